@@ -1,7 +1,13 @@
 from django.contrib import admin
 
 from aquarius_bribes.bribes.models import AggregatedByAssetBribe
-from aquarius_bribes.rewards.models import AssetHolderBalanceSnapshot, ClaimableBalance, Payout, VoteSnapshot
+from aquarius_bribes.rewards.models import (
+    AssetHolderBalanceSnapshot,
+    ClaimableBalance,
+    Payout,
+    VoteSnapshot,
+    VoteSnapshotArchive,
+)
 
 
 class AssetListFilter(admin.SimpleListFilter):
@@ -31,14 +37,32 @@ class VoteSnapshotAdmin(admin.ModelAdmin):
     get_short_market_key.short_description = 'Market key'
 
 
+@admin.register(VoteSnapshotArchive)
+class VoteSnapshotArchiveAdmin(admin.ModelAdmin):
+    list_display = (
+        'id', 'get_short_market_key', 'voting_account', 'votes_value', 'is_delegated', 'has_delegation',
+        'snapshot_time',
+    )
+    search_fields = ('=id', '=voting_account')
+    list_filter = ('snapshot_time', )
+
+    def get_short_market_key(self, obj):
+        return '{}...{}'.format(obj.market_key_id[:8], obj.market_key_id[-8:])
+    get_short_market_key.short_description = 'Market key'
+
+
 @admin.register(Payout)
 class PayoutAdmin(admin.ModelAdmin):
     list_display = (
-        'vote_snapshot', 'get_short_market_key', 'status', 'created_at', 'message', 'stellar_transaction_id',
+        'get_vote_snapshot', 'get_short_market_key', 'status', 'created_at', 'message', 'stellar_transaction_id',
     )
     list_filter = ('created_at', 'status')
     search_fields = ('stellar_transaction_id', 'vote_snapshot__voting_account', 'bribe__market_key__market_key')
 
+    def get_vote_snapshot(self, obj):
+        return obj.get_vote_snapshot()
+    get_vote_snapshot.short_description = 'Vote snapshot'
+
     def get_short_market_key(self, obj):
         return '{}...{}'.format(obj.bribe.market_key_id[:8], obj.bribe.market_key_id[-8:])
     get_short_market_key.short_description = 'Market key'
@@ -1,5 +1,5 @@
 from django.conf import settings as django_settings
-from django.core.cache import cache
+from django.db import models
 from django.utils import timezone
 
 from rest_framework.generics import GenericAPIView
@@ -7,20 +7,47 @@ from rest_framework.permissions import AllowAny
 from rest_framework.response import Response
 from rest_framework.status import HTTP_200_OK, HTTP_401_UNAUTHORIZED, HTTP_403_FORBIDDEN
 
-from aquarius_bribes.rewards.models import VoteSnapshot
-from aquarius_bribes.rewards.tasks import LOAD_VOTES_TASK_ACTIVE_KEY, task_load_votes
+from aquarius_bribes.rewards.models import VoteSnapshot, VoteSnapshotProgress
+from aquarius_bribes.rewards.tasks import is_load_votes_running, task_load_votes
 
 
 class RunVotesSnapshotAPIView(GenericAPIView):
     authorization_token = django_settings.REWARD_SERVER_AUTHORIZATION_TOKEN
     permission_classes = (AllowAny, )
 
+    def get_progress(self, snapshot_date):
+        progress = VoteSnapshotProgress.objects.filter(snapshot_time=snapshot_date)
+        summary = progress.aggregate(
+            markets=models.Count('id'),
+            done=models.Count('id', filter=models.Q(status=VoteSnapshotProgress.STATUS_DONE)),
+            failed=models.Count('id', filter=models.Q(status=VoteSnapshotProgress.STATUS_FAILED)),
+            last_update=models.Max('updated_at'),
+        )
+        summary['pages_loaded'] = sum(
+            next_page - 1 for next_page in progress.values_list('next_page', flat=True)
+        )
+        return summary
+
     def post(self, request, *args, **kwargs):
         if request.headers.get('Authorization', None) != "Bearer {}".format(self.authorization_token):
             return Response(data={'message': 'Not authorized'}, status=HTTP_401_UNAUTHORIZED)
 
-        in_progess = cache.get(LOAD_VOTES_TASK_ACTIVE_KEY, False)
-        if in_progess or VoteSnapshot.objects.filter(snapshot_time=timezone.now().date()).exists():
+        now = timezone.now()
+        progress = self.get_progress(now.date())
+
+        if is_load_votes_running():
+            return Response(data={'message': 'Snapshot in progress', 'progress': progress}, status=HTTP_403_FORBIDDEN)
+
+        if progress['markets']:
+            if progress['done'] == progress['markets']:
+                return Response(
+                    data={'message': 'Snapshot already exists', 'progress': progress}, status=HTTP_403_FORBIDDEN,
+                )
+            task_load_votes.delay()
+            return Response(data={'message': 'Snapshot resumed', 'progress': progress}, status=HTTP_200_OK)
+
+        # Days loaded before progress was recorded.
+        if VoteSnapshot.objects.filter(snapshot_time=now.date()).exists():
             return Response(data={'message': 'Snapshot already exists'}, status=HTTP_403_FORBIDDEN)
 
         task_load_votes.delay()
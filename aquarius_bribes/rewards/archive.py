@@ -0,0 +1,343 @@
+import hashlib
+import json
+import os
+from datetime import date, datetime, time
+from typing import Dict, Iterable, List, NamedTuple, Optional, Tuple
+
+from django.conf import settings
+from django.db import connection, models, transaction
+from django.utils import timezone
+
+import pyarrow as pa
+import pyarrow.compute as pc
+import pyarrow.ipc as ipc
+import pyarrow.parquet as pq
+
+from aquarius_bribes.rewards.models import AssetHolderBalanceSnapshot, Payout, VoteSnapshot
+from aquarius_bribes.utils.fields import StroopField
+
+FORMAT_PARQUET = 'parquet'
+FORMAT_ARROW = 'arrow'
+FORMATS = (FORMAT_PARQUET, FORMAT_ARROW)
+
+BATCH_SIZE = 50000
+
+
+class ArchiveSource(NamedTuple):
+    model: type
+    date_field: str
+    # Low-cardinality text columns (accounts, markets, assets) that are
+    # stored dictionary-encoded.
+    dictionary_fields: Tuple[str, ...]
+
+
+ARCHIVE_SOURCES = {
+    'payout': ArchiveSource(
+        Payout, 'created_at', ('asset_code', 'asset_issuer', 'status', 'message'),
+    ),
+    'votesnapshot': ArchiveSource(
+        VoteSnapshot, 'snapshot_time', ('market_key', 'voting_account', 'delegate_owner'),
+    ),
+    'assetholderbalancesnapshot': ArchiveSource(
+        AssetHolderBalanceSnapshot, 'created_at', ('account', 'asset_code', 'asset_issuer'),
+    ),
+}
+
+
+class ArchiveManifest(NamedTuple):
+    table: str
+    start: date
+    end: date
+    format: str
+    path: str
+    rows: int
+    checksum: str
+
+    def to_json(self) -> dict:
+        return dict(
+            self._asdict(), start=self.start.isoformat(), end=self.end.isoformat(), path=os.path.basename(self.path),
+        )
+
+    @classmethod
+    def from_json(cls, directory: str, data: dict) -> 'ArchiveManifest':
+        return cls(**dict(
+            data,
+            start=date.fromisoformat(data['start']),
+            end=date.fromisoformat(data['end']),
+            path=os.path.join(directory, data['path']),
+        ))
+
+
+class ArchiveVerificationError(Exception):
+    pass
+
+
+def _arrow_type(field: models.Field, dictionary: bool) -> pa.DataType:
+    if field.is_relation:
+        field = field.target_field
+    if dictionary:
+        return pa.dictionary(pa.int32(), pa.string())
+    if isinstance(field, models.DecimalField):
+        return pa.decimal128(field.max_digits, field.decimal_places)
+    if isinstance(field, StroopField):
+        return pa.decimal128(19, 7)
+    if isinstance(field, models.DateTimeField):
+        return pa.timestamp('us', tz='UTC')
+    if isinstance(field, models.DateField):
+        return pa.date32()
+    if isinstance(field, models.BooleanField):
+        return pa.bool_()
+    if isinstance(field, (models.IntegerField, models.AutoField)):
+        return pa.int64()
+    return pa.string()
+
+
+def _canonical(value) -> str:
+    if value is None:
+        return '\\N'
+    if isinstance(value, datetime):
+        return value.astimezone(timezone.utc).isoformat()
+    return str(value)
+
+
+class _RowChecksum(object):
+    """Order-sensitive digest of exported rows, comparable between the database and a file."""
+    def __init__(self):
+        self.rows = 0
+        self._hash = hashlib.sha256()
+
+    def update(self, rows: Iterable[tuple]):
+        for row in rows:
+            self._hash.update('\x1f'.join(_canonical(value) for value in row).encode())
+            self._hash.update(b'\n')
+            self.rows += 1
+
+    def hexdigest(self) -> str:
+        return self._hash.hexdigest()
+
+
+class _DictionaryEncoder(object):
+    """
+    Keeps one growing dictionary per column for the whole file so every batch
+    only extends the previous one; the Arrow IPC file format accepts that as
+    dictionary deltas but rejects replaced dictionaries.
+    """
+    def __init__(self):
+        self.values = []
+        self.indices = {}
+
+    def encode(self, column: list) -> pa.DictionaryArray:
+        codes = []
+        for value in column:
+            if value is None:
+                codes.append(None)
+                continue
+            code = self.indices.get(value)
+            if code is None:
+                code = self.indices[value] = len(self.values)
+                self.values.append(value)
+            codes.append(code)
+        return pa.DictionaryArray.from_arrays(
+            pa.array(codes, type=pa.int32()), pa.array(self.values, type=pa.string()),
+        )
+
+
+class ColumnarArchive(object):
+    """
+    Exports closed date ranges of historical snapshots and payouts to Parquet
+    or Arrow IPC files, one file plus a JSON manifest per (table, range), and
+    deletes the exported rows once the written file has been read back and
+    matched against the database.
+    """
+    def __init__(self, directory: str = None):
+        self.directory = directory or settings.REWARDS_ARCHIVE_ROOT
+
+    def _columns(self, source: ArchiveSource) -> List[Tuple[models.Field, bool]]:
+        return [
+            (field, field.name in source.dictionary_fields)
+            for field in source.model._meta.concrete_fields
+        ]
+
+    def _schema(self, source: ArchiveSource) -> pa.Schema:
+        return pa.schema([
+            pa.field(field.column, _arrow_type(field, dictionary), nullable=field.null)
+            for field, dictionary in self._columns(source)
+        ])
+
+    def _range_filter(self, source: ArchiveSource, start: date, end: date) -> Tuple[dict, list]:
+        field = source.model._meta.get_field(source.date_field)
+        if isinstance(field, models.DateTimeField):
+            bounds = [datetime.combine(start, time(), timezone.utc), datetime.combine(end, time(), timezone.utc)]
+        else:
+            bounds = [start, end]
+        lookup = {
+            '{0}__gte'.format(source.date_field): bounds[0],
+            '{0}__lt'.format(source.date_field): bounds[1],
+        }
+        return lookup, bounds
+
+    def _base_name(self, table: str, start: date, end: date) -> str:
+        return '{0}_{1}_{2}'.format(table, start.isoformat(), end.isoformat())
+
+    def _read_batches(self, manifest: ArchiveManifest) -> Iterable[pa.RecordBatch]:
+        if manifest.format == FORMAT_PARQUET:
+            yield from pq.ParquetFile(manifest.path).iter_batches(batch_size=BATCH_SIZE)
+        else:
+            with pa.memory_map(manifest.path) as source:
+                reader = ipc.open_file(source)
+                for index in range(reader.num_record_batches):
+                    yield reader.get_batch(index)
+
+    def _file_checksum(self, manifest: ArchiveManifest) -> _RowChecksum:
+        checksum = _RowChecksum()
+        for batch in self._read_batches(manifest):
+            columns = [column.to_pylist() for column in batch.columns]
+            checksum.update(zip(*columns))
+        return checksum
+
+    def export(self, table: str, start: date, end: date, file_format: str = FORMAT_PARQUET,
+               delete: bool = True) -> ArchiveManifest:
+        if end > timezone.now().date():
+            raise ValueError('Only closed ranges can be archived, {0} is not over yet'.format(end))
+        if start >= end:
+            raise ValueError('Empty archive range {0} - {1}'.format(start, end))
+
+        source = ARCHIVE_SOURCES[table]
+        columns = self._columns(source)
+        schema = self._schema(source)
+        lookup, bounds = self._range_filter(source, start, end)
+        if delete:
+            self._check_protected(source, table, lookup)
+        queryset = source.model.objects.filter(**lookup).order_by('pk').values_list(
+            *[field.attname for field, _ in columns]
+        )
+
+        os.makedirs(self.directory, exist_ok=True)
+        base_name = self._base_name(table, start, end)
+        path = os.path.join(self.directory, '{0}.{1}'.format(base_name, file_format))
+        encoders = {index: _DictionaryEncoder() for index, (_, dictionary) in enumerate(columns) if dictionary}
+        checksum = _RowChecksum()
+
+        if file_format == FORMAT_PARQUET:
+            writer = pq.ParquetWriter(path, schema, compression='zstd')
+        else:
+            writer = ipc.new_file(path, schema, options=ipc.IpcWriteOptions(emit_dictionary_deltas=True))
+
+        def write(rows):
+            checksum.update(rows)
+            arrays = []
+            for index, column in enumerate(zip(*rows)):
+                if index in encoders:
+                    arrays.append(encoders[index].encode(column))
+                else:
+                    arrays.append(pa.array(column, type=schema.field(index).type))
+            writer.write_batch(pa.RecordBatch.from_arrays(arrays, schema=schema))
+
+        with writer:
+            rows = []
+            for row in queryset.iterator(chunk_size=BATCH_SIZE):
+                rows.append(row)
+                if len(rows) >= BATCH_SIZE:
+                    write(rows)
+                    rows = []
+            if rows:
+                write(rows)
+
+        manifest = ArchiveManifest(
+            table=table, start=start, end=end, format=file_format, path=path,
+            rows=checksum.rows, checksum=checksum.hexdigest(),
+        )
+
+        written = self._file_checksum(manifest)
+        if (written.rows, written.hexdigest()) != (manifest.rows, manifest.checksum):
+            os.remove(path)
+            raise ArchiveVerificationError('{0} does not match the exported rows'.format(path))
+
+        with open(os.path.join(self.directory, '{0}.json'.format(base_name)), 'w') as manifest_file:
+            json.dump(manifest.to_json(), manifest_file, indent=2)
+
+        if delete:
+            self._delete(source, manifest, bounds)
+        return manifest
+
+    def _check_protected(self, source: ArchiveSource, table: str, lookup: dict):
+        # The raw delete below bypasses PROTECT, which is the only guard of
+        # relations without a database constraint, e.g. Payout.vote_snapshot.
+        rows = source.model.objects.filter(**lookup).values('pk')
+        for relation in source.model._meta.related_objects:
+            if relation.on_delete is not models.PROTECT:
+                continue
+            referencing = relation.related_model._base_manager.filter(**{
+                '{0}__in'.format(relation.field.name): rows,
+            })
+            if referencing.exists():
+                raise ValueError('Rows of {0} in the range are still referenced by {1}, archive those first'.format(
+                    table, relation.related_model._meta.model_name,
+                ))
+
+    def _delete(self, source: ArchiveSource, manifest: ArchiveManifest, bounds: list):
+        # Raw SQL on purpose: the ORM would collect every row (and the payouts
+        # protecting vote snapshots) into memory before deleting them.
+        column = source.model._meta.get_field(source.date_field).column
+        with transaction.atomic(), connection.cursor() as cursor:
+            cursor.execute(
+                'DELETE FROM "{0}" WHERE "{1}" >= %s AND "{1}" < %s'.format(source.model._meta.db_table, column),
+                bounds,
+            )
+            if cursor.rowcount != manifest.rows:
+                raise ArchiveVerificationError('Deleting {0} would remove {1} rows, {2} were archived'.format(
+                    manifest.table, cursor.rowcount, manifest.rows,
+                ))
+
+    def manifests(self, table: str = None) -> List[ArchiveManifest]:
+        if not os.path.isdir(self.directory):
+            return []
+        result = []
+        for name in sorted(os.listdir(self.directory)):
+            if not name.endswith('.json'):
+                continue
+            with open(os.path.join(self.directory, name)) as manifest_file:
+                manifest = ArchiveManifest.from_json(self.directory, json.load(manifest_file))
+            if table is None or manifest.table == table:
+                result.append(manifest)
+        return result
+
+    def read(self, table: str, start: date, end: date, filters: Optional[Dict[str, object]] = None,
+             columns: Optional[List[str]] = None) -> pa.Table:
+        """
+        Rows of ``table`` archived for days in [start, end), optionally
+        narrowed by equality ``filters`` on column names.
+        """
+        source = ARCHIVE_SOURCES[table]
+        schema = self._schema(source)
+        date_column = source.model._meta.get_field(source.date_field).column
+        _, bounds = self._range_filter(source, start, end)
+
+        tables = []
+        for manifest in self.manifests(table):
+            if manifest.end <= start or manifest.start >= end:
+                continue
+            if manifest.format == FORMAT_PARQUET:
+                data = pq.read_table(manifest.path)
+            else:
+                with pa.memory_map(manifest.path) as source_file:
+                    data = ipc.open_file(source_file).read_all()
+
+            date_type = data.schema.field(date_column).type
+            mask = pc.and_(
+                pc.greater_equal(data[date_column], pa.scalar(bounds[0], type=date_type)),
+                pc.less(data[date_column], pa.scalar(bounds[1], type=date_type)),
+            )
+            for column, value in (filters or {}).items():
+                values = data[column]
+                if pa.types.is_dictionary(values.type):
+                    values = values.cast(values.type.value_type)
+                mask = pc.and_(mask, pc.equal(values, value))
+            data = data.filter(mask)
+            tables.append(data.select(columns) if columns else data)
+
+        if not tables:
+            if columns:
+                schema = pa.schema([schema.field(name) for name in columns])
+            return schema.empty_table()
+        return pa.concat_tables(tables)
@@ -0,0 +1,78 @@
+import io
+from datetime import date, datetime
+from typing import List
+
+from django.db import connection, transaction
+
+COPY_BATCH_SIZE = 50000
+
+
+def _copy_value(value) -> str:
+    if value is None:
+        return '\\N'
+    if isinstance(value, bool):
+        return 't' if value else 'f'
+    if isinstance(value, (date, datetime)):
+        return value.isoformat()
+    return str(value).replace('\\', '\\\\').replace('\t', '\\t').replace('\n', '\\n').replace('\r', '\\r')
+
+
+class CopyLoader(object):
+    """
+    Bulk loads unsaved model instances with COPY FROM STDIN into a temporary
+    staging table shaped like the model's table (dropped on commit), from
+    which they are inserted or merged with a single statement. Primary keys
+    are left to the database; auto_now_add fields are filled like save()
+    would fill them.
+    """
+    def __init__(self, model, field_names: List[str] = None):
+        self.model = model
+        if field_names is None:
+            self.fields = [field for field in model._meta.concrete_fields if not field.primary_key]
+        else:
+            self.fields = [model._meta.get_field(name) for name in field_names]
+
+    @property
+    def table(self) -> str:
+        return self.model._meta.db_table
+
+    @property
+    def staging_table(self) -> str:
+        return '{0}_staging'.format(self.table)
+
+    @property
+    def columns(self) -> str:
+        return ', '.join('"{0}"'.format(field.column) for field in self.fields)
+
+    def _buffer(self, instances) -> io.StringIO:
+        buffer = io.StringIO()
+        for instance in instances:
+            buffer.write('\t'.join(
+                _copy_value(field.get_db_prep_save(field.pre_save(instance, True), connection))
+                for field in self.fields
+            ))
+            buffer.write('\n')
+        buffer.seek(0)
+        return buffer
+
+    def stage(self, cursor, instances) -> str:
+        """COPY instances into the staging table; must run inside a transaction."""
+        cursor.execute(
+            'CREATE TEMPORARY TABLE IF NOT EXISTS "{0}" ON COMMIT DROP AS '
+            'SELECT {1} FROM "{2}" WITH NO DATA'.format(self.staging_table, self.columns, self.table),
+        )
+        # Still there when the caller's transaction staged an earlier batch.
+        cursor.execute('TRUNCATE "{0}"'.format(self.staging_table))
+        cursor.copy_expert(
+            'COPY "{0}" ({1}) FROM STDIN'.format(self.staging_table, self.columns),
+            self._buffer(instances),
+        )
+        return self.staging_table
+
+    def insert(self, instances, batch_size: int = COPY_BATCH_SIZE):
+        for index in range(0, len(instances), batch_size):
+            with transaction.atomic(), connection.cursor() as cursor:
+                staging_table = self.stage(cursor, instances[index:index + batch_size])
+                cursor.execute('INSERT INTO "{0}" ({1}) SELECT {1} FROM "{2}"'.format(
+                    self.table, self.columns, staging_table,
+                ))
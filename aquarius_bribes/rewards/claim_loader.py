@@ -1,21 +1,60 @@
-from typing import Dict, List
+from typing import Dict, Iterator, List, Tuple
 
 from django.conf import settings
-from django.utils import timezone
+from django.core.cache import cache
+from django.db import transaction
 
-from billiard.exceptions import SoftTimeLimitExceeded
 from stellar_sdk import Asset as SDKAsset
 from stellar_sdk import ClaimPredicate
 
 from aquarius_bribes.bribes.utils import get_horizon
-from aquarius_bribes.rewards.models import ClaimableBalance, Claimant
+from aquarius_bribes.rewards.models import Account, ClaimableBalance, Claimant, get_snapshot_date
+from aquarius_bribes.utils.concurrency import consume_concurrently
+from aquarius_bribes.utils.horizon import HorizonPager
+
+SNAPSHOT_DONE = 'done'
 
 
 class ClaimLoader(object):
-    def __init__(self, asset: SDKAsset, account: str = None):
+    """
+    Loads the claimable balances of one asset for a snapshot day. The
+    Horizon cursor of the last stored page is kept per (asset, day), so a
+    snapshot stopped by a time limit resumes where it stopped.
+    """
+    def __init__(
+        self, asset: SDKAsset, account: str = None, snapshot_date=None,
+        cursor_cache_key: str = None, cursor_cache_timeout: int = 60 * 60 * 48, pager: HorizonPager = None,
+    ):
         self.asset = asset
         self.account = account
         self.horizon = get_horizon()
+        self.pager = pager or HorizonPager()
+        self.snapshot_date = snapshot_date or get_snapshot_date()
+
+        if not cursor_cache_key:
+            cursor_cache_key = '{0}:{1}:{2}_claims_loader'.format(
+                self.asset.code, self.asset.issuer, self.snapshot_date.isoformat(),
+            )
+        self.cursor_cache_key = cursor_cache_key
+        self.cursor_cache_timeout = cursor_cache_timeout
+
+    def load_cursor(self) -> str:
+        return cache.get(self.cursor_cache_key, None)
+
+    def save_cursor(self, cursor: str):
+        cache.set(self.cursor_cache_key, cursor, self.cursor_cache_timeout)
+
+    def reset(self):
+        cache.delete(self.cursor_cache_key)
+
+    def is_started(self) -> bool:
+        return self.load_cursor() is not None
+
+    def is_done(self) -> bool:
+        return self.load_cursor() == SNAPSHOT_DONE
+
+    def mark_done(self):
+        self.save_cursor(SNAPSHOT_DONE)
 
     def _get_page(self, page_limit: int = 200, cursor=None) -> List[Dict]:
         builder = self.horizon.claimable_balances()
@@ -36,20 +75,19 @@ class ClaimLoader(object):
 
         return builder.call()['_embedded']['records']
 
-    def make_claim_spanshot(self):
-        claims = self._get_page()
-
-        processed_claims = []
-        while claims:
-            try:
-                for claim in claims:
-                    processed_claims.append(self._process_claim(claim))
-
-                cursor = claims[-1]['paging_token']
+    def iter_pages(self) -> Iterator[List[Dict]]:
+        """
+        Page through the asset's claimable balances on Horizon, starting
+        after the saved cursor. Does not touch the database.
+        """
+        if self.is_done():
+            return
+        yield from self.pager.iter_pages(lambda cursor: self._get_page(cursor=cursor), self.load_cursor())
 
-                claims = self._get_page(cursor=cursor)
-            except SoftTimeLimitExceeded:
-                pass
+    def make_claim_spanshot(self):
+        for claims in self.iter_pages():
+            self.save_page(claims)
+        self.mark_done()
 
     def _build_predicate(self, raw_predicate):
         if 'and' in raw_predicate:
@@ -79,36 +117,96 @@ class ClaimLoader(object):
 
         raise Exception('Invalid predicate {0}'.format(raw_predicate))
 
-    def _process_claim(self, claim: Dict) -> ClaimableBalance:
+    def parse_claim(self, claim: Dict) -> Tuple[Dict, List[Dict]]:
+        """Field values of a Horizon claimable balance record and of its claimants."""
         owner = None
         for claimant in claim['claimants']:
             if claimant['predicate'].get('not', {}).get('unconditional', False) is not True:
                 owner = claimant['destination']
                 break
 
-        date = timezone.now()
-        date = date.replace(hour=0, minute=0, second=0, microsecond=0)
-        instance = ClaimableBalance.objects.filter(claimable_balance_id=claim['id'], loaded_at__gt=date).first()
-
-        if not instance:
-            instance = ClaimableBalance.objects.create(
-                claimable_balance_id=claim['id'],
-                asset_code=self.asset.code,
-                asset_issuer=self.asset.issuer,
-                amount=claim['amount'],
-                sponsor=claim['sponsor'],
-                paging_token='',
-                last_modified_time=claim['last_modified_time'],
-                last_modified_ledger=claim['last_modified_ledger'],
-                owner=owner,
-            )
-        else:
-            return instance
-
+        balance = {
+            'claimable_balance_id': claim['id'],
+            'asset_code': self.asset.code,
+            'asset_issuer': self.asset.issuer,
+            'amount': claim['amount'],
+            'sponsor': claim['sponsor'],
+            'last_modified_time': claim['last_modified_time'],
+            'last_modified_ledger': claim['last_modified_ledger'],
+            'owner': owner,
+        }
+        claimants = []
         for claimant in claim['claimants']:
-            Claimant.objects.create(
-                destination=claimant['destination'],
-                raw_predicate=self._build_predicate(claimant['predicate']).to_xdr_object().to_xdr(),
-                claimable_balance=instance,
-            )
-        return instance
+            raw_predicate = self._build_predicate(claimant['predicate']).to_xdr_object().to_xdr()
+            claimants.append({
+                'destination': claimant['destination'],
+                'raw_predicate': raw_predicate,
+                'predicate_kind': Claimant.get_predicate_kind(raw_predicate),
+            })
+        return balance, claimants
+
+    def _build_claim(self, claim: Dict, snapshot_date) -> Tuple[ClaimableBalance, List[Claimant]]:
+        balance, claimants = self.parse_claim(claim)
+        return (
+            ClaimableBalance(paging_token='', snapshot_date=snapshot_date, **balance),
+            [Claimant(snapshot_date=snapshot_date, **claimant) for claimant in claimants],
+        )
+
+    def save_page(self, claims: List[Dict]) -> List[ClaimableBalance]:
+        """
+        Store one Horizon page: balances and then their claimants, each with
+        a single bulk insert, and move the cursor past it. Balances already
+        stored for the snapshot day are skipped together with their
+        claimants, so replaying a page after an interruption is harmless.
+        """
+        snapshot_date = self.snapshot_date
+        existing = set(ClaimableBalance.objects.filter(
+            snapshot_date=snapshot_date, claimable_balance_id__in=[claim['id'] for claim in claims],
+        ).values_list('claimable_balance_id', flat=True))
+
+        built = [
+            self._build_claim(claim, snapshot_date)
+            for claim in claims if claim['id'] not in existing
+        ]
+        if not built:
+            self.save_cursor(claims[-1]['paging_token'])
+            return []
+        balances = [balance for balance, _ in built]
+        Account.objects.assign_refs(balances)
+
+        with transaction.atomic():
+            # Postgres returns the new primary keys, so claimants can point at them.
+            ClaimableBalance.objects.bulk_create(balances)
+            claimants = []
+            for balance, balance_claimants in built:
+                for claimant in balance_claimants:
+                    claimant.claimable_balance = balance
+                    claimants.append(claimant)
+            Account.objects.assign_refs(claimants)
+            Claimant.objects.bulk_create(claimants)
+        self.save_cursor(claims[-1]['paging_token'])
+        return balances
+
+
+def load_claims_concurrently(loaders: List[ClaimLoader], max_workers: int = 4):
+    """
+    Page the claimable balances of several assets in a thread pool while
+    the calling thread stores each page as it arrives, see
+    consume_concurrently. Assets paged to the end are marked done; the
+    first fetch error is raised once the other assets are done. A time
+    limit hitting the calling thread leaves every asset at its last stored
+    page.
+    """
+    errors = consume_concurrently(
+        loaders,
+        lambda loader: loader.iter_pages(),
+        lambda loader, claims: loader.save_page(claims),
+        max_workers=max_workers,
+        thread_name_prefix='claims-loader',
+    )
+    for loader, error in zip(loaders, errors):
+        if error is None:
+            loader.mark_done()
+    for error in errors:
+        if error is not None:
+            raise error
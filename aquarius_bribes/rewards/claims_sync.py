@@ -0,0 +1,245 @@
+from typing import Dict, List, Optional
+
+from django.core.cache import cache
+from django.db import connection, transaction
+from django.utils import timezone
+
+from stellar_sdk import Asset as SDKAsset
+
+from aquarius_bribes.rewards.claim_loader import ClaimLoader
+from aquarius_bribes.rewards.models import Account, ClaimableBalance, Claimant, LiveClaimableBalance, LiveClaimant
+from aquarius_bribes.utils.assets import get_asset_string
+from aquarius_bribes.utils.horizon import HorizonPager
+
+# Arbitrary constant identifying the sync in pg_advisory_lock.
+SYNC_LOCK_ID = 4100041
+
+COPY_BALANCES_SQL = """
+INSERT INTO "{snapshot}" (
+    "claimable_balance_id", "asset_code", "asset_issuer", "amount", "sponsor", "owner", "owner_ref_id",
+    "paging_token", "last_modified_time", "last_modified_ledger", "loaded_at", "updated_at", "snapshot_date"
+)
+SELECT "claimable_balance_id", "asset_code", "asset_issuer", "amount", "sponsor", "owner", "owner_ref_id",
+    '', "last_modified_time", "last_modified_ledger", now(), now(), %s
+FROM "{live}"
+WHERE "asset_code" = %s AND "asset_issuer" = %s
+ORDER BY "id"
+"""
+COPY_CLAIMANTS_SQL = """
+INSERT INTO "{snapshot_claimant}" (
+    "destination", "destination_ref_id", "raw_predicate", "predicate_kind", "claimable_balance_id", "snapshot_date"
+)
+SELECT live_claimant."destination", live_claimant."destination_ref_id", live_claimant."raw_predicate",
+    live_claimant."predicate_kind", snapshot."id", snapshot."snapshot_date"
+FROM "{live_claimant}" AS live_claimant
+JOIN "{live}" AS live ON live."id" = live_claimant."claimable_balance_id"
+JOIN "{snapshot}" AS snapshot
+    ON snapshot."claimable_balance_id" = live."claimable_balance_id" AND snapshot."snapshot_date" = %s
+WHERE live."asset_code" = %s AND live."asset_issuer" = %s
+ORDER BY live_claimant."id"
+"""
+
+
+class LiveClaimsSync(object):
+    """
+    Keeps LiveClaimableBalance up to date from the claimable balance
+    listings of the delegatable assets and copies it into a day's
+    ClaimableBalance snapshot.
+
+    Horizon orders an asset's listing by paging token, which starts with
+    the ledger a balance was last modified in, so paging on from the last
+    token seen returns only the balances created since; the first sync
+    pages the whole listing that way. Horizon files claim and clawback
+    operations under the claiming account only, not under the assets or
+    their other claimants, so there is no stream of removals to follow:
+    claimed balances just drop out of the listing. A sweep re-lists the
+    assets once per snapshot and deletes the balances it did not see, and
+    copy_snapshot refuses to copy before that sweep is complete. Between
+    snapshots only the new balances are paged, and every call is bounded
+    by ``max_pages`` per asset.
+    """
+    def __init__(
+        self, assets: List[SDKAsset], cursor_cache_key: str = 'live_claims_sync', pager: HorizonPager = None,
+    ):
+        self.pager = pager or HorizonPager()
+        self.cursor_cache_key = cursor_cache_key
+        self.loaders = {
+            get_asset_string(asset): ClaimLoader(
+                asset, cursor_cache_key='{0}:{1}:{2}_tail'.format(cursor_cache_key, asset.code, asset.issuer),
+                cursor_cache_timeout=None, pager=self.pager,
+            )
+            for asset in assets
+        }
+
+    def _get_sweep_key(self, loader: ClaimLoader) -> str:
+        return '{0}:{1}:{2}_sweep'.format(self.cursor_cache_key, loader.asset.code, loader.asset.issuer)
+
+    def _get_swept_key(self, loader: ClaimLoader) -> str:
+        return '{0}:{1}:{2}_swept'.format(self.cursor_cache_key, loader.asset.code, loader.asset.issuer)
+
+    def _get_caught_up_key(self, loader: ClaimLoader) -> str:
+        return '{0}:{1}:{2}_caught_up'.format(self.cursor_cache_key, loader.asset.code, loader.asset.issuer)
+
+    def _get_copied_key(self) -> str:
+        return '{0}_copied_at'.format(self.cursor_cache_key)
+
+    def is_caught_up(self, loader: ClaimLoader) -> bool:
+        """Whether the tail of the asset's listing has been paged to its end at least once."""
+        return cache.get(self._get_caught_up_key(loader), False)
+
+    def is_swept(self, loader: ClaimLoader) -> bool:
+        """Whether a sweep of the asset started after the last copied snapshot is complete."""
+        swept_at = cache.get(self._get_swept_key(loader))
+        copied_at = cache.get(self._get_copied_key())
+        return swept_at is not None and (copied_at is None or swept_at >= copied_at)
+
+    def _store(self, loader: ClaimLoader, records: List[Dict]):
+        balances = []
+        claimants = []
+        for record in records:
+            balance, balance_claimants = loader.parse_claim(record)
+            balance = LiveClaimableBalance(**balance)
+            balances.append(balance)
+            claimants.extend((balance, LiveClaimant(**claimant)) for claimant in balance_claimants)
+        if not balances:
+            return
+
+        Account.objects.assign_refs(balances)
+        Account.objects.assign_refs([claimant for _, claimant in claimants])
+        with transaction.atomic():
+            # Replaces rows of balances seen again, e.g. after a replayed page.
+            LiveClaimableBalance.objects.filter(
+                claimable_balance_id__in=[balance.claimable_balance_id for balance in balances],
+            ).delete()
+            LiveClaimableBalance.objects.bulk_create(balances)
+            for balance, claimant in claimants:
+                claimant.claimable_balance = balance
+            LiveClaimant.objects.bulk_create([claimant for _, claimant in claimants])
+
+    def reset(self):
+        """Drop the live rows and cursors of the assets; the next sync pages the listings from the start."""
+        for loader in self.loaders.values():
+            LiveClaimableBalance.objects.filter(
+                asset_code=loader.asset.code, asset_issuer=loader.asset.issuer,
+            ).delete()
+            loader.reset()
+            cache.delete_many([
+                self._get_sweep_key(loader), self._get_swept_key(loader), self._get_caught_up_key(loader),
+            ])
+        cache.delete(self._get_copied_key())
+
+    def _sync_tail(self, loader: ClaimLoader, max_pages: Optional[int]) -> bool:
+        pages = 0
+        for claims in loader.iter_pages():
+            self._store(loader, claims)
+            loader.save_cursor(claims[-1]['paging_token'])
+            pages += 1
+            if max_pages is not None and pages >= max_pages:
+                return False
+        cache.set(self._get_caught_up_key(loader), True, None)
+        return True
+
+    def _sweep(self, loader: ClaimLoader, max_pages: Optional[int]) -> bool:
+        sweep = cache.get(self._get_sweep_key(loader))
+        copied_at = cache.get(self._get_copied_key())
+        if sweep is None or (copied_at is not None and sweep['started_at'] < copied_at):
+            sweep = {'cursor': None, 'started_at': timezone.now()}
+        pages = 0
+        while max_pages is None or pages < max_pages:
+            claims = self.pager.call(lambda: loader._get_page(cursor=sweep['cursor']))
+            if not claims:
+                # Balances left untouched since the sweep started are gone.
+                LiveClaimableBalance.objects.filter(
+                    asset_code=loader.asset.code, asset_issuer=loader.asset.issuer,
+                    updated_at__lt=sweep['started_at'],
+                ).delete()
+                cache.set(self._get_swept_key(loader), sweep['started_at'], None)
+                cache.delete(self._get_sweep_key(loader))
+                return True
+
+            ids = [claim['id'] for claim in claims]
+            known = set(LiveClaimableBalance.objects.filter(
+                claimable_balance_id__in=ids,
+            ).values_list('claimable_balance_id', flat=True))
+            LiveClaimableBalance.objects.filter(claimable_balance_id__in=known).update(updated_at=timezone.now())
+            self._store(loader, [claim for claim in claims if claim['id'] not in known])
+            sweep['cursor'] = claims[-1]['paging_token']
+            pages += 1
+        cache.set(self._get_sweep_key(loader), sweep, None)
+        return False
+
+    def _lock(self, wait: bool) -> bool:
+        with connection.cursor() as cursor:
+            if wait:
+                cursor.execute('SELECT pg_advisory_lock(%s)', [SYNC_LOCK_ID])
+                return True
+            cursor.execute('SELECT pg_try_advisory_lock(%s)', [SYNC_LOCK_ID])
+            return cursor.fetchone()[0]
+
+    def _unlock(self):
+        with connection.cursor() as cursor:
+            cursor.execute('SELECT pg_advisory_unlock(%s)', [SYNC_LOCK_ID])
+
+    def sync(self, wait: bool = True, max_pages: int = None) -> bool:
+        """
+        Page the new balances of every asset, at most ``max_pages`` listing
+        pages each. Returns True once every asset's listing has been paged
+        to its end. Runs under a Postgres advisory lock; without ``wait`` it
+        returns False right away when another sync holds it.
+        """
+        if not self._lock(wait):
+            return False
+        try:
+            caught_up = True
+            for loader in self.loaders.values():
+                if not self._sync_tail(loader, max_pages):
+                    caught_up = False
+        finally:
+            self._unlock()
+        return caught_up
+
+    def sweep(self, max_pages: int = None) -> bool:
+        """
+        Move on the sweep of every asset not swept since the last copied
+        snapshot, at most ``max_pages`` listing pages each; a sweep started
+        before that snapshot starts over. Returns True once every asset is
+        swept, see is_swept.
+        """
+        self._lock(wait=True)
+        try:
+            swept = True
+            for loader in self.loaders.values():
+                if not self.is_swept(loader) and not self._sweep(loader, max_pages):
+                    swept = False
+        finally:
+            self._unlock()
+        return swept
+
+    def copy_snapshot(self, snapshot_date):
+        """
+        Replace the day's ClaimableBalance and Claimant rows of the assets
+        with the live ones. Raises ValueError unless every asset is caught
+        up and swept since the last copied snapshot: the live rows could
+        still hold balances claimed since.
+        """
+        for loader in self.loaders.values():
+            if not self.is_caught_up(loader) or not self.is_swept(loader):
+                raise ValueError('Live claims of {0} are not synced and swept, sync them first'.format(
+                    get_asset_string(loader.asset),
+                ))
+
+        tables = {
+            'snapshot': ClaimableBalance._meta.db_table,
+            'snapshot_claimant': Claimant._meta.db_table,
+            'live': LiveClaimableBalance._meta.db_table,
+            'live_claimant': LiveClaimant._meta.db_table,
+        }
+        with transaction.atomic(), connection.cursor() as cursor:
+            for loader in self.loaders.values():
+                asset = [loader.asset.code, loader.asset.issuer]
+                ClaimableBalance.objects.filter(
+                    snapshot_date=snapshot_date, asset_code=asset[0], asset_issuer=asset[1],
+                ).delete()
+                cursor.execute(COPY_BALANCES_SQL.format(**tables), [snapshot_date] + asset)
+                cursor.execute(COPY_CLAIMANTS_SQL.format(**tables), [snapshot_date] + asset)
+        cache.set(self._get_copied_key(), timezone.now(), None)
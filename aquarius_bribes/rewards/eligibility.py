@@ -1,42 +1,136 @@
 from datetime import datetime, time, timedelta
 from decimal import ROUND_UP, Decimal
 
-from django.db import models
+from django.db import connection, models, transaction
 from django.utils import timezone
 
 from stellar_sdk import Asset
 
-from aquarius_bribes.rewards.models import AssetHolderBalanceSnapshot, VoteSnapshot
+from aquarius_bribes.rewards.models import (
+    AssetHolderBalanceSnapshot,
+    AssetHolderBitmap,
+    AssetHolderInterval,
+    PayableVote,
+    PayableVoteSet,
+    VoteSnapshot,
+    VoteSnapshotProgress,
+)
+from aquarius_bribes.utils.bitmaps import IdBitmap
+from aquarius_bribes.utils.fields import from_stroops
 
+# Bribes with a NULL holders index are native and need no trustline; the
+# others keep the votes of their asset's holders, as a semi join.
+ELIGIBILITY_TOTALS_SQL = """
+WITH bribe ("id", "market_key_id", "holders_index") AS (VALUES {bribes}),
+holder ("holders_index", "account_id") AS ({holders})
+SELECT bribe."id", SUM(vote."votes_value")
+FROM bribe
+JOIN "{vote_snapshot}" AS vote
+    ON vote."market_key_id" = bribe."market_key_id" AND vote."snapshot_time" = %s AND NOT vote."has_delegation"
+WHERE bribe."holders_index" IS NULL
+GROUP BY bribe."id"
+UNION ALL
+SELECT bribe."id", SUM(vote."votes_value")
+FROM bribe
+JOIN "{vote_snapshot}" AS vote
+    ON vote."market_key_id" = bribe."market_key_id" AND vote."snapshot_time" = %s AND NOT vote."has_delegation"
+WHERE EXISTS (
+    SELECT 1 FROM holder
+    WHERE holder."holders_index" = bribe."holders_index" AND holder."account_id" = vote."voting_account_ref_id"
+)
+GROUP BY bribe."id"
+"""
 
-def get_asset_holders(asset_code, asset_issuer, snapshot_date):
-    """Accounts that held a trustline for the asset on the given day."""
+
+def get_asset_holders_query(asset_code, asset_issuer, snapshot_date) -> models.QuerySet:
+    """
+    Flat queryset of the Account ids that held a trustline for the asset on
+    the given day, for filtering votes in the database: the day's
+    AssetHolderBalanceSnapshot rows for days snapshotted before the
+    intervals, else the holder intervals valid that day.
+    """
     day_start = timezone.make_aware(datetime.combine(snapshot_date, time.min))
-    day_end = day_start + timedelta(days=1)
-    return set(
-        AssetHolderBalanceSnapshot.objects.filter(
-            created_at__gte=day_start,
-            created_at__lt=day_end,
-            asset_code=asset_code,
-            asset_issuer=asset_issuer,
-        ).values_list('account', flat=True)
+    legacy = AssetHolderBalanceSnapshot.objects.filter(
+        created_at__gte=day_start,
+        created_at__lt=day_start + timedelta(days=1),
+        asset_code=asset_code,
+        asset_issuer=asset_issuer,
+    ).values_list('account_ref_id', flat=True)
+    if legacy.exists():
+        return legacy
+    return AssetHolderInterval.objects.as_of(snapshot_date).filter(
+        asset_code=asset_code, asset_issuer=asset_issuer,
+    ).values_list('account_id', flat=True)
+
+
+def build_asset_holders(asset_code, asset_issuer, snapshot_date) -> IdBitmap:
+    """Bitmap of the Account ids of get_asset_holders_query."""
+    return IdBitmap.from_ids(get_asset_holders_query(asset_code, asset_issuer, snapshot_date).iterator())
+
+
+def store_asset_holders(asset_code, asset_issuer, snapshot_date) -> IdBitmap:
+    """
+    Persist the day's holders bitmap; call once the day's trustee snapshot
+    is complete.
+    """
+    holders = build_asset_holders(asset_code, asset_issuer, snapshot_date)
+    AssetHolderBitmap.objects.update_or_create(
+        asset_code=asset_code, asset_issuer=asset_issuer, snapshot_date=snapshot_date,
+        defaults={'bitmap': holders.to_bytes(), 'holders': len(holders)},
     )
+    return holders
+
+
+def get_asset_holders(asset_code, asset_issuer, snapshot_date) -> IdBitmap:
+    """
+    Holders of the asset on the given day, from the stored bitmap, or
+    built by build_asset_holders while the day has none.
+    """
+    stored = AssetHolderBitmap.objects.filter(
+        asset_code=asset_code, asset_issuer=asset_issuer, snapshot_date=snapshot_date,
+    ).values_list('bitmap', flat=True).first()
+    if stored is not None:
+        return IdBitmap.from_bytes(stored)
+    return build_asset_holders(asset_code, asset_issuer, snapshot_date)
 
 
-def get_payable_votes(bribe, snapshot_date, reward_amount=None, asset_holder_cache=None):
+def get_unfinished_markets(snapshot_date, market_keys) -> set:
+    """
+    Markets among ``market_keys`` whose votes of the day are still loading
+    or failed to load, see VoteSnapshotProgress. Their snapshot may be
+    partial, so nothing is paid against it. Days loaded before progress
+    was tracked have no rows and count as finished.
+    """
+    return set(VoteSnapshotProgress.objects.filter(
+        snapshot_time=snapshot_date, market_key_id__in=list(market_keys),
+    ).exclude(status=VoteSnapshotProgress.STATUS_DONE).values_list('market_key_id', flat=True))
+
+
+def _get_bribe_asset_holders(bribe, snapshot_date, asset_holder_cache=None) -> models.QuerySet:
+    cache_key = (bribe.asset_code, bribe.asset_issuer, snapshot_date)
+    if asset_holder_cache is not None and cache_key in asset_holder_cache:
+        return asset_holder_cache[cache_key]
+
+    accounts = get_asset_holders_query(bribe.asset_code, bribe.asset_issuer, snapshot_date)
+    if asset_holder_cache is not None:
+        asset_holder_cache[cache_key] = accounts
+    return accounts
+
+
+def get_payable_votes(bribe, snapshot_date, reward_amount=None, asset_holder_cache=None, eligibility=None):
     """
     Return (votes_qs, total_votes_pre_dust) — shared definition of the payable
     set used by task_pay_rewards, reconcile, and monitoring.
 
     Filters (identical to the inline chain in task_pay_rewards):
+      0. Nothing is payable while the market's votes of the day are not
+         completely loaded, see get_unfinished_markets.
       1. VoteSnapshot(market_key=bribe.market_key, snapshot_time=snapshot_date)
-      2. For non-native bribes: voting_account must have an
-         AssetHolderBalanceSnapshot for the bribe asset on that UTC day
-         (trustline requirement). Holders are fetched once via the
-         (asset_code, asset_issuer, created_at) composite index and applied
-         to VoteSnapshot as ``voting_account = ANY(%s)``. This keeps the
-         queryset filter structural (no subquery join), which avoids a
-         Nested Loop Semi Join on large holder sets.
+      2. For non-native bribes: voting_account must hold the bribe asset
+         on that UTC day (trustline requirement). Holders are a subquery
+         over the stored holder rows, see get_asset_holders_query, applied
+         as ``voting_account_ref_id IN (...)``, so neither holders nor
+         voters are loaded into Python or sent back as parameters.
       3. has_delegation=False (delegators routed through delegatee).
       4. (optional) If reward_amount is given: dust filter
          votes_value >= ceil(1e-7 * total_votes_pre_dust / reward_amount)
@@ -47,44 +141,152 @@ def get_payable_votes(bribe, snapshot_date, reward_amount=None, asset_holder_cac
     use as the denominator — computing over the post-dust queryset
     inflates per-recipient reward values.
 
-    asset_holder_cache: optional ``{(asset_code, asset_issuer, date): set}``
+    asset_holder_cache: optional ``{(asset_code, asset_issuer, date): QuerySet}``
     dict; when supplied, callers that walk many bribes for the same date
-    reuse the holder set across invocations.
+    reuse the holders query of get_asset_holders_query across invocations.
+
+    eligibility: optional ``(total_votes_pre_dust, min_votes_value)`` of the
+    bribe from get_eligibility_totals. Filter 0 and the aggregate query are
+    skipped, and a None total returns the empty set right away.
     """
+    if eligibility is not None:
+        total_votes_pre_dust, min_votes_value = eligibility
+        if total_votes_pre_dust is None:
+            return VoteSnapshot.objects.none(), None
+    elif get_unfinished_markets(snapshot_date, [bribe.market_key_id]):
+        return VoteSnapshot.objects.none(), None
+
     votes = VoteSnapshot.objects.filter(
         market_key=bribe.market_key,
         snapshot_time=snapshot_date,
     )
 
     if bribe.asset.type != Asset.native().type:
-        cache_key = (bribe.asset_code, bribe.asset_issuer, snapshot_date)
-        if asset_holder_cache is not None and cache_key in asset_holder_cache:
-            accounts = asset_holder_cache[cache_key]
-        else:
-            accounts = get_asset_holders(
-                bribe.asset_code, bribe.asset_issuer, snapshot_date,
-            )
-            if asset_holder_cache is not None:
-                asset_holder_cache[cache_key] = accounts
-
-        if not accounts:
-            return VoteSnapshot.objects.none(), None
-
-        votes = votes.extra(
-            where=['voting_account = ANY(%s)'],
-            params=[list(accounts)],
+        votes = votes.filter(
+            voting_account_ref_id__in=_get_bribe_asset_holders(bribe, snapshot_date, asset_holder_cache),
         )
 
     votes = votes.exclude(has_delegation=True)
 
-    total_votes_pre_dust = votes.aggregate(
-        total=models.Sum('votes_value'),
-    )['total']
+    if eligibility is None:
+        total_votes_pre_dust = votes.aggregate(
+            total=models.Sum('votes_value'),
+        )['total']
+        min_votes_value = get_min_votes_value(total_votes_pre_dust, reward_amount)
 
-    if reward_amount is not None and total_votes_pre_dust and total_votes_pre_dust > 0:
-        min_votes_value = Decimal(
-            Decimal('0.0000001') * total_votes_pre_dust / Decimal(reward_amount),
-        ).quantize(Decimal('0.0000001'), rounding=ROUND_UP)
+    if min_votes_value is not None:
         votes = votes.filter(votes_value__gte=min_votes_value)
 
     return votes, total_votes_pre_dust
+
+
+def get_eligibility_totals(bribes, snapshot_date, reward_amounts=None, asset_holder_cache=None):
+    """
+    Batched counterpart of the totals of get_payable_votes: return
+    ``{bribe.pk: (total_votes_pre_dust, min_votes_value)}`` for every bribe,
+    computed in one grouped query instead of one aggregate per bribe. The
+    values are meant for the ``eligibility`` of get_payable_votes.
+
+    The holders query of each asset is inlined once and joined with the
+    votes in the database. Bribes without payable votes, or whose market
+    is not completely loaded, get ``(None, None)``.
+
+    reward_amounts: optional ``{bribe.pk: reward_amount}`` for the dust
+    cutoffs; bribes missing from it get none.
+    """
+    bribes = list(bribes)
+    reward_amounts = reward_amounts or {}
+    totals = {bribe.pk: (None, None) for bribe in bribes}
+    unfinished = get_unfinished_markets(snapshot_date, {bribe.market_key_id for bribe in bribes})
+    bribes = [bribe for bribe in bribes if bribe.market_key_id not in unfinished]
+    if not bribes:
+        return totals
+
+    if asset_holder_cache is None:
+        # Holders are looked up once per asset even without a caller's cache.
+        asset_holder_cache = {}
+
+    holders_indexes = {}
+    holders_sql = []
+    holders_params = []
+    bribe_params = []
+    for bribe in bribes:
+        holders_index = None
+        if bribe.asset.type != Asset.native().type:
+            holders = _get_bribe_asset_holders(bribe, snapshot_date, asset_holder_cache)
+            holders_index = holders_indexes.get(id(holders))
+            if holders_index is None:
+                holders_index = holders_indexes[id(holders)] = len(holders_sql)
+                sql, params = holders.query.sql_with_params()
+                holders_sql.append('SELECT {0}, holders.* FROM ({1}) AS holders'.format(holders_index, sql))
+                holders_params.extend(params)
+        bribe_params.append((bribe.pk, bribe.market_key_id, holders_index))
+
+    sql = ELIGIBILITY_TOTALS_SQL.format(
+        vote_snapshot=VoteSnapshot._meta.db_table,
+        bribes=', '.join(['(%s::integer, %s::varchar, %s::integer)'] * len(bribe_params)),
+        holders=' UNION ALL '.join(holders_sql) or 'SELECT NULL::integer, NULL::bigint WHERE false',
+    )
+    with connection.cursor() as cursor:
+        params = [param for params in bribe_params for param in params] + holders_params
+        cursor.execute(sql, params + [snapshot_date, snapshot_date])
+        rows = cursor.fetchall()
+
+    for bribe_id, total in rows:
+        total_votes = from_stroops(total)
+        totals[bribe_id] = (total_votes, get_min_votes_value(total_votes, reward_amounts.get(bribe_id)))
+    return totals
+
+
+def get_min_votes_value(total_votes, reward_amount):
+    """Dust cutoff of get_payable_votes, None when there is none to apply."""
+    if reward_amount is None or not total_votes or total_votes <= 0:
+        return None
+    return Decimal(
+        Decimal('0.0000001') * total_votes / Decimal(reward_amount),
+    ).quantize(Decimal('0.0000001'), rounding=ROUND_UP)
+
+
+def purge_payable_votes(snapshot_date):
+    """
+    Delete the PayableVoteSet / PayableVote rows of days before
+    snapshot_date. Only the current day's sets are read, and older ones
+    would point at votes that get archived.
+    """
+    PayableVote.objects.filter(payable_set__snapshot_date__lt=snapshot_date).delete()
+    PayableVoteSet.objects.filter(snapshot_date__lt=snapshot_date).delete()
+
+
+def materialize_payable_votes(bribe, snapshot_date, votes, total_votes, reward_amount=None):
+    """
+    Evaluate the payable set returned by get_payable_votes once into
+    PayableVoteSet / PayableVote, replacing the ones stored for the bribe
+    and day, and return a queryset reading the stored ids. Callers that
+    walk the votes many times (count, payout cleanup, every payout page)
+    then no longer re-run the holder and dust filters.
+    """
+    with transaction.atomic():
+        payable_set, _ = PayableVoteSet.objects.update_or_create(
+            bribe=bribe, snapshot_date=snapshot_date,
+            defaults={
+                'reward_amount': reward_amount,
+                'total_votes': total_votes,
+                'min_votes_value': get_min_votes_value(total_votes, reward_amount),
+            },
+        )
+        PayableVote.objects.filter(payable_set=payable_set).delete()
+
+        if not votes.query.is_empty():
+            sql, params = votes.values('id').query.sql_with_params()
+            with connection.cursor() as cursor:
+                cursor.execute(
+                    'INSERT INTO "{0}" ("payable_set_id", "vote_snapshot_id") '
+                    'SELECT %s, payable."id" FROM ({1}) AS payable'.format(PayableVote._meta.db_table, sql),
+                    [payable_set.pk] + list(params),
+                )
+
+    # snapshot_time lets Postgres prune VoteSnapshot to the day's partition.
+    return VoteSnapshot.objects.filter(
+        snapshot_time=snapshot_date,
+        id__in=PayableVote.objects.filter(payable_set=payable_set).values('vote_snapshot_id'),
+    )
@@ -0,0 +1,161 @@
+import gzip
+import json
+import os
+import struct
+from datetime import date
+from decimal import Decimal
+from typing import BinaryIO, Dict, Iterator, List, Tuple
+
+from stellar_sdk import Asset, StrKey
+from stellar_sdk.xdr import BucketEntry, BucketEntryType, LedgerEntryType
+
+from aquarius_bribes.rewards.bulk_load import COPY_BATCH_SIZE, CopyLoader
+from aquarius_bribes.rewards.models import Account, AssetHolderBalanceStaging, get_snapshot_date
+from aquarius_bribes.rewards.trustees_loader import TrusteesLoader
+from aquarius_bribes.utils.assets import get_asset_string
+
+ARCHIVE_STATE_PATH = os.path.join('.well-known', 'stellar-history.json')
+EMPTY_BUCKET_HASH = '0' * 64
+STROOPS_IN_UNIT = Decimal(10 ** 7)
+
+# Offsets into the XDR of a BucketEntry. Live and init entries hold a
+# LedgerEntry (last modified ledger, then the entry type); dead entries a
+# LedgerKey. Account ids are 36 bytes: key type and ed25519 key.
+ENTRY_TYPE = struct.Struct('>i')
+LIVE_DATA_TYPE_AT = 8
+LIVE_ACCOUNT_AT = 12
+LIVE_ASSET_AT = 48
+DEAD_KEY_TYPE_AT = 4
+DEAD_ACCOUNT_AT = 8
+DEAD_ASSET_AT = 44
+ACCOUNT_KEY_SIZE = 32
+# TrustLineAsset XDR sizes of credit_alphanum4 and credit_alphanum12.
+ASSET_SIZES = (44, 52)
+
+LIVE_ENTRY_TYPES = (BucketEntryType.LIVEENTRY.value, BucketEntryType.INITENTRY.value)
+DEAD_ENTRY_TYPE = BucketEntryType.DEADENTRY.value
+TRUSTLINE_TYPE = LedgerEntryType.TRUSTLINE.value
+
+
+def iter_bucket_records(stream: BinaryIO) -> Iterator[bytes]:
+    """XDR of each BucketEntry of a bucket file, framed with RFC 5531 record marks."""
+    while True:
+        mark = stream.read(4)
+        if not mark:
+            return
+        size = struct.unpack('>I', mark)[0] & 0x7FFFFFFF
+        yield stream.read(size)
+
+
+def open_bucket(path: str) -> BinaryIO:
+    if path.endswith('.gz'):
+        return gzip.open(path, 'rb')
+    return open(path, 'rb')
+
+
+class LedgerDumpTrusteesLoader(object):
+    """
+    Alternative to TrusteesLoader that reads the holders of several assets
+    from the ledger state in history archive bucket files on local disk,
+    in one pass and without Horizon.
+
+    Buckets are read newest first, so the first entry of a trustline seen
+    is its current state and older ones are skipped; a dead entry shadows
+    the trustline altogether. Only trustlines of the assets are decoded,
+    everything else is skipped by looking at a few bytes of the record.
+    """
+    def __init__(self, assets: List[Asset], bucket_paths: List[str], snapshot_date: date = None):
+        self.assets = {
+            asset.to_trust_line_asset_xdr_object().to_xdr_bytes(): asset
+            for asset in assets if not asset.is_native()
+        }
+        self.bucket_paths = bucket_paths
+        self.snapshot_date = snapshot_date or get_snapshot_date()
+
+    @classmethod
+    def from_archive(
+        cls, assets: List[Asset], archive_root: str, state_path: str = None, **kwargs,
+    ) -> 'LedgerDumpTrusteesLoader':
+        """
+        Loader for the bucket list of a history archive state, by default
+        the archive's latest one, with buckets at their usual
+        bucket/ab/cd/ef/bucket-<hash>.xdr.gz paths.
+        """
+        with open(state_path or os.path.join(archive_root, ARCHIVE_STATE_PATH)) as state_file:
+            state = json.load(state_file)
+
+        bucket_paths = []
+        for level in state['currentBuckets']:
+            for bucket_hash in (level['curr'], level['snap']):
+                if bucket_hash == EMPTY_BUCKET_HASH:
+                    continue
+                bucket_paths.append(os.path.join(
+                    archive_root, 'bucket', bucket_hash[0:2], bucket_hash[2:4], bucket_hash[4:6],
+                    'bucket-{0}.xdr.gz'.format(bucket_hash),
+                ))
+        return cls(assets, bucket_paths, **kwargs)
+
+    def _match_asset(self, record: bytes, offset: int):
+        for size in ASSET_SIZES:
+            asset = self.assets.get(record[offset:offset + size])
+            if asset is not None:
+                return asset
+        return None
+
+    def iter_trustlines(self) -> Iterator[Tuple[str, Asset, Decimal]]:
+        """(account id, asset, balance) of every current trustline of the assets."""
+        seen = set()
+        for path in self.bucket_paths:
+            with open_bucket(path) as stream:
+                for record in iter_bucket_records(stream):
+                    entry_type = ENTRY_TYPE.unpack_from(record)[0]
+                    if entry_type in LIVE_ENTRY_TYPES:
+                        if ENTRY_TYPE.unpack_from(record, LIVE_DATA_TYPE_AT)[0] != TRUSTLINE_TYPE:
+                            continue
+                        asset = self._match_asset(record, LIVE_ASSET_AT)
+                        key = (record[LIVE_ACCOUNT_AT:LIVE_ASSET_AT], asset)
+                    elif entry_type == DEAD_ENTRY_TYPE:
+                        if ENTRY_TYPE.unpack_from(record, DEAD_KEY_TYPE_AT)[0] != TRUSTLINE_TYPE:
+                            continue
+                        asset = self._match_asset(record, DEAD_ASSET_AT)
+                        key = (record[DEAD_ACCOUNT_AT:DEAD_ASSET_AT], asset)
+                    else:
+                        continue
+
+                    if asset is None or key in seen:
+                        continue
+                    seen.add(key)
+                    if entry_type == DEAD_ENTRY_TYPE:
+                        continue
+
+                    trust_line = BucketEntry.from_xdr_bytes(record).live_entry.data.trust_line
+                    yield (
+                        StrKey.encode_ed25519_public_key(key[0][-ACCOUNT_KEY_SIZE:]),
+                        asset,
+                        Decimal(trust_line.balance.int64) / STROOPS_IN_UNIT,
+                    )
+
+    def make_balances_spanshot(self, batch_size: int = COPY_BATCH_SIZE) -> Dict[str, int]:
+        """
+        Replace the day's holders of the assets with the ones in the
+        buckets, writing them in batches. Returns the holders per asset.
+        """
+        for asset in self.assets.values():
+            TrusteesLoader(asset, snapshot_date=self.snapshot_date).reset()
+
+        holders = {get_asset_string(asset): 0 for asset in self.assets.values()}
+        batch = []
+        for account, asset, balance in self.iter_trustlines():
+            batch.append(AssetHolderBalanceStaging(
+                account=account, asset_code=asset.code, asset_issuer=asset.issuer, balance=balance,
+            ))
+            holders[get_asset_string(asset)] += 1
+            if len(batch) >= batch_size:
+                self._write(batch)
+                batch = []
+        self._write(batch)
+        return holders
+
+    def _write(self, snapshots: List[AssetHolderBalanceStaging]):
+        Account.objects.assign_refs(snapshots)
+        CopyLoader(AssetHolderBalanceStaging).insert(snapshots)
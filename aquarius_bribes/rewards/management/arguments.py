@@ -0,0 +1,18 @@
+from datetime import date
+
+from django.core.management.base import CommandError
+
+
+def parse_month(value: str) -> date:
+    try:
+        year, month = value.split('-')
+        return date(int(year), int(month), 1)
+    except ValueError:
+        raise CommandError('Expected month in YYYY-MM format, got {0}'.format(value))
+
+
+def parse_date(value: str) -> date:
+    try:
+        return date.fromisoformat(value)
+    except ValueError:
+        raise CommandError('Expected date in YYYY-MM-DD format, got {0}'.format(value))
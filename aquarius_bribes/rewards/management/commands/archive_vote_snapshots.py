@@ -0,0 +1,27 @@
+from django.core.management.base import BaseCommand
+from django.utils import timezone
+
+from aquarius_bribes.rewards.management.arguments import parse_month
+from aquarius_bribes.rewards.partitions import add_months, archive_vote_snapshot_partitions, month_start
+
+
+class Command(BaseCommand):
+    help = 'Move vote snapshot months out of the partitioned VoteSnapshot table into VoteSnapshotArchive.'
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--keep-months', type=int, default=3,
+            help='Number of months, including the current one, to keep in VoteSnapshot.',
+        )
+        parser.add_argument(
+            '--before', type=parse_month,
+            help='Archive partitions holding only days before this month (YYYY-MM). Overrides --keep-months.',
+        )
+
+    def handle(self, *args, **options):
+        before = options['before']
+        if before is None:
+            before = add_months(month_start(timezone.now().date()), 1 - options['keep_months'])
+
+        for name, rows in archive_vote_snapshot_partitions(before):
+            self.stdout.write('Archived {0}: {1} rows'.format(name, rows))
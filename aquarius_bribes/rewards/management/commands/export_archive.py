@@ -0,0 +1,44 @@
+from django.core.management.base import BaseCommand, CommandError
+
+from aquarius_bribes.rewards.archive import (
+    ARCHIVE_SOURCES,
+    FORMAT_PARQUET,
+    FORMATS,
+    ArchiveVerificationError,
+    ColumnarArchive,
+)
+from aquarius_bribes.rewards.management.arguments import parse_date
+
+
+class Command(BaseCommand):
+    help = (
+        'Export a closed date range of vote snapshots, holder balance snapshots and payouts to Parquet or '
+        'Arrow IPC files and delete the exported rows.'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--table', action='append', choices=sorted(ARCHIVE_SOURCES),
+            help='Table to export, may be repeated. Defaults to all of them.',
+        )
+        parser.add_argument('--start', type=parse_date, required=True, help='First day of the range (YYYY-MM-DD).')
+        parser.add_argument('--end', type=parse_date, required=True, help='Day after the range (YYYY-MM-DD).')
+        parser.add_argument('--format', choices=FORMATS, default=FORMAT_PARQUET)
+        parser.add_argument('--directory', help='Archive directory. Defaults to REWARDS_ARCHIVE_ROOT.')
+        parser.add_argument('--keep-rows', action='store_true', help='Only export, do not delete exported rows.')
+
+    def handle(self, *args, **options):
+        archive = ColumnarArchive(options['directory'])
+        # Payouts go first so their vote snapshots are never deleted while
+        # the payouts pointing at them are still in the database.
+        tables = [table for table in ARCHIVE_SOURCES if table in (options['table'] or ARCHIVE_SOURCES)]
+
+        for table in tables:
+            try:
+                manifest = archive.export(
+                    table, options['start'], options['end'],
+                    file_format=options['format'], delete=not options['keep_rows'],
+                )
+            except (ValueError, ArchiveVerificationError) as exc:
+                raise CommandError(str(exc))
+            self.stdout.write('Exported {0}: {1} rows to {2}'.format(table, manifest.rows, manifest.path))
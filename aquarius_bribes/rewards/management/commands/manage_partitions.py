@@ -0,0 +1,47 @@
+from django.core.management.base import BaseCommand, CommandError
+
+from aquarius_bribes.rewards.management.arguments import parse_month
+from aquarius_bribes.rewards.partitions import PARTITION_MONTHS_AHEAD, PARTITIONED_TABLES
+
+
+class Command(BaseCommand):
+    help = 'List, create ahead, detach and re-attach monthly partitions of the partitioned rewards tables.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('action', choices=['list', 'ensure', 'detach', 'attach'])
+        parser.add_argument('--table', choices=sorted(PARTITIONED_TABLES), required=True)
+        parser.add_argument(
+            '--months-ahead', type=int, default=PARTITION_MONTHS_AHEAD,
+            help='ensure: months to create after the current.',
+        )
+        parser.add_argument(
+            '--before', type=parse_month,
+            help='detach: detach partitions holding only rows before this month (YYYY-MM).',
+        )
+        parser.add_argument('--name', help='attach: name of the detached partition table.')
+        parser.add_argument('--month', type=parse_month, help='attach: month the partition holds (YYYY-MM).')
+
+    def handle(self, *args, **options):
+        partitioning = PARTITIONED_TABLES[options['table']]
+        action = options['action']
+
+        if action == 'list':
+            for partition in partitioning.get_partitions():
+                if partition.is_default:
+                    bound = 'DEFAULT'
+                else:
+                    bound = 'before {0}'.format(partition.upper_bound)
+                self.stdout.write('{0}\t{1}'.format(partition.name, bound))
+        elif action == 'ensure':
+            for name in partitioning.ensure_partitions(months_ahead=options['months_ahead']):
+                self.stdout.write('Created {0}'.format(name))
+        elif action == 'detach':
+            if not options['before']:
+                raise CommandError('--before is required to detach partitions')
+            for name in partitioning.detach_partitions(options['before']):
+                self.stdout.write('Detached {0}'.format(name))
+        elif action == 'attach':
+            if not options['name'] or not options['month']:
+                raise CommandError('--name and --month are required to attach a partition')
+            partitioning.attach_partition(options['name'], options['month'])
+            self.stdout.write('Attached {0}'.format(options['name']))
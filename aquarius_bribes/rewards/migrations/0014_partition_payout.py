@@ -0,0 +1,103 @@
+from django.db import migrations
+
+PARTITION_PAYOUT_SQL = """
+ALTER TABLE "rewards_payout" RENAME TO "rewards_payout_legacy";
+-- A partition cannot have a primary key of its own; the (id, created_at) key
+-- of the parent is built on it when it is attached below.
+ALTER TABLE "rewards_payout_legacy" DROP CONSTRAINT "rewards_payout_pkey";
+
+CREATE TABLE "rewards_payout" (LIKE "rewards_payout_legacy" INCLUDING DEFAULTS)
+    PARTITION BY RANGE ("created_at");
+ALTER TABLE "rewards_payout" ADD CONSTRAINT "rewards_payout_pkey" PRIMARY KEY ("id", "created_at");
+ALTER SEQUENCE "rewards_payout_id_seq" OWNED BY "rewards_payout"."id";
+
+CREATE INDEX "payout_bribe_id_idx" ON "rewards_payout" ("bribe_id");
+CREATE INDEX "payout_vote_snapshot_id_idx" ON "rewards_payout" ("vote_snapshot_id");
+CREATE INDEX "payout_created_at_idx" ON "rewards_payout" ("created_at");
+CREATE INDEX "payout_status_idx" ON "rewards_payout" ("status");
+CREATE INDEX "payout_status_like_idx" ON "rewards_payout" ("status" varchar_pattern_ops);
+CREATE INDEX "payout_message_idx" ON "rewards_payout" ("message");
+CREATE INDEX "payout_message_like_idx" ON "rewards_payout" ("message" text_pattern_ops);
+
+ALTER TABLE "rewards_payout" ADD CONSTRAINT "payout_bribe_id_fk"
+    FOREIGN KEY ("bribe_id") REFERENCES "bribes_aggregatedbyassetbribe" ("id") DEFERRABLE INITIALLY DEFERRED;
+ALTER TABLE "rewards_payout" ADD CONSTRAINT "payout_vote_snapshot_id_fk"
+    FOREIGN KEY ("vote_snapshot_id") REFERENCES "rewards_votesnapshot" ("id") DEFERRABLE INITIALLY DEFERRED;
+
+DO $$
+DECLARE
+    boundary timestamptz;
+    month timestamptz;
+BEGIN
+    SELECT COALESCE(
+        date_trunc('month', max("created_at"), 'UTC') + interval '1 month',
+        date_trunc('month', now(), 'UTC')
+    ) INTO boundary FROM "rewards_payout_legacy";
+    -- Existing rows stay where they are: the old table becomes the partition
+    -- for everything before the first monthly partition.
+    EXECUTE format(
+        'ALTER TABLE "rewards_payout" ATTACH PARTITION "rewards_payout_legacy" FOR VALUES FROM (MINVALUE) TO (%L)',
+        boundary
+    );
+    month := date_trunc('month', now(), 'UTC');
+    WHILE month < date_trunc('month', now(), 'UTC') + interval '3 month' LOOP
+        IF month >= boundary THEN
+            EXECUTE format(
+                'CREATE TABLE %I PARTITION OF "rewards_payout" FOR VALUES FROM (%L) TO (%L)',
+                'rewards_payout_p' || to_char(month AT TIME ZONE 'UTC', 'YYYY_MM'), month, month + interval '1 month'
+            );
+        END IF;
+        month := month + interval '1 month';
+    END LOOP;
+END $$;
+
+CREATE TABLE "rewards_payout_default" PARTITION OF "rewards_payout" DEFAULT;
+"""
+
+UNPARTITION_PAYOUT_SQL = """
+CREATE TABLE "rewards_payout_plain" (LIKE "rewards_payout" INCLUDING DEFAULTS);
+INSERT INTO "rewards_payout_plain" SELECT * FROM "rewards_payout";
+ALTER SEQUENCE "rewards_payout_id_seq" OWNED BY "rewards_payout_plain"."id";
+DROP TABLE "rewards_payout";
+ALTER TABLE "rewards_payout_plain" RENAME TO "rewards_payout";
+ALTER TABLE "rewards_payout" ADD CONSTRAINT "rewards_payout_pkey" PRIMARY KEY ("id");
+
+CREATE INDEX "rewards_payout_bribe_id_1cbda341" ON "rewards_payout" ("bribe_id");
+CREATE INDEX "rewards_payout_vote_snapshot_id_e4fbd734" ON "rewards_payout" ("vote_snapshot_id");
+CREATE INDEX "rewards_payout_created_at_c849595b" ON "rewards_payout" ("created_at");
+CREATE INDEX "rewards_payout_status_7f45d02c" ON "rewards_payout" ("status");
+CREATE INDEX "rewards_payout_status_7f45d02c_like" ON "rewards_payout" ("status" varchar_pattern_ops);
+CREATE INDEX "rewards_payout_message_53ff5185" ON "rewards_payout" ("message");
+CREATE INDEX "rewards_payout_message_53ff5185_like" ON "rewards_payout" ("message" text_pattern_ops);
+
+ALTER TABLE "rewards_payout" ADD CONSTRAINT "rewards_payout_bribe_id_1cbda341_fk_bribes_ag"
+    FOREIGN KEY ("bribe_id") REFERENCES "bribes_aggregatedbyassetbribe" ("id") DEFERRABLE INITIALLY DEFERRED;
+ALTER TABLE "rewards_payout" ADD CONSTRAINT "rewards_payout_vote_snapshot_id_e4fbd734_fk_rewards_v"
+    FOREIGN KEY ("vote_snapshot_id") REFERENCES "rewards_votesnapshot" ("id") DEFERRABLE INITIALLY DEFERRED;
+"""
+
+
+class Migration(migrations.Migration):
+    """
+    Convert rewards_payout into a table range-partitioned by created_at month.
+
+    The existing table is attached as a single partition covering everything
+    up to the end of the month of its newest row, so no historical data is
+    copied (an empty table only covers the months before the current one).
+    Monthly partitions up to two months ahead are created here;
+    task_ensure_partitions keeps creating them ahead from then on and the
+    manage_partitions command detaches old ones.
+
+    The primary key becomes (id, created_at) because Postgres requires unique
+    constraints on a partitioned table to include the partition key. Django
+    keeps treating id as the primary key; ids still come from the same
+    sequence.
+    """
+
+    dependencies = [
+        ('rewards', '0013_ahbs_asset_date_idx'),
+    ]
+
+    operations = [
+        migrations.RunSQL(sql=PARTITION_PAYOUT_SQL, reverse_sql=UNPARTITION_PAYOUT_SQL),
+    ]
@@ -0,0 +1,42 @@
+# Generated by Django 3.2.23 on 2026-10-19 12:47
+
+import django.contrib.postgres.indexes
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('bribes', '0009_auto_20250811_1004'),
+        ('rewards', '0014_partition_payout'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='payout',
+            name='vote_snapshot',
+            field=models.ForeignKey(db_constraint=False, on_delete=django.db.models.deletion.PROTECT, to='rewards.votesnapshot'),
+        ),
+        migrations.CreateModel(
+            name='VoteSnapshotArchive',
+            fields=[
+                ('id', models.BigIntegerField(primary_key=True, serialize=False)),
+                ('votes_value', models.DecimalField(decimal_places=7, max_digits=20)),
+                ('voting_account', models.CharField(max_length=56)),
+                ('is_delegated', models.BooleanField(default=False)),
+                ('has_delegation', models.BooleanField(default=False)),
+                ('delegate_owner', models.CharField(blank=True, default=None, max_length=56, null=True)),
+                ('snapshot_time', models.DateField()),
+                ('market_key', models.ForeignKey(db_constraint=False, db_index=False, null=True, on_delete=django.db.models.deletion.PROTECT, to='bribes.marketkey')),
+            ],
+        ),
+        migrations.AddIndex(
+            model_name='votesnapshotarchive',
+            index=django.contrib.postgres.indexes.BrinIndex(fields=['snapshot_time'], name='vsa_snapshot_time_brin'),
+        ),
+        migrations.AddIndex(
+            model_name='votesnapshotarchive',
+            index=models.Index(fields=['market_key', 'snapshot_time'], name='vsa_market_date_idx'),
+        ),
+    ]
@@ -0,0 +1,106 @@
+from django.db import migrations
+
+PARTITION_VOTESNAPSHOT_SQL = """
+ALTER TABLE "rewards_votesnapshot" RENAME TO "rewards_votesnapshot_legacy";
+-- A partition cannot have a primary key of its own; the (id, snapshot_time)
+-- key of the parent is built on it when it is attached below.
+ALTER TABLE "rewards_votesnapshot_legacy" DROP CONSTRAINT "rewards_votesnapshot_pkey";
+
+CREATE TABLE "rewards_votesnapshot" (LIKE "rewards_votesnapshot_legacy" INCLUDING DEFAULTS)
+    PARTITION BY RANGE ("snapshot_time");
+ALTER TABLE "rewards_votesnapshot" ADD CONSTRAINT "rewards_votesnapshot_pkey" PRIMARY KEY ("id", "snapshot_time");
+ALTER SEQUENCE "rewards_votesnapshot_id_seq" OWNED BY "rewards_votesnapshot"."id";
+
+ALTER TABLE "rewards_votesnapshot" ADD CONSTRAINT "votesnapshot_unique_key" UNIQUE (
+    "snapshot_time", "market_key_id", "voting_account", "is_delegated", "has_delegation", "delegate_owner"
+);
+CREATE INDEX "votesnapshot_snapshot_time_idx" ON "rewards_votesnapshot" ("snapshot_time");
+CREATE INDEX "votesnapshot_market_key_id_idx" ON "rewards_votesnapshot" ("market_key_id");
+CREATE INDEX "votesnapshot_market_key_id_like_idx" ON "rewards_votesnapshot" ("market_key_id" varchar_pattern_ops);
+CREATE INDEX "votesnapshot_voting_account_idx" ON "rewards_votesnapshot" ("voting_account");
+CREATE INDEX "votesnapshot_voting_account_like_idx" ON "rewards_votesnapshot" ("voting_account" varchar_pattern_ops);
+CREATE INDEX "votesnapshot_delegate_owner_idx" ON "rewards_votesnapshot" ("delegate_owner");
+CREATE INDEX "votesnapshot_delegate_owner_like_idx" ON "rewards_votesnapshot" ("delegate_owner" varchar_pattern_ops);
+
+ALTER TABLE "rewards_votesnapshot" ADD CONSTRAINT "votesnapshot_market_key_id_fk"
+    FOREIGN KEY ("market_key_id") REFERENCES "bribes_marketkey" ("market_key") DEFERRABLE INITIALLY DEFERRED;
+
+DO $$
+DECLARE
+    boundary date;
+    month date;
+BEGIN
+    SELECT COALESCE(
+        date_trunc('month', max("snapshot_time")) + interval '1 month',
+        date_trunc('month', now() AT TIME ZONE 'UTC')
+    )::date INTO boundary FROM "rewards_votesnapshot_legacy";
+    -- Existing rows stay where they are: the old table becomes the partition
+    -- for everything before the first monthly partition.
+    EXECUTE format(
+        'ALTER TABLE "rewards_votesnapshot" ATTACH PARTITION "rewards_votesnapshot_legacy" '
+        'FOR VALUES FROM (MINVALUE) TO (%L)',
+        boundary
+    );
+    month := date_trunc('month', now() AT TIME ZONE 'UTC')::date;
+    WHILE month < date_trunc('month', now() AT TIME ZONE 'UTC') + interval '3 month' LOOP
+        IF month >= boundary THEN
+            EXECUTE format(
+                'CREATE TABLE %I PARTITION OF "rewards_votesnapshot" FOR VALUES FROM (%L) TO (%L)',
+                'rewards_votesnapshot_p' || to_char(month, 'YYYY_MM'), month, (month + interval '1 month')::date
+            );
+        END IF;
+        month := (month + interval '1 month')::date;
+    END LOOP;
+END $$;
+
+CREATE TABLE "rewards_votesnapshot_default" PARTITION OF "rewards_votesnapshot" DEFAULT;
+"""
+
+UNPARTITION_VOTESNAPSHOT_SQL = """
+CREATE TABLE "rewards_votesnapshot_plain" (LIKE "rewards_votesnapshot" INCLUDING DEFAULTS);
+INSERT INTO "rewards_votesnapshot_plain" SELECT * FROM "rewards_votesnapshot";
+ALTER SEQUENCE "rewards_votesnapshot_id_seq" OWNED BY "rewards_votesnapshot_plain"."id";
+DROP TABLE "rewards_votesnapshot";
+ALTER TABLE "rewards_votesnapshot_plain" RENAME TO "rewards_votesnapshot";
+ALTER TABLE "rewards_votesnapshot" ADD CONSTRAINT "rewards_votesnapshot_pkey" PRIMARY KEY ("id");
+
+ALTER TABLE "rewards_votesnapshot" ADD CONSTRAINT "rewards_votesnapshot_snapshot_time_market_key_a444ae94_uniq" UNIQUE (
+    "snapshot_time", "market_key_id", "voting_account", "is_delegated", "has_delegation", "delegate_owner"
+);
+CREATE INDEX "rewards_votesnapshot_snapshot_time_ac2dae5b" ON "rewards_votesnapshot" ("snapshot_time");
+CREATE INDEX "rewards_votesnapshot_market_key_id_e34c0444" ON "rewards_votesnapshot" ("market_key_id");
+CREATE INDEX "rewards_votesnapshot_market_key_id_e34c0444_like"
+    ON "rewards_votesnapshot" ("market_key_id" varchar_pattern_ops);
+CREATE INDEX "rewards_votesnapshot_voting_account_b32d5ac5" ON "rewards_votesnapshot" ("voting_account");
+CREATE INDEX "rewards_votesnapshot_voting_account_b32d5ac5_like"
+    ON "rewards_votesnapshot" ("voting_account" varchar_pattern_ops);
+CREATE INDEX "rewards_votesnapshot_delegate_owner_fb65f904" ON "rewards_votesnapshot" ("delegate_owner");
+CREATE INDEX "rewards_votesnapshot_delegate_owner_fb65f904_like"
+    ON "rewards_votesnapshot" ("delegate_owner" varchar_pattern_ops);
+
+ALTER TABLE "rewards_votesnapshot" ADD CONSTRAINT "rewards_votesnapshot_market_key_id_e34c0444_fk_bribes_ma"
+    FOREIGN KEY ("market_key_id") REFERENCES "bribes_marketkey" ("market_key") DEFERRABLE INITIALLY DEFERRED;
+"""
+
+
+class Migration(migrations.Migration):
+    """
+    Convert rewards_votesnapshot into a table range-partitioned by
+    snapshot_time month, the same way 0014 did for rewards_payout.
+
+    Every read filters on snapshot_time, so queries prune to one partition,
+    and the unique key is maintained per partition instead of as one index
+    over the whole history. Old months are rolled into VoteSnapshotArchive by
+    the archive_vote_snapshots command.
+
+    The primary key becomes (id, snapshot_time); Payout keeps pointing at
+    VoteSnapshot.id without a database constraint (see 0015).
+    """
+
+    dependencies = [
+        ('rewards', '0015_votesnapshotarchive'),
+    ]
+
+    operations = [
+        migrations.RunSQL(sql=PARTITION_VOTESNAPSHOT_SQL, reverse_sql=UNPARTITION_VOTESNAPSHOT_SQL),
+    ]
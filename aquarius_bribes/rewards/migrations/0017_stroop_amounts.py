@@ -0,0 +1,71 @@
+import aquarius_bribes.utils.fields
+from django.db import migrations
+
+AMOUNT_COLUMNS = [
+    ('rewards_votesnapshot', 'votes_value'),
+    ('rewards_votesnapshotarchive', 'votes_value'),
+    ('rewards_payout', 'reward_amount'),
+    ('rewards_assetholderbalancesnapshot', 'balance'),
+]
+
+TO_STROOPS_SQL = [
+    'ALTER TABLE "{0}" ALTER COLUMN "{1}" TYPE bigint USING round("{1}" * 10000000)::bigint;'.format(table, column)
+    for table, column in AMOUNT_COLUMNS
+]
+
+FROM_STROOPS_SQL = [
+    'ALTER TABLE "{0}" ALTER COLUMN "{1}" TYPE numeric(20, 7) USING "{1}" / 10000000.0;'.format(table, column)
+    for table, column in AMOUNT_COLUMNS
+]
+
+
+class Migration(migrations.Migration):
+    """
+    Store vote, balance and payout amounts as bigint stroops (amount * 10^7).
+
+    The generated AlterField would cast numeric to bigint and drop the
+    fraction, so the columns are converted by hand; the state operations only
+    swap the field class. On the partitioned tables the ALTER recurses into
+    every partition. Stellar amounts are int64 stroops on the ledger, so every
+    stored value fits.
+
+    The conversion is not optional: every deployment runs it, and the models
+    only read and write stroops afterwards. Amounts keep 7 decimal places.
+    The old numeric(20, 7) columns already held no more than that, and new
+    values are rounded half up to a whole stroop by to_stroops, the same way
+    the numeric columns rounded them before.
+    """
+
+    dependencies = [
+        ('rewards', '0016_partition_votesnapshot'),
+    ]
+
+    operations = [
+        migrations.SeparateDatabaseAndState(
+            database_operations=[
+                migrations.RunSQL(sql=TO_STROOPS_SQL, reverse_sql=FROM_STROOPS_SQL),
+            ],
+            state_operations=[
+                migrations.AlterField(
+                    model_name='assetholderbalancesnapshot',
+                    name='balance',
+                    field=aquarius_bribes.utils.fields.StroopField(),
+                ),
+                migrations.AlterField(
+                    model_name='payout',
+                    name='reward_amount',
+                    field=aquarius_bribes.utils.fields.StroopField(null=True),
+                ),
+                migrations.AlterField(
+                    model_name='votesnapshot',
+                    name='votes_value',
+                    field=aquarius_bribes.utils.fields.StroopField(),
+                ),
+                migrations.AlterField(
+                    model_name='votesnapshotarchive',
+                    name='votes_value',
+                    field=aquarius_bribes.utils.fields.StroopField(),
+                ),
+            ],
+        ),
+    ]
@@ -0,0 +1,66 @@
+# Generated by Django 3.2.23 on 2026-10-19 12:55
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+ACCOUNT_REFS = [
+    ('rewards_votesnapshot', 'voting_account', 'voting_account_ref_id'),
+    ('rewards_assetholderbalancesnapshot', 'account', 'account_ref_id'),
+    ('rewards_claimablebalance', 'owner', 'owner_ref_id'),
+    ('rewards_claimant', 'destination', 'destination_ref_id'),
+]
+
+BACKFILL_ACCOUNTS_SQL = [
+    'INSERT INTO "rewards_account" ("address") '
+    'SELECT DISTINCT "{1}" FROM "{0}" WHERE "{1}" IS NOT NULL ON CONFLICT DO NOTHING;'.format(table, column)
+    for table, column, _ in ACCOUNT_REFS
+] + [
+    'UPDATE "{0}" SET "{2}" = "rewards_account"."id" FROM "rewards_account" '
+    'WHERE "rewards_account"."address" = "{0}"."{1}";'.format(table, column, ref)
+    for table, column, ref in ACCOUNT_REFS
+]
+
+
+class Migration(migrations.Migration):
+    """
+    Account dictionary for the addresses repeated in every snapshot row, and
+    a reference to it from VoteSnapshot, AssetHolderBalanceSnapshot,
+    ClaimableBalance and Claimant. Existing rows are backfilled here; new
+    rows get their reference on save() or from Account.objects.assign_refs()
+    in the bulk loaders.
+    """
+
+    dependencies = [
+        ('rewards', '0017_stroop_amounts'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='Account',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('address', models.CharField(max_length=56, unique=True)),
+            ],
+        ),
+        migrations.AddField(
+            model_name='assetholderbalancesnapshot',
+            name='account_ref',
+            field=models.ForeignKey(editable=False, null=True, on_delete=django.db.models.deletion.PROTECT, related_name='+', to='rewards.account'),
+        ),
+        migrations.AddField(
+            model_name='claimablebalance',
+            name='owner_ref',
+            field=models.ForeignKey(editable=False, null=True, on_delete=django.db.models.deletion.PROTECT, related_name='+', to='rewards.account'),
+        ),
+        migrations.AddField(
+            model_name='claimant',
+            name='destination_ref',
+            field=models.ForeignKey(editable=False, null=True, on_delete=django.db.models.deletion.PROTECT, related_name='+', to='rewards.account'),
+        ),
+        migrations.AddField(
+            model_name='votesnapshot',
+            name='voting_account_ref',
+            field=models.ForeignKey(editable=False, null=True, on_delete=django.db.models.deletion.PROTECT, related_name='+', to='rewards.account'),
+        ),
+        migrations.RunSQL(sql=BACKFILL_ACCOUNTS_SQL, reverse_sql=migrations.RunSQL.noop),
+    ]
@@ -0,0 +1,39 @@
+# Generated by Django 3.2.23 on 2026-10-19 13:07
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+    """
+    Per market and day checkpoints of task_load_votes. Days loaded before
+    this migration have no progress rows and are recognised by their
+    VoteSnapshot rows as before.
+    """
+
+    dependencies = [
+        ('bribes', '0009_auto_20250811_1004'),
+        ('rewards', '0018_account'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='VoteSnapshotProgress',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('snapshot_time', models.DateField()),
+                ('tracker_timestamp', models.DateTimeField()),
+                ('status', models.CharField(choices=[('running', 'running'), ('failed', 'failed'), ('done', 'done')], default='running', max_length=30)),
+                ('next_page', models.PositiveIntegerField(default=1)),
+                ('run_start_id', models.BigIntegerField(default=0)),
+                ('message', models.TextField(blank=True)),
+                ('started_at', models.DateTimeField(auto_now_add=True)),
+                ('updated_at', models.DateTimeField(auto_now=True)),
+                ('finished_at', models.DateTimeField(blank=True, null=True)),
+                ('market_key', models.ForeignKey(on_delete=django.db.models.deletion.PROTECT, to='bribes.marketkey')),
+            ],
+            options={
+                'unique_together': {('snapshot_time', 'market_key')},
+            },
+        ),
+    ]
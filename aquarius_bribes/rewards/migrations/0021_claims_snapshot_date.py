@@ -0,0 +1,50 @@
+# Generated by Django 3.2.23 on 2026-10-19 13:11
+
+import aquarius_bribes.rewards.models
+from django.db import migrations, models
+from stellar_sdk import ClaimPredicate
+
+UNCONDITIONAL = ClaimPredicate.predicate_unconditional().to_xdr_object().to_xdr()
+NOT_UNCONDITIONAL = ClaimPredicate.predicate_not(ClaimPredicate.predicate_unconditional()).to_xdr_object().to_xdr()
+
+BACKFILL_SQL = [
+    'UPDATE "rewards_claimablebalance" SET "snapshot_date" = ("loaded_at" AT TIME ZONE \'UTC\')::date;',
+    'UPDATE "rewards_claimant" SET "snapshot_date" = "rewards_claimablebalance"."snapshot_date", '
+    '"predicate_kind" = CASE "rewards_claimant"."raw_predicate" WHEN %s THEN 0 WHEN %s THEN 1 ELSE 2 END '
+    'FROM "rewards_claimablebalance" '
+    'WHERE "rewards_claimablebalance"."id" = "rewards_claimant"."claimable_balance_id";',
+]
+
+
+class Migration(migrations.Migration):
+    """
+    Snapshot day of claimable balances and claimants, and claimant
+    predicates reduced to an enum, backfilled from loaded_at and
+    raw_predicate. The indexes on them are built by the next migration.
+    """
+
+    dependencies = [
+        ('rewards', '0020_votesnapshotprogress'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='claimablebalance',
+            name='snapshot_date',
+            field=models.DateField(default=aquarius_bribes.rewards.models.get_snapshot_date),
+        ),
+        migrations.AddField(
+            model_name='claimant',
+            name='predicate_kind',
+            field=models.PositiveSmallIntegerField(choices=[(0, 'unconditional'), (1, 'not unconditional'), (2, 'other')], default=2),
+        ),
+        migrations.AddField(
+            model_name='claimant',
+            name='snapshot_date',
+            field=models.DateField(default=aquarius_bribes.rewards.models.get_snapshot_date),
+        ),
+        migrations.RunSQL(
+            [BACKFILL_SQL[0], (BACKFILL_SQL[1], [UNCONDITIONAL, NOT_UNCONDITIONAL])],
+            reverse_sql=migrations.RunSQL.noop,
+        ),
+    ]
@@ -0,0 +1,29 @@
+from django.contrib.postgres.operations import AddIndexConcurrently
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+    """
+    Composite indexes for the delegation lookups of one snapshot day, built
+    without locking the claims tables against the running snapshot.
+    """
+    atomic = False
+
+    dependencies = [
+        ('rewards', '0021_claims_snapshot_date'),
+    ]
+
+    operations = [
+        AddIndexConcurrently(
+            model_name='claimablebalance',
+            index=models.Index(
+                fields=['snapshot_date', 'asset_code', 'asset_issuer', 'owner'], name='cb_snapshot_asset_owner_idx',
+            ),
+        ),
+        AddIndexConcurrently(
+            model_name='claimant',
+            index=models.Index(
+                fields=['snapshot_date', 'destination', 'predicate_kind'], name='claimant_snapshot_dest_idx',
+            ),
+        ),
+    ]
@@ -0,0 +1,52 @@
+# Generated by Django 3.2.23 on 2026-10-19 13:19
+
+import aquarius_bribes.rewards.models
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+    """
+    Live copy of the delegatable assets' claimable balances, filled by the
+    first LiveClaimsSync run.
+    """
+
+    dependencies = [
+        ('rewards', '0022_claims_snapshot_indexes'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='LiveClaimableBalance',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('claimable_balance_id', models.CharField(max_length=96, unique=True)),
+                ('asset_code', models.CharField(max_length=12)),
+                ('asset_issuer', models.CharField(max_length=56)),
+                ('amount', models.DecimalField(decimal_places=7, default=0, max_digits=20)),
+                ('sponsor', models.CharField(max_length=56)),
+                ('owner', models.CharField(max_length=56)),
+                ('last_modified_time', models.DateTimeField(null=True)),
+                ('last_modified_ledger', models.PositiveIntegerField()),
+                ('updated_at', models.DateTimeField(auto_now=True)),
+                ('owner_ref', models.ForeignKey(editable=False, null=True, on_delete=django.db.models.deletion.PROTECT, related_name='+', to='rewards.account')),
+            ],
+            bases=(aquarius_bribes.rewards.models.AccountRefMixin, models.Model),
+        ),
+        migrations.CreateModel(
+            name='LiveClaimant',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('destination', models.CharField(max_length=56)),
+                ('raw_predicate', models.TextField()),
+                ('predicate_kind', models.PositiveSmallIntegerField(choices=[(0, 'unconditional'), (1, 'not unconditional'), (2, 'other')], default=2)),
+                ('claimable_balance', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='claimants', to='rewards.liveclaimablebalance')),
+                ('destination_ref', models.ForeignKey(editable=False, null=True, on_delete=django.db.models.deletion.PROTECT, related_name='+', to='rewards.account')),
+            ],
+            bases=(aquarius_bribes.rewards.models.AccountRefMixin, models.Model),
+        ),
+        migrations.AddIndex(
+            model_name='liveclaimablebalance',
+            index=models.Index(fields=['asset_code', 'asset_issuer'], name='live_cb_asset_idx'),
+        ),
+    ]
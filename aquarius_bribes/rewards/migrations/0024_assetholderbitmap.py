@@ -0,0 +1,32 @@
+# Generated by Django 3.2.23 on 2026-10-19 13:31
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+    """
+    Holders of each bribe asset per day as compressed bitmaps over Account
+    ids, stored by the trustee snapshot.
+    """
+
+    dependencies = [
+        ('rewards', '0023_liveclaimablebalance'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='AssetHolderBitmap',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('asset_code', models.CharField(max_length=12)),
+                ('asset_issuer', models.CharField(max_length=56)),
+                ('snapshot_date', models.DateField()),
+                ('bitmap', models.BinaryField()),
+                ('holders', models.PositiveIntegerField()),
+                ('created_at', models.DateTimeField(auto_now_add=True)),
+            ],
+            options={
+                'unique_together': {('asset_code', 'asset_issuer', 'snapshot_date')},
+            },
+        ),
+    ]
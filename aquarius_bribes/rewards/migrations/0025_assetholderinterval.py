@@ -0,0 +1,40 @@
+# Generated by Django 3.2.23 on 2026-10-19 13:36
+
+import django.contrib.postgres.fields.ranges
+import django.contrib.postgres.indexes
+from django.db import migrations, models
+import django.db.models.deletion
+import django.db.models.expressions
+
+
+class Migration(migrations.Migration):
+    """
+    Trustline holders as validity ranges. Nothing is backfilled: the first
+    sync of each asset opens intervals for all of its current holders.
+    """
+
+    dependencies = [
+        ('rewards', '0024_assetholderbitmap'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='AssetHolderInterval',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('asset_code', models.CharField(max_length=12)),
+                ('asset_issuer', models.CharField(max_length=56)),
+                ('valid_from', models.DateField()),
+                ('valid_to', models.DateField(blank=True, null=True)),
+                ('account', models.ForeignKey(on_delete=django.db.models.deletion.PROTECT, related_name='+', to='rewards.account')),
+            ],
+        ),
+        migrations.AddIndex(
+            model_name='assetholderinterval',
+            index=django.contrib.postgres.indexes.GistIndex(django.db.models.expressions.Func(django.db.models.expressions.F('valid_from'), django.db.models.expressions.F('valid_to'), function='daterange', output_field=django.contrib.postgres.fields.ranges.DateRangeField()), name='holder_interval_validity_gist'),
+        ),
+        migrations.AddIndex(
+            model_name='assetholderinterval',
+            index=models.Index(fields=['asset_code', 'asset_issuer', 'valid_to'], name='holder_interval_open_idx'),
+        ),
+    ]
@@ -0,0 +1,56 @@
+# Generated by Django 3.2.23 on 2026-10-19 13:39
+
+import aquarius_bribes.utils.fields
+from django.db import migrations, models
+import django.db.models.deletion
+
+# PayableVote references PayableVoteSet, so it has to be unlogged first and
+# logged last: a logged table cannot reference an unlogged one.
+SET_UNLOGGED_SQL = """
+ALTER TABLE "rewards_payablevote" SET UNLOGGED;
+ALTER TABLE "rewards_payablevoteset" SET UNLOGGED;
+"""
+SET_LOGGED_SQL = """
+ALTER TABLE "rewards_payablevoteset" SET LOGGED;
+ALTER TABLE "rewards_payablevote" SET LOGGED;
+"""
+
+
+class Migration(migrations.Migration):
+    """
+    Materialized payable votes. Both tables are unlogged: they only hold
+    what the current payout run derived, so skipping the WAL is worth
+    losing them on a crash.
+    """
+
+    dependencies = [
+        ('bribes', '0009_auto_20250811_1004'),
+        ('rewards', '0025_assetholderinterval'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='PayableVoteSet',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('snapshot_date', models.DateField()),
+                ('reward_amount', aquarius_bribes.utils.fields.StroopField(null=True)),
+                ('total_votes', aquarius_bribes.utils.fields.StroopField(null=True)),
+                ('min_votes_value', aquarius_bribes.utils.fields.StroopField(null=True)),
+                ('created_at', models.DateTimeField(auto_now=True)),
+                ('bribe', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to='bribes.aggregatedbyassetbribe')),
+            ],
+            options={
+                'unique_together': {('bribe', 'snapshot_date')},
+            },
+        ),
+        migrations.CreateModel(
+            name='PayableVote',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('payable_set', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='votes', to='rewards.payablevoteset')),
+                ('vote_snapshot', models.ForeignKey(db_constraint=False, on_delete=django.db.models.deletion.DO_NOTHING, related_name='+', to='rewards.votesnapshot')),
+            ],
+        ),
+        migrations.RunSQL(sql=SET_UNLOGGED_SQL, reverse_sql=SET_LOGGED_SQL),
+    ]
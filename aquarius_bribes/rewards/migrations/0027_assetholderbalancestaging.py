@@ -0,0 +1,42 @@
+# Generated by Django 3.2.23 on 2026-10-19 14:17
+
+import aquarius_bribes.rewards.models
+import aquarius_bribes.utils.fields
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+    """
+    Unlogged staging table for the trustee snapshots, created empty so the
+    ALTER is instant. AssetHolderBalanceSnapshot stays logged with the
+    holders of the days before the intervals, which nothing else keeps.
+    """
+
+    dependencies = [
+        ('rewards', '0026_payablevoteset'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='AssetHolderBalanceStaging',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('account', models.CharField(max_length=255)),
+                ('asset_code', models.CharField(max_length=12)),
+                ('asset_issuer', models.CharField(max_length=56)),
+                ('balance', aquarius_bribes.utils.fields.StroopField()),
+                ('created_at', models.DateTimeField(auto_now_add=True)),
+                ('account_ref', models.ForeignKey(editable=False, null=True, on_delete=django.db.models.deletion.PROTECT, related_name='+', to='rewards.account')),
+            ],
+            bases=(aquarius_bribes.rewards.models.AccountRefMixin, models.Model),
+        ),
+        migrations.AddIndex(
+            model_name='assetholderbalancestaging',
+            index=models.Index(fields=['asset_code', 'asset_issuer', 'created_at', 'account'], name='ahb_staging_asset_date_idx'),
+        ),
+        migrations.RunSQL(
+            'ALTER TABLE "rewards_assetholderbalancestaging" SET UNLOGGED;',
+            reverse_sql='ALTER TABLE "rewards_assetholderbalancestaging" SET LOGGED;',
+        ),
+    ]
@@ -1,11 +1,78 @@
+from datetime import datetime, time, timedelta
+
 from django.conf import settings
-from django.db import models
+from django.contrib.postgres.fields import DateRangeField
+from django.contrib.postgres.indexes import BrinIndex, GistIndex
+from django.db import connection, models, transaction
+from django.utils import timezone
 
 from stellar_sdk import Asset
 from stellar_sdk import Claimant as SDKClaimant
 from stellar_sdk import ClaimPredicate
 from stellar_sdk.xdr import ClaimPredicate as XDRClaimPredicate
 
+from aquarius_bribes.rewards.utils import _get_not_unconditinal_predicate, _get_unconditional_predicate
+from aquarius_bribes.utils.fields import StroopField
+
+
+def get_snapshot_date():
+    return timezone.now().date()
+
+
+class AccountManager(models.Manager):
+    INTERN_BATCH_SIZE = 5000
+
+    def intern(self, addresses) -> dict:
+        """Map Stellar addresses to Account ids, creating the missing accounts."""
+        addresses = list({address for address in addresses if address})
+        ids = {}
+        for index in range(0, len(addresses), self.INTERN_BATCH_SIZE):
+            batch = addresses[index:index + self.INTERN_BATCH_SIZE]
+            known = dict(self.filter(address__in=batch).values_list('address', 'id'))
+            missing = [address for address in batch if address not in known]
+            if missing:
+                self.bulk_create([self.model(address=address) for address in missing], ignore_conflicts=True)
+                known.update(self.filter(address__in=missing).values_list('address', 'id'))
+            ids.update(known)
+        return ids
+
+    def assign_refs(self, instances):
+        """Fill the account references of unsaved rows before bulk_create, which skips save()."""
+        if not instances:
+            return
+        ref_fields = instances[0].ACCOUNT_REF_FIELDS
+        ids = self.intern(
+            getattr(instance, address_field) for instance in instances for address_field, _ in ref_fields
+        )
+        for instance in instances:
+            for address_field, ref_field in ref_fields:
+                setattr(instance, '{0}_id'.format(ref_field), ids.get(getattr(instance, address_field)))
+
+
+class Account(models.Model):
+    """
+    Dictionary of Stellar addresses. High-volume tables keep an integer
+    reference next to the 56 character address, so joins and set operations
+    on accounts run on integers.
+    """
+    address = models.CharField(max_length=56, unique=True)
+
+    objects = AccountManager()
+
+    def __str__(self):
+        return '{0}..{1}'.format(self.address[:4], self.address[-4:])
+
+
+class AccountRefMixin(object):
+    # (address field, Account foreign key) pairs kept in sync on save.
+    ACCOUNT_REF_FIELDS = ()
+
+    def save(self, *args, **kwargs):
+        ids = Account.objects.intern(getattr(self, address_field) for address_field, _ in self.ACCOUNT_REF_FIELDS)
+        for address_field, ref_field in self.ACCOUNT_REF_FIELDS:
+            setattr(self, '{0}_id'.format(ref_field), ids.get(getattr(self, address_field)))
+        super().save(*args, **kwargs)
+
 
 class OldClaimableBalance(models.Model):
     claimable_balance_id = models.CharField(max_length=96, primary_key=True)
@@ -62,7 +129,9 @@ class OldClaimant(models.Model):
         return ClaimPredicate.from_xdr_object(XDRClaimPredicate.from_xdr(self.raw_predicate))
 
 
-class ClaimableBalance(models.Model):
+class ClaimableBalance(AccountRefMixin, models.Model):
+    ACCOUNT_REF_FIELDS = (('owner', 'owner_ref'), )
+
     claimable_balance_id = models.CharField(max_length=96)
 
     asset_code = models.CharField(max_length=12)
@@ -72,6 +141,9 @@ class ClaimableBalance(models.Model):
     sponsor = models.CharField(max_length=56, db_index=True)
 
     owner = models.CharField(max_length=56, db_index=True)
+    owner_ref = models.ForeignKey(
+        Account, null=True, editable=False, on_delete=models.PROTECT, related_name='+',
+    )
 
     paging_token = models.CharField(max_length=32, blank=True)
     last_modified_time = models.DateTimeField(null=True)
@@ -79,6 +151,16 @@ class ClaimableBalance(models.Model):
 
     loaded_at = models.DateTimeField(auto_now_add=True, db_index=True)
     updated_at = models.DateTimeField(auto_now=True)
+    # UTC day of the claims snapshot the row belongs to.
+    snapshot_date = models.DateField(default=get_snapshot_date)
+
+    class Meta:
+        indexes = [
+            models.Index(
+                fields=['snapshot_date', 'asset_code', 'asset_issuer', 'owner'],
+                name='cb_snapshot_asset_owner_idx',
+            ),
+        ]
 
     def __str__(self):
         return "ClaimableBalance: {}...{}".format(self.claimable_balance_id[:6], self.claimable_balance_id[-6:])
@@ -100,12 +182,53 @@ class ClaimableBalance(models.Model):
         return result
 
 
-class Claimant(models.Model):
+class Claimant(AccountRefMixin, models.Model):
+    ACCOUNT_REF_FIELDS = (('destination', 'destination_ref'), )
+
+    PREDICATE_UNCONDITIONAL = 0
+    PREDICATE_NOT_UNCONDITIONAL = 1
+    PREDICATE_OTHER = 2
+    PREDICATE_KIND_CHOICES = (
+        (PREDICATE_UNCONDITIONAL, 'unconditional'),
+        (PREDICATE_NOT_UNCONDITIONAL, 'not unconditional'),
+        (PREDICATE_OTHER, 'other'),
+    )
+
     destination = models.CharField(max_length=56, db_index=True)
+    destination_ref = models.ForeignKey(
+        Account, null=True, editable=False, on_delete=models.PROTECT, related_name='+',
+    )
 
     raw_predicate = models.TextField()
+    # raw_predicate reduced to the cases delegation lookups tell apart.
+    predicate_kind = models.PositiveSmallIntegerField(choices=PREDICATE_KIND_CHOICES, default=PREDICATE_OTHER)
 
     claimable_balance = models.ForeignKey('ClaimableBalance', on_delete=models.CASCADE, related_name='claimants')
+    # Copy of the balance's snapshot_date, so claimants of a day are found
+    # without joining their balances.
+    snapshot_date = models.DateField(default=get_snapshot_date)
+
+    class Meta:
+        indexes = [
+            models.Index(
+                fields=['snapshot_date', 'destination', 'predicate_kind'],
+                name='claimant_snapshot_dest_idx',
+            ),
+        ]
+
+    def save(self, *args, **kwargs):
+        self.predicate_kind = self.get_predicate_kind(self.raw_predicate)
+        if Claimant.claimable_balance.is_cached(self):
+            self.snapshot_date = self.claimable_balance.snapshot_date
+        super().save(*args, **kwargs)
+
+    @classmethod
+    def get_predicate_kind(cls, raw_predicate: str) -> int:
+        if raw_predicate == _get_unconditional_predicate():
+            return cls.PREDICATE_UNCONDITIONAL
+        if raw_predicate == _get_not_unconditinal_predicate():
+            return cls.PREDICATE_NOT_UNCONDITIONAL
+        return cls.PREDICATE_OTHER
 
     def __str__(self):
         return "Claimant {}...{} for {}...{}".format(
@@ -119,11 +242,71 @@ class Claimant(models.Model):
         return ClaimPredicate.from_xdr_object(XDRClaimPredicate.from_xdr(self.raw_predicate))
 
 
-class VoteSnapshot(models.Model):
+class LiveClaimableBalance(AccountRefMixin, models.Model):
+    """
+    Current claimable balances of the delegatable assets, kept up to date
+    from their Horizon listings. Daily claims snapshots are copied from
+    here once a sweep has dropped the claimed balances. ``updated_at`` is
+    also when a sweep last saw the balance.
+    """
+    ACCOUNT_REF_FIELDS = (('owner', 'owner_ref'), )
+
+    claimable_balance_id = models.CharField(max_length=96, unique=True)
+
+    asset_code = models.CharField(max_length=12)
+    asset_issuer = models.CharField(max_length=56)
+
+    amount = models.DecimalField(max_digits=20, decimal_places=7, default=0)
+    sponsor = models.CharField(max_length=56)
+
+    owner = models.CharField(max_length=56)
+    owner_ref = models.ForeignKey(
+        Account, null=True, editable=False, on_delete=models.PROTECT, related_name='+',
+    )
+
+    last_modified_time = models.DateTimeField(null=True)
+    last_modified_ledger = models.PositiveIntegerField()
+
+    updated_at = models.DateTimeField(auto_now=True)
+
+    class Meta:
+        indexes = [
+            models.Index(fields=['asset_code', 'asset_issuer'], name='live_cb_asset_idx'),
+        ]
+
+    def __str__(self):
+        return "LiveClaimableBalance: {}...{}".format(self.claimable_balance_id[:6], self.claimable_balance_id[-6:])
+
+
+class LiveClaimant(AccountRefMixin, models.Model):
+    ACCOUNT_REF_FIELDS = (('destination', 'destination_ref'), )
+
+    destination = models.CharField(max_length=56)
+    destination_ref = models.ForeignKey(
+        Account, null=True, editable=False, on_delete=models.PROTECT, related_name='+',
+    )
+
+    raw_predicate = models.TextField()
+    predicate_kind = models.PositiveSmallIntegerField(
+        choices=Claimant.PREDICATE_KIND_CHOICES, default=Claimant.PREDICATE_OTHER,
+    )
+
+    claimable_balance = models.ForeignKey(LiveClaimableBalance, on_delete=models.CASCADE, related_name='claimants')
+
+    def __str__(self):
+        return "LiveClaimant {}...{}".format(self.destination[:6], self.destination[-6:])
+
+
+class VoteSnapshot(AccountRefMixin, models.Model):
+    ACCOUNT_REF_FIELDS = (('voting_account', 'voting_account_ref'), )
+
     market_key = models.ForeignKey('bribes.MarketKey', null=True, on_delete=models.PROTECT)
 
-    votes_value = models.DecimalField(max_digits=20, decimal_places=7)
+    votes_value = StroopField()
     voting_account = models.CharField(max_length=56, db_index=True)
+    voting_account_ref = models.ForeignKey(
+        Account, null=True, editable=False, on_delete=models.PROTECT, related_name='+',
+    )
 
     is_delegated = models.BooleanField(default=False)
     has_delegation = models.BooleanField(default=False)
@@ -143,6 +326,79 @@ class VoteSnapshot(models.Model):
         )
 
 
+class VoteSnapshotArchive(models.Model):
+    """
+    Compact append-only storage for vote snapshot months rolled out of the
+    partitioned VoteSnapshot table. Rows keep their original ids so payouts
+    of archived days can still be audited, but carry none of the per-column
+    and unique indexes of the live table.
+    """
+    id = models.BigIntegerField(primary_key=True)
+
+    market_key = models.ForeignKey(
+        'bribes.MarketKey', null=True, on_delete=models.PROTECT, db_constraint=False, db_index=False,
+    )
+
+    votes_value = StroopField()
+    voting_account = models.CharField(max_length=56)
+
+    is_delegated = models.BooleanField(default=False)
+    has_delegation = models.BooleanField(default=False)
+    delegate_owner = models.CharField(max_length=56, default=None, blank=True, null=True)
+
+    snapshot_time = models.DateField()
+
+    class Meta:
+        indexes = [
+            BrinIndex(fields=['snapshot_time'], name='vsa_snapshot_time_brin'),
+            models.Index(fields=['market_key', 'snapshot_time'], name='vsa_market_date_idx'),
+        ]
+
+    def __str__(self):
+        return 'VoteSnapshotArchive: {}..{} ({})'.format(
+            self.voting_account[:4], self.voting_account[-4:], self.snapshot_time,
+        )
+
+
+class VoteSnapshotProgress(models.Model):
+    """
+    Progress of loading one market's votes for one snapshot day. VotesLoader
+    checkpoints the next tracker page together with every batch it writes,
+    so a rerun skips finished markets and resumes the others where they
+    stopped.
+    """
+    STATUS_RUNNING = 'running'
+    STATUS_FAILED = 'failed'
+    STATUS_DONE = 'done'
+    STATUS_CHOICES = (
+        (STATUS_RUNNING, 'running'),
+        (STATUS_FAILED, 'failed'),
+        (STATUS_DONE, 'done'),
+    )
+
+    snapshot_time = models.DateField()
+    market_key = models.ForeignKey('bribes.MarketKey', on_delete=models.PROTECT)
+
+    # Exact timestamp the voting tracker is asked for; a resumed run must
+    # page through the same listing.
+    tracker_timestamp = models.DateTimeField()
+    status = models.CharField(choices=STATUS_CHOICES, default=STATUS_RUNNING, max_length=30)
+    next_page = models.PositiveIntegerField(default=1)
+    # VoteSnapshot ids up to this one existed before the run started.
+    run_start_id = models.BigIntegerField(default=0)
+    message = models.TextField(blank=True)
+
+    started_at = models.DateTimeField(auto_now_add=True)
+    updated_at = models.DateTimeField(auto_now=True)
+    finished_at = models.DateTimeField(null=True, blank=True)
+
+    class Meta:
+        unique_together = ('snapshot_time', 'market_key')
+
+    def __str__(self):
+        return 'VoteSnapshotProgress: {} ({}) {}'.format(self.market_key_id, self.snapshot_time, self.status)
+
+
 class Payout(models.Model):
     STATUS_SUCCESS = 'success'
     STATUS_FAILED = 'failed'
@@ -153,7 +409,10 @@ class Payout(models.Model):
 
     bribe = models.ForeignKey('bribes.AggregatedByAssetBribe', on_delete=models.PROTECT)
 
-    vote_snapshot = models.ForeignKey(VoteSnapshot, on_delete=models.PROTECT)
+    # No database-level constraint: VoteSnapshot is partitioned by
+    # snapshot_time and its id alone is not unique at the database level.
+    # PROTECT is still enforced by the ORM.
+    vote_snapshot = models.ForeignKey(VoteSnapshot, on_delete=models.PROTECT, db_constraint=False)
 
     stellar_transaction_id = models.CharField(max_length=64, blank=True)
     status = models.CharField(
@@ -161,7 +420,7 @@ class Payout(models.Model):
     )
     message = models.TextField(blank=True, db_index=True)
 
-    reward_amount = models.DecimalField(max_digits=20, decimal_places=7, null=True)
+    reward_amount = StroopField(null=True)
 
     asset_code = models.CharField(max_length=12)
     asset_issuer = models.CharField(max_length=56)
@@ -172,17 +431,69 @@ class Payout(models.Model):
     def __str__(self):
         return 'Payout {0} for {1}'.format(
             self.reward_amount,
-            self.vote_snapshot.voting_account,
+            self.get_vote_snapshot().voting_account,
         )
 
+    def get_vote_snapshot(self):
+        # Votes of archived snapshot days keep their ids in VoteSnapshotArchive.
+        try:
+            return self.vote_snapshot
+        except VoteSnapshot.DoesNotExist:
+            return VoteSnapshotArchive.objects.get(pk=self.vote_snapshot_id)
+
+
+class PayableVoteSet(models.Model):
+    """
+    Eligibility of one bribe on a snapshot day, materialized by
+    eligibility.materialize_payable_votes: the pre-dust total, the dust
+    cutoff and, in PayableVote, the votes left to pay. Both tables are
+    UNLOGGED; they are rebuilt by every payout run, which first purges the
+    sets of earlier days.
+    """
+    bribe = models.ForeignKey('bribes.AggregatedByAssetBribe', on_delete=models.CASCADE)
+    snapshot_date = models.DateField()
+
+    reward_amount = StroopField(null=True)
+    total_votes = StroopField(null=True)
+    min_votes_value = StroopField(null=True)
+
+    created_at = models.DateTimeField(auto_now=True)
+
+    class Meta:
+        unique_together = (('bribe', 'snapshot_date'), )
+
+    def __str__(self):
+        return 'PayableVoteSet of bribe {0} at {1}'.format(self.bribe_id, self.snapshot_date)
+
+
+class PayableVote(models.Model):
+    payable_set = models.ForeignKey(PayableVoteSet, on_delete=models.CASCADE, related_name='votes')
+    # No database-level constraint, as for Payout.vote_snapshot.
+    vote_snapshot = models.ForeignKey(
+        VoteSnapshot, on_delete=models.DO_NOTHING, db_constraint=False, related_name='+',
+    )
+
+    def __str__(self):
+        return 'PayableVote {0} of set {1}'.format(self.vote_snapshot_id, self.payable_set_id)
+
+
+class AssetHolderBalanceSnapshot(AccountRefMixin, models.Model):
+    """
+    Trustline holders of the days snapshotted before AssetHolderInterval,
+    one row per holder and day. No longer written; build_asset_holders
+    still reads them for those days.
+    """
+    ACCOUNT_REF_FIELDS = (('account', 'account_ref'), )
 
-class AssetHolderBalanceSnapshot(models.Model):
     account = models.CharField(max_length=255, db_index=True)
+    account_ref = models.ForeignKey(
+        Account, null=True, editable=False, on_delete=models.PROTECT, related_name='+',
+    )
 
     asset_code = models.CharField(max_length=12)
     asset_issuer = models.CharField(max_length=56)
 
-    balance = models.DecimalField(max_digits=20, decimal_places=7)
+    balance = StroopField()
 
     created_at = models.DateTimeField(auto_now_add=True, db_index=True)
 
@@ -198,3 +509,164 @@ class AssetHolderBalanceSnapshot(models.Model):
         return '{0}..{1} at {2}: {3} {4}'.format(
             self.account[:8], self.account[-8:], self.created_at.date(), self.balance, self.asset.code,
         )
+
+
+class AssetHolderBalanceStaging(AccountRefMixin, models.Model):
+    """
+    Holders of a trustee snapshot in progress, written by the trustees
+    loaders. Once the day is complete they are folded into
+    AssetHolderInterval and deleted, so the table is UNLOGGED: loading
+    every holder each day writes no WAL, and a crash only loses the
+    snapshot in progress.
+    """
+    ACCOUNT_REF_FIELDS = (('account', 'account_ref'), )
+
+    account = models.CharField(max_length=255)
+    account_ref = models.ForeignKey(
+        Account, null=True, editable=False, on_delete=models.PROTECT, related_name='+',
+    )
+
+    asset_code = models.CharField(max_length=12)
+    asset_issuer = models.CharField(max_length=56)
+
+    balance = StroopField()
+
+    created_at = models.DateTimeField(auto_now_add=True)
+
+    class Meta:
+        indexes = [
+            models.Index(
+                fields=['asset_code', 'asset_issuer', 'created_at', 'account'],
+                name='ahb_staging_asset_date_idx',
+            ),
+        ]
+
+    def __str__(self):
+        return '{0}..{1} at {2}: {3} {4}'.format(
+            self.account[:8], self.account[-8:], self.created_at.date(), self.balance, self.asset_code,
+        )
+
+
+HOLDER_SNAPSHOT_MATCH = """
+    snapshot."asset_code" = %s AND snapshot."asset_issuer" = %s
+    AND snapshot."created_at" >= %s AND snapshot."created_at" < %s
+"""
+
+
+class AssetHolderIntervalManager(models.Manager):
+    def as_of(self, snapshot_date):
+        """Holders of the last trustee snapshot synced on or before ``snapshot_date``."""
+        return self.get_queryset().extra(
+            where=['daterange("valid_from", "valid_to") @> %s::date'], params=[snapshot_date],
+        )
+
+    def sync(self, asset_code, asset_issuer, snapshot_date):
+        """
+        Fold the finished AssetHolderBalanceStaging rows of one asset and day
+        into the intervals: open intervals of accounts no longer holding
+        the asset are closed at ``snapshot_date`` and only new holders open
+        intervals. Syncing the same day again first undoes what the previous
+        sync of that day did. Returns (closed, opened) row counts.
+        """
+        table = self.model._meta.db_table
+        snapshot_table = AssetHolderBalanceStaging._meta.db_table
+        day_start = timezone.make_aware(datetime.combine(snapshot_date, time.min))
+        snapshot_params = [asset_code, asset_issuer, day_start, day_start + timedelta(days=1)]
+        asset_filter = '"asset_code" = %s AND "asset_issuer" = %s'
+        with transaction.atomic(), connection.cursor() as cursor:
+            cursor.execute(
+                'SELECT 1 FROM "{0}" WHERE {1} AND ("valid_from" > %s OR "valid_to" > %s) LIMIT 1'.format(
+                    table, asset_filter,
+                ),
+                [asset_code, asset_issuer, snapshot_date, snapshot_date],
+            )
+            if cursor.fetchone():
+                raise ValueError('Holders of {0} are already synced past {1}'.format(asset_code, snapshot_date))
+
+            cursor.execute(
+                'DELETE FROM "{0}" WHERE {1} AND "valid_from" = %s'.format(table, asset_filter),
+                [asset_code, asset_issuer, snapshot_date],
+            )
+            cursor.execute(
+                'UPDATE "{0}" SET "valid_to" = NULL WHERE {1} AND "valid_to" = %s'.format(table, asset_filter),
+                [asset_code, asset_issuer, snapshot_date],
+            )
+
+            cursor.execute(
+                'UPDATE "{0}" AS stored SET "valid_to" = %s '
+                'WHERE stored."asset_code" = %s AND stored."asset_issuer" = %s AND stored."valid_to" IS NULL '
+                'AND NOT EXISTS (SELECT 1 FROM "{1}" AS snapshot WHERE {2} '
+                'AND snapshot."account_ref_id" = stored."account_id")'.format(
+                    table, snapshot_table, HOLDER_SNAPSHOT_MATCH,
+                ),
+                [snapshot_date, asset_code, asset_issuer] + snapshot_params,
+            )
+            closed = cursor.rowcount
+
+            cursor.execute(
+                'INSERT INTO "{0}" ("asset_code", "asset_issuer", "account_id", "valid_from") '
+                'SELECT DISTINCT %s, %s, snapshot."account_ref_id", %s FROM "{1}" AS snapshot '
+                'WHERE {2} AND snapshot."account_ref_id" IS NOT NULL AND NOT EXISTS ('
+                'SELECT 1 FROM "{0}" AS stored WHERE stored."asset_code" = %s AND stored."asset_issuer" = %s '
+                'AND stored."valid_to" IS NULL AND stored."account_id" = snapshot."account_ref_id")'.format(
+                    table, snapshot_table, HOLDER_SNAPSHOT_MATCH,
+                ),
+                [asset_code, asset_issuer, snapshot_date] + snapshot_params + [asset_code, asset_issuer],
+            )
+            opened = cursor.rowcount
+        return closed, opened
+
+
+class AssetHolderInterval(models.Model):
+    """
+    Trustline holders stored as validity ranges: a row says an account
+    held the asset from ``valid_from`` until ``valid_to`` (exclusive, NULL
+    while it still does). Daily syncs only write accounts that started or
+    stopped holding, so the history grows with trustline changes rather
+    than with holders times days.
+    """
+    asset_code = models.CharField(max_length=12)
+    asset_issuer = models.CharField(max_length=56)
+    account = models.ForeignKey(Account, on_delete=models.PROTECT, related_name='+')
+
+    valid_from = models.DateField()
+    valid_to = models.DateField(null=True, blank=True)
+
+    objects = AssetHolderIntervalManager()
+
+    class Meta:
+        indexes = [
+            GistIndex(
+                models.Func(
+                    models.F('valid_from'), models.F('valid_to'), function='daterange', output_field=DateRangeField(),
+                ),
+                name='holder_interval_validity_gist',
+            ),
+            models.Index(fields=['asset_code', 'asset_issuer', 'valid_to'], name='holder_interval_open_idx'),
+        ]
+
+    def __str__(self):
+        return 'AssetHolderInterval: {} #{} ({} - {})'.format(
+            self.asset_code, self.account_id, self.valid_from, self.valid_to or '',
+        )
+
+
+class AssetHolderBitmap(models.Model):
+    """
+    Account ids of an asset's holders on a day, as a compressed IdBitmap;
+    stored once the day's trustee snapshot is complete.
+    """
+    asset_code = models.CharField(max_length=12)
+    asset_issuer = models.CharField(max_length=56)
+    snapshot_date = models.DateField()
+
+    bitmap = models.BinaryField()
+    holders = models.PositiveIntegerField()
+
+    created_at = models.DateTimeField(auto_now_add=True)
+
+    class Meta:
+        unique_together = (('asset_code', 'asset_issuer', 'snapshot_date'), )
+
+    def __str__(self):
+        return '{0} holders of {1} at {2}'.format(self.holders, self.asset_code, self.snapshot_date)
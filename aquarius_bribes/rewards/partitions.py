@@ -0,0 +1,192 @@
+import re
+from datetime import date
+from typing import List, NamedTuple, Optional, Tuple
+
+from django.db import connection, transaction
+from django.utils import timezone
+
+from aquarius_bribes.rewards.models import Payout, VoteSnapshot, VoteSnapshotArchive
+
+PARTITION_UPPER_BOUND_RE = re.compile(r"TO \('(\d{4}-\d{2}-\d{2})[^']*'\)")
+
+# Far enough ahead that no row lands in DEFAULT between daily runs of
+# task_ensure_partitions, even if the task is broken for a few months.
+PARTITION_MONTHS_AHEAD = 6
+
+
+class Partition(NamedTuple):
+    name: str
+    upper_bound: Optional[date]
+    is_default: bool
+
+
+def month_start(value) -> date:
+    return date(value.year, value.month, 1)
+
+
+def add_months(month: date, count: int) -> date:
+    index = month.year * 12 + month.month - 1 + count
+    return date(index // 12, index % 12 + 1, 1)
+
+
+class MonthlyPartitioning(object):
+    """
+    Native Postgres range partitioning of a table by calendar month (UTC).
+
+    The parent table is converted by a migration; this class only manages the
+    monthly children: creating them ahead of time, detaching old ones so they
+    can be moved to cheaper storage or dropped, and re-attaching detached ones.
+    Every partitioned table keeps a DEFAULT partition so inserts never fail
+    when the periodic task that creates partitions ahead has not run. Months
+    are created well ahead, so DEFAULT stays empty and adding a partition never
+    has to detach it.
+    """
+    def __init__(self, model, column: str, is_timestamp: bool):
+        self.model = model
+        self.column = column
+        self.is_timestamp = is_timestamp
+
+    @property
+    def table(self) -> str:
+        return self.model._meta.db_table
+
+    @property
+    def default_partition(self) -> str:
+        return '{0}_default'.format(self.table)
+
+    def partition_name(self, month: date) -> str:
+        return '{0}_p{1:04d}_{2:02d}'.format(self.table, month.year, month.month)
+
+    def _bound(self, month: date) -> str:
+        if self.is_timestamp:
+            return '{0} 00:00:00+00'.format(month.isoformat())
+        return month.isoformat()
+
+    def get_partitions(self) -> List[Partition]:
+        with connection.cursor() as cursor:
+            cursor.execute(
+                'SELECT child.relname, pg_get_expr(child.relpartbound, child.oid) '
+                'FROM pg_inherits '
+                'JOIN pg_class parent ON parent.oid = pg_inherits.inhparent '
+                'JOIN pg_class child ON child.oid = pg_inherits.inhrelid '
+                'WHERE parent.relname = %s ORDER BY child.relname',
+                [self.table],
+            )
+            rows = cursor.fetchall()
+
+        partitions = []
+        for name, bound in rows:
+            match = PARTITION_UPPER_BOUND_RE.search(bound)
+            partitions.append(Partition(
+                name=name,
+                upper_bound=date.fromisoformat(match.group(1)) if match else None,
+                is_default=bound == 'DEFAULT',
+            ))
+        return partitions
+
+    def create_partition(self, month: date) -> bool:
+        month = month_start(month)
+        name = self.partition_name(month)
+        if name in {partition.name for partition in self.get_partitions()}:
+            return False
+
+        lower, upper = self._bound(month), self._bound(add_months(month, 1))
+        with transaction.atomic(), connection.cursor() as cursor:
+            cursor.execute(
+                'SELECT 1 FROM "{0}" WHERE "{1}" >= %s AND "{1}" < %s LIMIT 1'.format(
+                    self.default_partition, self.column,
+                ),
+                [lower, upper],
+            )
+            in_default = cursor.fetchone() is not None
+
+            # Rows that already landed in the DEFAULT partition for this month
+            # would make the ATTACH fail, so move them over first. Detaching
+            # DEFAULT locks the whole table, which is why it is only done then.
+            if in_default:
+                cursor.execute('ALTER TABLE "{0}" DETACH PARTITION "{1}"'.format(self.table, self.default_partition))
+            cursor.execute('CREATE TABLE "{0}" (LIKE "{1}" INCLUDING DEFAULTS)'.format(name, self.table))
+            if in_default:
+                cursor.execute(
+                    'WITH moved AS (DELETE FROM "{0}" WHERE "{2}" >= %s AND "{2}" < %s RETURNING *) '
+                    'INSERT INTO "{1}" SELECT * FROM moved'.format(self.default_partition, name, self.column),
+                    [lower, upper],
+                )
+            # ATTACH only takes SHARE UPDATE EXCLUSIVE on the parent, unlike
+            # CREATE TABLE ... PARTITION OF, so reads and writes go on.
+            cursor.execute(
+                'ALTER TABLE "{0}" ATTACH PARTITION "{1}" FOR VALUES FROM (%s) TO (%s)'.format(self.table, name),
+                [lower, upper],
+            )
+            if in_default:
+                cursor.execute('ALTER TABLE "{0}" ATTACH PARTITION "{1}" DEFAULT'.format(
+                    self.table, self.default_partition,
+                ))
+        return True
+
+    def ensure_partitions(self, months_ahead: int = PARTITION_MONTHS_AHEAD, today: date = None) -> List[str]:
+        current = month_start(today or timezone.now().date())
+        created = []
+        for offset in range(months_ahead + 1):
+            month = add_months(current, offset)
+            if self.create_partition(month):
+                created.append(self.partition_name(month))
+        return created
+
+    def detach_partitions(self, before: date) -> List[str]:
+        """Detach every bounded partition whose rows all predate ``before``."""
+        detached = []
+        with transaction.atomic(), connection.cursor() as cursor:
+            for partition in self.get_partitions():
+                if partition.is_default or partition.upper_bound is None or partition.upper_bound > before:
+                    continue
+                cursor.execute('ALTER TABLE "{0}" DETACH PARTITION "{1}"'.format(self.table, partition.name))
+                detached.append(partition.name)
+        return detached
+
+    def attach_partition(self, name: str, month: date):
+        month = month_start(month)
+        with connection.cursor() as cursor:
+            cursor.execute(
+                'ALTER TABLE "{0}" ATTACH PARTITION "{1}" FOR VALUES FROM (%s) TO (%s)'.format(self.table, name),
+                [self._bound(month), self._bound(add_months(month, 1))],
+            )
+
+
+PARTITIONED_TABLES = {
+    'payout': MonthlyPartitioning(Payout, 'created_at', is_timestamp=True),
+    'votesnapshot': MonthlyPartitioning(VoteSnapshot, 'snapshot_time', is_timestamp=False),
+}
+
+
+def archive_vote_snapshot_partitions(before: date) -> List[Tuple[str, int]]:
+    """
+    Roll every VoteSnapshot partition holding only days before ``before`` into
+    VoteSnapshotArchive. Each partition is detached, copied and dropped in one
+    transaction, so a failed copy leaves it attached and untouched.
+    """
+    partitioning = PARTITIONED_TABLES['votesnapshot']
+    columns = ', '.join('"{0}"'.format(field.column) for field in VoteSnapshotArchive._meta.concrete_fields)
+
+    archived = []
+    for partition in partitioning.get_partitions():
+        if partition.is_default or partition.upper_bound is None or partition.upper_bound > before:
+            continue
+
+        with transaction.atomic(), connection.cursor() as cursor:
+            # Deferred foreign key checks queued against the partition would
+            # block dropping it; run them now.
+            cursor.execute('SET CONSTRAINTS ALL IMMEDIATE')
+            cursor.execute('ALTER TABLE "{0}" DETACH PARTITION "{1}"'.format(partitioning.table, partition.name))
+            cursor.execute('SELECT count(*) FROM "{0}"'.format(partition.name))
+            expected = cursor.fetchone()[0]
+            cursor.execute('INSERT INTO "{0}" ({1}) SELECT {1} FROM "{2}"'.format(
+                VoteSnapshotArchive._meta.db_table, columns, partition.name,
+            ))
+            if cursor.rowcount != expected:
+                raise RuntimeError('Archived {0} of {1} rows from {2}'.format(
+                    cursor.rowcount, expected, partition.name,
+                ))
+            cursor.execute('DROP TABLE "{0}"'.format(partition.name))
+        archived.append((partition.name, expected))
+    return archived
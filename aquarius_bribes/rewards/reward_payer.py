@@ -22,7 +22,7 @@ logger = logging.getLogger(__name__)
 class BaseRewardPayer(object):
     payout_class = None
 
-    def __init__(self, bribe, payer_wallet, reward_asset, reward_amount, stop_at=None):
+    def __init__(self, bribe, payer_wallet, reward_asset, reward_amount, stop_at=None, payouts_since=None):
         self.bribe = bribe
         self.asset = reward_asset
         self.payer_wallet = payer_wallet
@@ -34,6 +34,16 @@ class BaseRewardPayer(object):
         # runs by _clean_rewards, but skipped within the current pay_reward loop
         # so a persistent horizon outage can't infinitely re-enqueue the same page.
         self._build_failure_vote_ids: set = set()
+        # Lower bound for created_at of any payout of the votes being paid
+        # (the start of their snapshot day). Payout is partitioned by
+        # created_at month, so bounding every payout lookup lets Postgres
+        # prune the scan to the current partitions.
+        self.payouts_since = payouts_since
+
+    def _get_payouts_filter(self, prefix=''):
+        if self.payouts_since is None:
+            return models.Q()
+        return models.Q(**{'{0}created_at__gte'.format(prefix): self.payouts_since})
 
     def _clean_rewards(self, rewards):
         raise NotImplementedError()
@@ -261,6 +271,7 @@ class BaseRewardPayer(object):
         # on the next submit when the original tx lands later. Same status
         # filter on the update/delete operations below for defense in depth.
         uncertain_transactions = rewards.filter(
+            self._get_payouts_filter('payout__'),
             payout__status=self.payout_class.STATUS_FAILED,
             payout__stellar_transaction_id__gt='',
         ).filter(
@@ -279,6 +290,7 @@ class BaseRewardPayer(object):
 
                 if tx_data.get('successful', False):
                     self.payout_class.objects.filter(
+                        self._get_payouts_filter(),
                         stellar_transaction_id=tx_hash,
                         status=self.payout_class.STATUS_FAILED,
                     ).update(
@@ -287,11 +299,13 @@ class BaseRewardPayer(object):
                     )
                 else:
                     self.payout_class.objects.filter(
+                        self._get_payouts_filter(),
                         stellar_transaction_id=tx_hash,
                         status=self.payout_class.STATUS_FAILED,
                     ).delete()
             except NotFoundError:
                 self.payout_class.objects.filter(
+                    self._get_payouts_filter(),
                     stellar_transaction_id=tx_hash,
                     status=self.payout_class.STATUS_FAILED,
                 ).delete()
@@ -335,6 +349,7 @@ class RewardPayer(BaseRewardPayer):
             'unknown_response_no_successful_field',
         ]) | models.Q(message__startswith='build_failure:')
         failed_by_unkown_reason = self.payout_class.objects.filter(
+            self._get_payouts_filter(),
             bribe=self.bribe, vote_snapshot__in=qs,
         ).exclude(
             retryable_failure, status=self.payout_class.STATUS_FAILED,
@@ -342,6 +357,7 @@ class RewardPayer(BaseRewardPayer):
         qs = qs.exclude(id__in=failed_by_unkown_reason)
 
         already_payed = rewards.filter(
+            self._get_payouts_filter('payout__'),
             payout__status=self.payout_class.STATUS_SUCCESS, payout__bribe=self.bribe,
         ).values_list('id', flat=True)
         qs = qs.exclude(id__in=already_payed)
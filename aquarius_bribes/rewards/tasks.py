@@ -6,19 +6,38 @@ from decimal import Decimal
 
 from django.conf import settings
 from django.core.cache import cache
+from django.db import connection
 from django.utils import timezone
 
+from billiard.exceptions import SoftTimeLimitExceeded
 from stellar_sdk import Asset
 
 from aquarius_bribes.bribes.models import AggregatedByAssetBribe
-from aquarius_bribes.rewards.claim_loader import ClaimLoader
-from aquarius_bribes.rewards.eligibility import get_payable_votes
-from aquarius_bribes.rewards.models import ClaimableBalance
+from aquarius_bribes.rewards.claim_loader import ClaimLoader, load_claims_concurrently
+from aquarius_bribes.rewards.claims_sync import LiveClaimsSync
+from aquarius_bribes.rewards.eligibility import (
+    get_eligibility_totals,
+    get_payable_votes,
+    materialize_payable_votes,
+    purge_payable_votes,
+    store_asset_holders,
+)
+from aquarius_bribes.rewards.ledger_dump import LedgerDumpTrusteesLoader
+from aquarius_bribes.rewards.models import (
+    AssetHolderBitmap,
+    AssetHolderInterval,
+    ClaimableBalance,
+    VoteSnapshotProgress,
+    get_snapshot_date,
+)
+from aquarius_bribes.rewards.partitions import PARTITION_MONTHS_AHEAD, PARTITIONED_TABLES
 from aquarius_bribes.rewards.reward_payer import RewardPayer
-from aquarius_bribes.rewards.trustees_loader import TrusteesLoader
+from aquarius_bribes.rewards.trustees_loader import TrusteesLoader, make_balances_snapshot_concurrently
 from aquarius_bribes.rewards.utils import SecuredWallet
-from aquarius_bribes.rewards.votes_loader import VotesLoader
+from aquarius_bribes.rewards.votes_loader import DelegationIndex, VotesLoader, load_votes_concurrently
 from aquarius_bribes.taskapp import app as celery_app
+from aquarius_bribes.utils.horizon import HorizonPager, HorizonUnavailable
+from aquarius_bribes.utils.http import HostLimitedSession, RateLimiter
 
 logger = logging.getLogger(__name__)
 
@@ -29,29 +48,103 @@ LOAD_TRUSTORS_TASK_ACTIVE_KEY = 'LOAD_TRUSTORS_TASK_ACTIVE_KEY'
 PAY_REWARDS_TASK_ACTIVE_KEY = 'PAY_REWARDS_TASK_ACTIVE_KEY'
 
 LOAD_VOTES_TASK_TTL = 60 * 60 * 2
+# Arbitrary constant identifying task_load_votes runs in pg_advisory_lock.
+LOAD_VOTES_LOCK_ID = 4100036
 LOAD_TRUSTORS_TASK_TTL = 60 * 60 * 10
 PAY_REWARDS_TASK_TTL = int(PAYREWARD_TIME_LIMIT.total_seconds()) + 60 * 5
 
+LOAD_VOTES_WORKERS = 8
+LOAD_CLAIMS_WORKERS = 4
+LOAD_TRUSTEES_WORKERS = 8
+# Listing pages per asset for the tail of a live claims sync.
+LIVE_CLAIMS_SYNC_MAX_PAGES = 20
+# Listing pages per asset for each run of the sweep before a claims snapshot.
+LIVE_CLAIMS_SWEEP_MAX_PAGES = 200
+# Shared by every trustees loader thread.
+TRUSTEES_HORIZON_REQUESTS_PER_SECOND = 10
+RESUME_COUNTDOWN = 60
+# Resuming after Horizon gave up waits out the incident instead.
+HORIZON_UNAVAILABLE_COUNTDOWN = 60 * 10
+VOTING_TRACKER_MAX_CONNECTIONS = 4
+
+
+@celery_app.task(ignore_result=True, soft_time_limit=60 * 50, time_limit=60 * 55)
+def task_make_claims_snapshot(resume=False, resume_on_timeout=True):
+    """
+    Reload the day's claims of every delegatable asset, or with ``resume``
+    continue an interrupted reload from its saved cursors. Returns True
+    once all assets are loaded. Stopped by its soft time limit it keeps the
+    loaded pages and, unless the caller resumes it itself, schedules a run
+    that continues from the cursors.
+    """
+    snapshot_date = timezone.now().date()
+    assets = [asset for asset_pair in settings.DELEGATABLE_ASSETS for asset in asset_pair]
+
+    if settings.CLAIMS_LIVE_SYNC:
+        # The live tables only need the balances since their last sync, and
+        # one sweep for the claimed ones; a sync or sweep stopped by the time
+        # limit or its page bound keeps its cursors.
+        try:
+            live_claims = LiveClaimsSync(assets)
+            if not live_claims.sync(max_pages=LIVE_CLAIMS_SYNC_MAX_PAGES):
+                logger.warning('task_make_claims_snapshot: live claims are still paging their first listing')
+                if resume_on_timeout:
+                    task_make_claims_snapshot.apply_async(kwargs={'resume': True}, countdown=RESUME_COUNTDOWN)
+                return False
+            if not live_claims.sweep(max_pages=LIVE_CLAIMS_SWEEP_MAX_PAGES):
+                logger.warning('task_make_claims_snapshot: live claims are still sweeping claimed balances')
+                if resume_on_timeout:
+                    task_make_claims_snapshot.apply_async(kwargs={'resume': True}, countdown=RESUME_COUNTDOWN)
+                return False
+        except SoftTimeLimitExceeded:
+            logger.warning('task_make_claims_snapshot: live claims sync stopped by the time limit')
+            if resume_on_timeout:
+                task_make_claims_snapshot.apply_async(kwargs={'resume': True}, countdown=RESUME_COUNTDOWN)
+            return False
+        except HorizonUnavailable as error:
+            logger.warning('task_make_claims_snapshot: live claims sync stopped, %s', error)
+            if resume_on_timeout:
+                task_make_claims_snapshot.apply_async(
+                    kwargs={'resume': True}, countdown=HORIZON_UNAVAILABLE_COUNTDOWN,
+                )
+            return False
+        live_claims.copy_snapshot(snapshot_date)
+        return True
+
+    pager = HorizonPager()
+    loaders = []
+    for asset in assets:
+        loader = ClaimLoader(asset, snapshot_date=snapshot_date, pager=pager)
+        if not resume:
+            loader.reset()
+        if not loader.is_started():
+            ClaimableBalance.objects.filter(
+                snapshot_date=snapshot_date, asset_code=asset.code, asset_issuer=asset.issuer,
+            ).delete()
+        if not loader.is_done():
+            loaders.append(loader)
 
-@celery_app.task(ignore_result=True)
-def task_make_claims_snapshot():
-    snapshot_time = timezone.now()
-    snapshot_time = snapshot_time.replace(minute=0, second=0, microsecond=0, hour=0)
-
-    for asset, delegated_asset in settings.DELEGATABLE_ASSETS:
-        ClaimableBalance.objects.filter(asset_code=asset.code, asset_issuer=asset.issuer).filter(
-            loaded_at__gte=snapshot_time,
-            loaded_at__lt=snapshot_time + timedelta(days=1),
-        ).delete()
-        loader = ClaimLoader(asset)
-        loader.make_claim_spanshot()
-
-        ClaimableBalance.objects.filter(asset_code=delegated_asset.code, asset_issuer=delegated_asset.issuer).filter(
-            loaded_at__gte=snapshot_time,
-            loaded_at__lt=snapshot_time + timedelta(days=1),
-        ).delete()
-        loader = ClaimLoader(delegated_asset)
-        loader.make_claim_spanshot()
+    try:
+        load_claims_concurrently(loaders, max_workers=LOAD_CLAIMS_WORKERS)
+    except SoftTimeLimitExceeded:
+        logger.warning('task_make_claims_snapshot: stopped by the time limit, claims are kept up to the cursor')
+        if resume_on_timeout:
+            task_make_claims_snapshot.apply_async(kwargs={'resume': True}, countdown=RESUME_COUNTDOWN)
+        return False
+    except HorizonUnavailable as error:
+        logger.warning('task_make_claims_snapshot: stopped, claims are kept up to the cursor, %s', error)
+        if resume_on_timeout:
+            task_make_claims_snapshot.apply_async(kwargs={'resume': True}, countdown=HORIZON_UNAVAILABLE_COUNTDOWN)
+        return False
+    return True
+
+
+@celery_app.task(ignore_result=True, soft_time_limit=60 * 10, time_limit=60 * 15)
+def task_sync_live_claims():
+    if not settings.CLAIMS_LIVE_SYNC:
+        return
+    assets = [asset for asset_pair in settings.DELEGATABLE_ASSETS for asset in asset_pair]
+    LiveClaimsSync(assets).sync(wait=False, max_pages=LIVE_CLAIMS_SYNC_MAX_PAGES)
 
 
 @celery_app.task(ignore_result=True, soft_time_limit=60 * 20, time_limit=60 * 30)
@@ -62,51 +155,153 @@ def task_run_load_votes():
     task_make_trustees_snapshot.delay()
 
 
-@celery_app.task(ignore_result=True, soft_time_limit=60 * 60 * 1, time_limit=60 * (60 * 1 + 5))
-def task_load_votes(snapshot_time=None):
-    cache.set(LOAD_VOTES_TASK_ACTIVE_KEY, True, LOAD_VOTES_TASK_TTL)
+def acquire_load_votes_lock() -> bool:
+    with connection.cursor() as cursor:
+        cursor.execute('SELECT pg_try_advisory_lock(%s)', [LOAD_VOTES_LOCK_ID])
+        return cursor.fetchone()[0]
 
-    if snapshot_time is None:
-        snapshot_time = timezone.now()
-        snapshot_time = snapshot_time.replace(minute=0, second=0, microsecond=0)
 
-    task_make_claims_snapshot()
+def release_load_votes_lock():
+    with connection.cursor() as cursor:
+        cursor.execute('SELECT pg_advisory_unlock(%s)', [LOAD_VOTES_LOCK_ID])
 
-    markets_with_active_bribes = AggregatedByAssetBribe.objects.filter(
-        start_at__lte=snapshot_time, stop_at__gt=snapshot_time,
-    ).values_list('market_key', flat=True).distinct()
 
-    for market_key in markets_with_active_bribes:
-        loader = VotesLoader(market_key, snapshot_time)
-        loader.load_votes()
+def is_load_votes_running() -> bool:
+    """
+    Whether a task_load_votes run holds its lock on any worker. The lock
+    is tied to the run's database session, so it is released as soon as a
+    dead worker's connection goes away.
+    """
+    if not acquire_load_votes_lock():
+        return True
+    release_load_votes_lock()
+    return False
 
-    cache.set(LOAD_VOTES_TASK_ACTIVE_KEY, False, None)
 
+@celery_app.task(ignore_result=True, soft_time_limit=60 * 60 * 1, time_limit=60 * (60 * 1 + 5))
+def task_load_votes(snapshot_time=None, resume_claims=False):
+    """
+    Load the day's votes of every market with an active bribe, resuming
+    the day's progress records if there are any. Only one run at a time
+    holds LOAD_VOTES_LOCK_ID: two runs resuming the same checkpoints would
+    sum the same pages twice. Stopped by its soft time limit it keeps the
+    checkpoints and LOAD_VOTES_TASK_ACTIVE_KEY, and schedules a run that
+    resumes them.
+    """
+    if not acquire_load_votes_lock():
+        logger.warning('task_load_votes: another run holds the lock; aborting')
+        return
 
-@celery_app.task(ignore_result=True, soft_time_limit=60 * 60 * 8, time_limit=60 * (60 * 8 + 5))
-def task_make_trustees_snapshot(snapshot_time=None):
-    cache.set(LOAD_TRUSTORS_TASK_ACTIVE_KEY, True, LOAD_TRUSTORS_TASK_TTL)
+    cache.set(LOAD_VOTES_TASK_ACTIVE_KEY, True, LOAD_VOTES_TASK_TTL)
+    resume_pending = False
 
-    if snapshot_time is None:
-        snapshot_time = timezone.now()
+    try:
+        if snapshot_time is None:
+            snapshot_time = timezone.now()
+            snapshot_time = snapshot_time.replace(minute=0, second=0, microsecond=0)
+
+        # A rerun of an interrupted day resumes it: same tracker timestamp,
+        # and the claims snapshot its checkpoints were taken against.
+        progress = VoteSnapshotProgress.objects.filter(snapshot_time=snapshot_time.date())
+        resumed_timestamp = progress.values_list('tracker_timestamp', flat=True).first()
+        if resumed_timestamp is None:
+            if not task_make_claims_snapshot(resume=resume_claims, resume_on_timeout=False):
+                # Votes need the full claims snapshot: carry on in a new run.
+                task_load_votes.apply_async(kwargs={'resume_claims': True}, countdown=RESUME_COUNTDOWN)
+                return
+        else:
+            snapshot_time = resumed_timestamp
+
+        markets_with_active_bribes = list(AggregatedByAssetBribe.objects.filter(
+            start_at__lte=snapshot_time, stop_at__gt=snapshot_time,
+        ).values_list('market_key', flat=True).distinct())
+
+        if markets_with_active_bribes:
+            # Claimable balances of the day are the same for every market.
+            delegation_index = DelegationIndex(snapshot_time)
+            session = HostLimitedSession(max_per_host=VOTING_TRACKER_MAX_CONNECTIONS)
+            load_votes_concurrently(
+                [
+                    VotesLoader(market_key, snapshot_time, delegation_index=delegation_index, session=session)
+                    for market_key in markets_with_active_bribes
+                ],
+                max_workers=LOAD_VOTES_WORKERS,
+            )
+    except SoftTimeLimitExceeded:
+        logger.warning('task_load_votes: stopped by the time limit, votes are kept up to the checkpoints')
+        task_load_votes.apply_async(countdown=RESUME_COUNTDOWN)
+        resume_pending = True
+    finally:
+        if not resume_pending:
+            cache.set(LOAD_VOTES_TASK_ACTIVE_KEY, False, None)
+        release_load_votes_lock()
 
-    markets_with_active_bribes = AggregatedByAssetBribe.objects.filter(
-        start_at__lte=snapshot_time, stop_at__gt=snapshot_time,
-    )
 
-    assets = set()
-    for bribe in markets_with_active_bribes:
-        assets.add((bribe.asset_code, bribe.asset_issuer))
+@celery_app.task(ignore_result=True, soft_time_limit=60 * 60 * 8, time_limit=60 * (60 * 8 + 5))
+def task_make_trustees_snapshot(snapshot_time=None, resume=False):
+    """
+    Snapshot the holders of every bribe asset, or with ``resume`` continue
+    an interrupted snapshot from the loaders' checkpoints. Stopped by its
+    soft time limit it schedules a run that resumes, and keeps
+    LOAD_TRUSTORS_TASK_ACTIVE_KEY set until then: the day's holders are
+    partial, so no rewards may be paid against them.
+    """
+    cache.set(LOAD_TRUSTORS_TASK_ACTIVE_KEY, True, LOAD_TRUSTORS_TASK_TTL)
+    resume_pending = False
 
-    for asset_data in assets:
-        if not (asset_data[0] == Asset.native().code and asset_data[1] == ''):
-            asset = Asset(code=asset_data[0], issuer=asset_data[1])
+    try:
+        if snapshot_time is None:
+            snapshot_time = timezone.now()
 
-            loader = TrusteesLoader(asset)
-            loader.save_last_event_id(None)
-            loader.make_balances_spanshot()
+        markets_with_active_bribes = AggregatedByAssetBribe.objects.filter(
+            start_at__lte=snapshot_time, stop_at__gt=snapshot_time,
+        )
 
-    cache.set(LOAD_TRUSTORS_TASK_ACTIVE_KEY, False, None)
+        assets = set()
+        for bribe in markets_with_active_bribes:
+            assets.add((bribe.asset_code, bribe.asset_issuer))
+
+        snapshot_date = get_snapshot_date()
+        assets = [
+            Asset(code=asset_data[0], issuer=asset_data[1]) for asset_data in assets
+            if not (asset_data[0] == Asset.native().code and asset_data[1] == '')
+        ]
+
+        if not resume:
+            AssetHolderBitmap.objects.filter(snapshot_date=snapshot_date).delete()
+
+        if settings.TRUSTEES_LEDGER_ARCHIVE_PATH:
+            # One pass over the local ledger state, nothing to resume.
+            LedgerDumpTrusteesLoader.from_archive(
+                assets, settings.TRUSTEES_LEDGER_ARCHIVE_PATH, snapshot_date=snapshot_date,
+            ).make_balances_spanshot()
+        else:
+            pager = HorizonPager(rate_limiter=RateLimiter(TRUSTEES_HORIZON_REQUESTS_PER_SECOND))
+            loaders = []
+            for asset in assets:
+                loaders.extend(TrusteesLoader.sharded(asset, pager=pager))
+
+            if not resume:
+                for loader in loaders:
+                    loader.save_last_event_id(None)
+            make_balances_snapshot_concurrently(loaders, max_workers=LOAD_TRUSTEES_WORKERS)
+
+        for asset in assets:
+            AssetHolderInterval.objects.sync(asset.code, asset.issuer, snapshot_date)
+            store_asset_holders(asset.code, asset.issuer, snapshot_date)
+            # The day's rows were only staging for the intervals.
+            TrusteesLoader(asset, snapshot_date=snapshot_date).reset()
+    except SoftTimeLimitExceeded:
+        logger.warning('task_make_trustees_snapshot: stopped by the time limit, holders are kept up to the checkpoints')
+        task_make_trustees_snapshot.apply_async(kwargs={'resume': True}, countdown=RESUME_COUNTDOWN)
+        resume_pending = True
+    except HorizonUnavailable as error:
+        logger.warning('task_make_trustees_snapshot: stopped, holders are kept up to the checkpoints, %s', error)
+        task_make_trustees_snapshot.apply_async(kwargs={'resume': True}, countdown=HORIZON_UNAVAILABLE_COUNTDOWN)
+        resume_pending = True
+    finally:
+        if not resume_pending:
+            cache.set(LOAD_TRUSTORS_TASK_ACTIVE_KEY, False, None)
 
 
 @celery_app.task(
@@ -137,32 +332,51 @@ def task_pay_rewards(snapshot_time=None, reward_period=DEFAULT_REWARD_PERIOD):
 
     try:
         stop_at = timezone.now() + PAYREWARD_TIME_LIMIT
+        # Holders are looked up once per asset for all the bribes.
         asset_holder_cache = {}
 
         if snapshot_time is None:
             snapshot_time = timezone.now()
             snapshot_time = snapshot_time.replace(minute=0, second=0, microsecond=0)
 
+        purge_payable_votes(snapshot_time.date())
+
         reward_wallet = SecuredWallet(
             public_key=settings.BRIBE_WALLET_ADDRESS,
             secret=settings.BRIBE_WALLET_SIGNER,
         )
 
-        active_bribes = AggregatedByAssetBribe.objects.filter(
+        active_bribes = list(AggregatedByAssetBribe.objects.filter(
             start_at__lte=snapshot_time, stop_at__gt=snapshot_time,
+        ))
+        reward_amounts = {
+            bribe.pk: bribe.daily_amount * Decimal(reward_period.total_seconds() / (24 * 3600))
+            for bribe in active_bribes
+        }
+        # One grouped query instead of an aggregate per bribe.
+        eligibility_totals = get_eligibility_totals(
+            active_bribes, snapshot_time.date(), reward_amounts=reward_amounts, asset_holder_cache=asset_holder_cache,
         )
 
         for bribe in active_bribes:
-            reward_amount = bribe.daily_amount * Decimal(reward_period.total_seconds() / (24 * 3600))
+            reward_amount = reward_amounts[bribe.pk]
             votes, total_votes = get_payable_votes(
                 bribe,
                 snapshot_time.date(),
                 reward_amount=reward_amount,
                 asset_holder_cache=asset_holder_cache,
+                eligibility=eligibility_totals[bribe.pk],
+            )
+            # Evaluated once; the payer walks these votes on every page.
+            votes = materialize_payable_votes(
+                bribe, snapshot_time.date(), votes, total_votes, reward_amount=reward_amount,
             )
 
             if votes.count() > 0:
-                reward_payer = RewardPayer(bribe, reward_wallet, bribe.asset, reward_amount, stop_at=stop_at)
+                reward_payer = RewardPayer(
+                    bribe, reward_wallet, bribe.asset, reward_amount,
+                    stop_at=stop_at, payouts_since=snapshot_time.replace(hour=0),
+                )
                 reward_payer.pay_reward(votes, total_votes=total_votes)
     finally:
         # Only release the lock if we still own it — otherwise a stale
@@ -170,3 +384,11 @@ def task_pay_rewards(snapshot_time=None, reward_period=DEFAULT_REWARD_PERIOD):
         # by the next worker.
         if cache.get(PAY_REWARDS_TASK_ACTIVE_KEY) == owner_token:
             cache.delete(PAY_REWARDS_TASK_ACTIVE_KEY)
+
+
+@celery_app.task(ignore_result=True, soft_time_limit=60 * 10, time_limit=60 * 15)
+def task_ensure_partitions(months_ahead=PARTITION_MONTHS_AHEAD):
+    for partitioning in PARTITIONED_TABLES.values():
+        created = partitioning.ensure_partitions(months_ahead=months_ahead)
+        if created:
+            logger.info('Created partitions %s', ', '.join(created))
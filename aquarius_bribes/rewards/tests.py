@@ -1,33 +1,95 @@
+import gzip
 import io
+import json
+import os
+import struct
+import tempfile
+import threading
 from datetime import date, datetime, time, timedelta
 from decimal import ROUND_DOWN, ROUND_UP, Decimal
 from unittest import mock
 
 from django.conf import settings
+from django.core.cache import cache
 from django.core.management import CommandError, call_command
-from django.db import models
+from django.db import connection, models
 from django.test import TestCase, override_settings
+from django.test.utils import CaptureQueriesContext
 from django.utils import timezone
 
 import requests
+from billiard.exceptions import SoftTimeLimitExceeded
 from constance import config
 from stellar_sdk import Asset, Claimant, ClaimPredicate, Keypair, Server, TransactionBuilder
-from stellar_sdk.exceptions import BaseHorizonError
+from stellar_sdk import xdr as stellar_xdr
+from stellar_sdk.client.response import Response as HorizonResponse
+from stellar_sdk.exceptions import BadRequestError, BadResponseError, BaseHorizonError, NotFoundError
 
 from aquarius_bribes.bribes.models import AggregatedByAssetBribe, Bribe, MarketKey
 from aquarius_bribes.bribes.tasks import task_aggregate_bribes, load_market_key_details
-from aquarius_bribes.rewards.eligibility import get_payable_votes
-from aquarius_bribes.rewards.models import AssetHolderBalanceSnapshot, ClaimableBalance, Payout, VoteSnapshot
+from aquarius_bribes.rewards.api import RunVotesSnapshotAPIView
+from aquarius_bribes.rewards.archive import ArchiveVerificationError, ColumnarArchive
+from aquarius_bribes.rewards.bulk_load import CopyLoader
+from aquarius_bribes.rewards.claim_loader import ClaimLoader, load_claims_concurrently
+from aquarius_bribes.rewards.claims_sync import LiveClaimsSync
+from aquarius_bribes.rewards.eligibility import (
+    get_asset_holders,
+    get_eligibility_totals,
+    get_min_votes_value,
+    get_payable_votes,
+    materialize_payable_votes,
+    purge_payable_votes,
+    store_asset_holders,
+)
+from aquarius_bribes.rewards.ledger_dump import LedgerDumpTrusteesLoader
+from aquarius_bribes.rewards.models import (
+    Account,
+    AssetHolderBalanceSnapshot,
+    AssetHolderBalanceStaging,
+    AssetHolderBitmap,
+    AssetHolderInterval,
+    ClaimableBalance,
+)
+from aquarius_bribes.rewards.models import Claimant as BalanceClaimant
+from aquarius_bribes.rewards.models import (
+    LiveClaimableBalance,
+    PayableVote,
+    PayableVoteSet,
+    Payout,
+    VoteSnapshot,
+    VoteSnapshotArchive,
+    VoteSnapshotProgress,
+    get_snapshot_date,
+)
+from aquarius_bribes.rewards.partitions import PARTITIONED_TABLES, add_months, month_start
 from aquarius_bribes.rewards.reward_payer import RewardPayer
 from aquarius_bribes.rewards.tasks import (
+    LOAD_TRUSTORS_TASK_ACTIVE_KEY,
+    LOAD_VOTES_LOCK_ID,
+    LOAD_VOTES_TASK_ACTIVE_KEY,
+    is_load_votes_running,
     task_load_votes,
     task_make_claims_snapshot,
     task_make_trustees_snapshot,
     task_pay_rewards,
 )
+from aquarius_bribes.rewards.trustees_loader import (
+    ACCOUNT_ID_PREFIXES,
+    TrusteesLoader,
+    account_id_ranges,
+    make_balances_snapshot_concurrently,
+)
 from aquarius_bribes.rewards.utils import SecuredWallet
-from aquarius_bribes.rewards.votes_loader import VotesLoader
+from aquarius_bribes.rewards.votes_loader import (
+    DelegationIndex,
+    VotesLoader,
+    load_votes_concurrently,
+    split_delegated_votes,
+)
 from aquarius_bribes.utils.assets import get_asset_string
+from aquarius_bribes.utils.bitmaps import IdBitmap
+from aquarius_bribes.utils.horizon import HorizonPager, HorizonUnavailable
+from aquarius_bribes.utils.http import RateLimiter
 
 random_asset_issuer = Keypair.random()
 bribe_wallet = Keypair.random()
@@ -356,6 +418,7 @@ class BribesTests(TestCase):
         response = self.server.submit_transaction(transaction_envelope)
         self.assertEqual(response['successful'], True)
 
+        Account.objects.assign_refs(votes)
         VoteSnapshot.objects.bulk_create(votes)
 
         start_at = timezone.now()
@@ -431,6 +494,7 @@ class BribesTests(TestCase):
         response = self.server.submit_transaction(transaction_envelope)
         self.assertEqual(response['successful'], True)
 
+        Account.objects.assign_refs(votes)
         VoteSnapshot.objects.bulk_create(votes)
 
         start_at = timezone.now()
@@ -486,8 +550,7 @@ class BribesTests(TestCase):
         )
         bribe.save()
         task_make_trustees_snapshot()
-        holders_before = AssetHolderBalanceSnapshot.objects.count()
-        AssetHolderBalanceSnapshot.objects.all().delete()
+        holders_before = AssetHolderInterval.objects.as_of(get_snapshot_date()).count()
 
         claims_before = ClaimableBalance.objects.count()
 
@@ -592,7 +655,10 @@ class BribesTests(TestCase):
         self.assertEqual(claims_before, ClaimableBalance.objects.count() - (3 + 1))  # 3 delegations + 1 delegated vote
 
         task_make_trustees_snapshot()
-        self.assertEqual(AssetHolderBalanceSnapshot.objects.count() - holders_before, 13 + 1)  # 13 votes + bribe wallet
+        # 13 votes + bribe wallet
+        self.assertEqual(
+            AssetHolderInterval.objects.as_of(get_snapshot_date()).count() - holders_before, 13 + 1,
+        )
 
         def vote_loading_mock(self, page):
             if page and page > 1:
@@ -646,8 +712,7 @@ class BribesTests(TestCase):
         claims_before = ClaimableBalance.objects.count()
         ClaimableBalance.objects.all().delete()
         task_make_trustees_snapshot()
-        holders_before = AssetHolderBalanceSnapshot.objects.count()
-        AssetHolderBalanceSnapshot.objects.all().delete()
+        holders_before = AssetHolderInterval.objects.as_of(get_snapshot_date()).count()
 
         votes = []
         accounts = []
@@ -786,7 +851,10 @@ class BribesTests(TestCase):
         self.assertEqual(claims_before, ClaimableBalance.objects.count() - (10 + 3 + 1 + 1))  # 10 votes + 3 delegations + 1 delegated vote
 
         task_make_trustees_snapshot()
-        self.assertEqual(AssetHolderBalanceSnapshot.objects.count() - holders_before, 13 + 1)  # 13 votes + bribe wallet
+        # 13 votes + bribe wallet
+        self.assertEqual(
+            AssetHolderInterval.objects.as_of(get_snapshot_date()).count() - holders_before, 13 + 1,
+        )
 
         def vote_loading_mock(self, page):
             if page and page > 1:
@@ -837,8 +905,7 @@ class BribesTests(TestCase):
         bribe.save()
 
         task_make_trustees_snapshot()
-        holders_before = AssetHolderBalanceSnapshot.objects.count()
-        AssetHolderBalanceSnapshot.objects.all().delete()
+        holders_before = AssetHolderInterval.objects.as_of(get_snapshot_date()).count()
 
         builder = self._get_builder(self.account_1)
 
@@ -948,7 +1015,9 @@ class BribesTests(TestCase):
         )
 
         task_make_trustees_snapshot()
-        self.assertEqual(AssetHolderBalanceSnapshot.objects.count() - holders_before, 14)
+        self.assertEqual(
+            AssetHolderInterval.objects.as_of(get_snapshot_date()).count() - holders_before, 14,
+        )
 
         def vote_loading_mock(self, page):
             if page and page > 1:
@@ -1007,8 +1076,7 @@ class BribesTests(TestCase):
         claims_before = ClaimableBalance.objects.count()
         ClaimableBalance.objects.all().delete()
         task_make_trustees_snapshot()
-        holders_before = AssetHolderBalanceSnapshot.objects.count()
-        AssetHolderBalanceSnapshot.objects.all().delete()
+        holders_before = AssetHolderInterval.objects.as_of(get_snapshot_date()).count()
 
         votes = []
         accounts = []
@@ -1150,7 +1218,10 @@ class BribesTests(TestCase):
         self.assertEqual(claims_before, ClaimableBalance.objects.count() - (10 + 3 + 1 + 1))  # 10 votes + 3 delegations + 1 delegated vote
 
         task_make_trustees_snapshot()
-        self.assertEqual(AssetHolderBalanceSnapshot.objects.count() - holders_before, 13 + 1)  # 13 votes + bribe wallet
+        # 13 votes + bribe wallet
+        self.assertEqual(
+            AssetHolderInterval.objects.as_of(get_snapshot_date()).count() - holders_before, 13 + 1,
+        )
 
         def vote_loading_mock(self, page):
             if page and page > 1:
@@ -1205,8 +1276,7 @@ class BribesTests(TestCase):
         claims_before = ClaimableBalance.objects.count()
         ClaimableBalance.objects.all().delete()
         task_make_trustees_snapshot()
-        holders_before = AssetHolderBalanceSnapshot.objects.count()
-        AssetHolderBalanceSnapshot.objects.all().delete()
+        holders_before = AssetHolderInterval.objects.as_of(get_snapshot_date()).count()
 
         votes = []
         accounts = []
@@ -1352,8 +1422,7 @@ class BribesTests(TestCase):
         claims_before = ClaimableBalance.objects.count()
         ClaimableBalance.objects.all().delete()
         task_make_trustees_snapshot()
-        holders_before = AssetHolderBalanceSnapshot.objects.count()
-        AssetHolderBalanceSnapshot.objects.all().delete()
+        holders_before = AssetHolderInterval.objects.as_of(get_snapshot_date()).count()
 
         votes_2 = []
         accounts_2 = []
@@ -1490,7 +1559,10 @@ class BribesTests(TestCase):
         self.assertEqual(claims_before, ClaimableBalance.objects.count() - (10 + 3 + 1 + 1) * 2)  # 10 votes + 3 delegations + 1 delegated vote
 
         task_make_trustees_snapshot()
-        self.assertEqual(AssetHolderBalanceSnapshot.objects.count() - holders_before, 26 + 1)  # 13 votes + bribe wallet
+        # 13 votes + bribe wallet
+        self.assertEqual(
+            AssetHolderInterval.objects.as_of(get_snapshot_date()).count() - holders_before, 26 + 1,
+        )
 
         def vote_loading_mock(self, page):
             if page and page > 1:
@@ -1859,6 +1931,116 @@ class RewardPayerResilienceTests(TestCase):
         self.assertEqual(returned_votes.count(), len(regular_votes))
         self.assertNotIn(dust_vote.id, returned_votes.values_list("id", flat=True))
 
+    def test_eligibility_totals_match_payable_votes(self):
+        snapshot_date = timezone.now().date()
+        issuer = Keypair.random().public_key
+        market = self._make_market()
+        other_market = self._make_market()
+        native_bribe = self._make_bribe(
+            market, asset_code=Asset.native().code, asset_issuer="", total=Decimal("0.0007000"),
+        )
+        self._make_dust_votes(market, snapshot_date)
+        bribes = [native_bribe]
+        for bribe_market in (market, other_market):
+            bribes.append(AggregatedByAssetBribe.objects.create(
+                market_key=bribe_market,
+                asset_code="AQUA",
+                asset_issuer=issuer,
+                start_at=timezone.now() - timedelta(hours=1),
+                stop_at=timezone.now() + timedelta(hours=1),
+                total_reward_amount=Decimal("700"),
+            ))
+        holder = VoteSnapshot.objects.filter(market_key=market, snapshot_time=snapshot_date).first()
+        self._make_holder(holder.voting_account, "AQUA", issuer, self._at(snapshot_date, 12))
+        self._make_vote(other_market, Keypair.random().public_key, snapshot_date, "5")
+        empty_bribe = self._make_bribe(self._make_market(), asset_code=Asset.native().code, asset_issuer="")
+        bribes.append(empty_bribe)
+
+        reward_amounts = {bribe.pk: bribe.daily_amount for bribe in bribes}
+        holders_cache = {}
+        with self.assertNumQueries(3):
+            # Unfinished markets, the legacy rows check of the shared asset
+            # once, then the grouped query joining the holders.
+            totals = get_eligibility_totals(
+                bribes, snapshot_date, reward_amounts=reward_amounts, asset_holder_cache=holders_cache,
+            )
+
+        for bribe in bribes:
+            votes, total_votes = get_payable_votes(bribe, snapshot_date, reward_amount=reward_amounts[bribe.pk])
+            self.assertEqual(totals[bribe.pk][0], total_votes)
+            if total_votes is not None:
+                self.assertEqual(
+                    totals[bribe.pk][1], get_min_votes_value(total_votes, reward_amounts[bribe.pk]),
+                )
+            with self.assertNumQueries(0):
+                batched_votes, batched_total = get_payable_votes(
+                    bribe, snapshot_date, reward_amount=reward_amounts[bribe.pk],
+                    eligibility=totals[bribe.pk], asset_holder_cache=holders_cache,
+                )
+            self.assertEqual(batched_total, total_votes)
+            self.assertEqual(
+                sorted(batched_votes.values_list("id", flat=True)), sorted(votes.values_list("id", flat=True)),
+            )
+        self.assertIsNotNone(totals[native_bribe.pk][0])
+        self.assertEqual(totals[bribes[1].pk][0], holder.votes_value)
+        self.assertEqual(totals[bribes[2].pk], (None, None))
+        self.assertEqual(totals[empty_bribe.pk], (None, None))
+
+    def test_materialized_payable_votes_match_eligibility(self):
+        snapshot_date = timezone.now().date()
+        market = self._make_market()
+        bribe = self._make_bribe(
+            market,
+            asset_code=Asset.native().code,
+            asset_issuer="",
+            total=Decimal("0.0007000"),
+        )
+        regular_votes, dust_vote = self._make_dust_votes(market, snapshot_date)
+
+        votes, total_votes = get_payable_votes(bribe, snapshot_date, reward_amount=bribe.daily_amount)
+        expected = sorted(votes.values_list("id", flat=True))
+        materialized = materialize_payable_votes(
+            bribe, snapshot_date, votes, total_votes, reward_amount=bribe.daily_amount,
+        )
+
+        self.assertEqual(sorted(materialized.values_list("id", flat=True)), expected)
+        self.assertNotIn(dust_vote.id, expected)
+        payable_set = PayableVoteSet.objects.get(bribe=bribe, snapshot_date=snapshot_date)
+        self.assertEqual(payable_set.total_votes, total_votes)
+        self.assertIsNotNone(payable_set.min_votes_value)
+
+        # A rerun replaces the stored votes instead of adding to them.
+        regular_votes[0].delete()
+        votes, total_votes = get_payable_votes(bribe, snapshot_date, reward_amount=bribe.daily_amount)
+        materialize_payable_votes(bribe, snapshot_date, votes, total_votes, reward_amount=bribe.daily_amount)
+        self.assertEqual(PayableVoteSet.objects.count(), 1)
+        self.assertEqual(PayableVote.objects.count(), len(expected) - 1)
+
+        materialize_payable_votes(bribe, snapshot_date, VoteSnapshot.objects.none(), Decimal("0"))
+        self.assertEqual(PayableVote.objects.count(), 0)
+
+    def test_payable_votes_of_earlier_days_are_purged(self):
+        snapshot_date = timezone.now().date()
+        market = self._make_market()
+        bribe = self._make_bribe(
+            market,
+            asset_code=Asset.native().code,
+            asset_issuer="",
+            total=Decimal("0.0007000"),
+        )
+        self._make_dust_votes(market, snapshot_date)
+        votes, total_votes = get_payable_votes(bribe, snapshot_date, reward_amount=bribe.daily_amount)
+        expected = sorted(votes.values_list("id", flat=True))
+        materialize_payable_votes(bribe, snapshot_date, votes, total_votes, reward_amount=bribe.daily_amount)
+        materialize_payable_votes(
+            bribe, snapshot_date - timedelta(days=1), votes, total_votes, reward_amount=bribe.daily_amount,
+        )
+
+        purge_payable_votes(snapshot_date)
+
+        self.assertEqual(list(PayableVoteSet.objects.values_list("snapshot_date", flat=True)), [snapshot_date])
+        self.assertEqual(sorted(PayableVote.objects.values_list("vote_snapshot_id", flat=True)), expected)
+
     def _make_rewardpayer_with_mocked_server(self, bribe, mock_server):
         wallet = SecuredWallet(public_key="G" + "A" * 55, secret="S" + "A" * 55)
         payer = RewardPayer(bribe, wallet, bribe.asset, Decimal("100"), stop_at=None)
@@ -2224,9 +2406,11 @@ class RewardPayerResilienceTests(TestCase):
 
         calls = []
 
-        def spy_gpv(bribe, snap_date, reward_amount=None, asset_holder_cache=None):
+        def spy_gpv(bribe, snap_date, reward_amount=None, asset_holder_cache=None, **kwargs):
             calls.append(asset_holder_cache)
-            return real_gpv(bribe, snap_date, reward_amount=reward_amount, asset_holder_cache=asset_holder_cache)
+            return real_gpv(
+                bribe, snap_date, reward_amount=reward_amount, asset_holder_cache=asset_holder_cache, **kwargs,
+            )
 
         with mock.patch("aquarius_bribes.rewards.tasks.get_payable_votes", side_effect=spy_gpv):
             with mock.patch("aquarius_bribes.rewards.tasks.SecuredWallet"):
@@ -2241,6 +2425,33 @@ class RewardPayerResilienceTests(TestCase):
         for c in calls[1:]:
             self.assertIs(c, first_cache)
 
+    def test_task_pay_rewards_skips_markets_not_completely_loaded(self):
+        snapshot_date = timezone.now().date()
+        markets = [self._make_market() for _ in range(3)]
+        bribes = [
+            self._make_bribe(market, asset_code=Asset.native().code, start=timezone.now() - timedelta(hours=1))
+            for market in markets
+        ]
+        for market in markets:
+            self._make_vote(market, Keypair.random().public_key, snapshot_date, "1000")
+        for market, status in zip(markets, (VoteSnapshotProgress.STATUS_FAILED, VoteSnapshotProgress.STATUS_DONE)):
+            VoteSnapshotProgress.objects.create(
+                snapshot_time=snapshot_date, market_key=market, tracker_timestamp=timezone.now(), status=status,
+            )
+
+        failed_votes, failed_total = get_payable_votes(bribes[0], snapshot_date)
+        self.assertEqual((failed_votes.count(), failed_total), (0, None))
+        self.assertEqual(get_eligibility_totals(bribes, snapshot_date)[bribes[0].pk], (None, None))
+
+        with mock.patch("aquarius_bribes.rewards.tasks.SecuredWallet"), \
+                mock.patch("aquarius_bribes.rewards.tasks.RewardPayer") as reward_payer:
+            task_pay_rewards()
+
+        # The market without a progress row was loaded before progress was tracked.
+        self.assertEqual(
+            sorted(call.args[0].pk for call in reward_payer.call_args_list), [bribes[1].pk, bribes[2].pk],
+        )
+
     def test_unknown_response_failed_payouts_remain_retryable(self):
         # X6: a failed Payout with message='unknown_response_no_successful_field'
         # must be included in the retryable set — the next _clean_rewards call
@@ -2702,3 +2913,1455 @@ class RewardPayerResilienceTests(TestCase):
         self.assertEqual(payout.status, Payout.STATUS_SUCCESS)
         self.assertEqual(payout.message, "reverified_after_timeout")
 
+
+class PartitioningTests(TestCase):
+    def setUp(self):
+        self.partitioning = PARTITIONED_TABLES['payout']
+        self.market = MarketKey.objects.create(market_key=Keypair.random().public_key)
+        self.bribe = AggregatedByAssetBribe.objects.create(
+            market_key=self.market,
+            asset_code=Asset.native().code,
+            asset_issuer='',
+            start_at=timezone.now() - timedelta(days=1),
+            stop_at=timezone.now() + timedelta(days=6),
+            total_reward_amount=Decimal('700'),
+        )
+        self.vote = VoteSnapshot.objects.create(
+            market_key=self.market,
+            voting_account=Keypair.random().public_key,
+            votes_value=Decimal('100'),
+            snapshot_time=timezone.now().date(),
+        )
+
+    def _make_payout(self, created_at=None):
+        payout = Payout.objects.create(
+            bribe=self.bribe,
+            vote_snapshot=self.vote,
+            stellar_transaction_id='hash',
+            reward_amount=Decimal('1'),
+            asset_code=Asset.native().code,
+            asset_issuer='',
+        )
+        if created_at is not None:
+            Payout.objects.filter(pk=payout.pk).update(created_at=created_at)
+        return payout
+
+    def _count_rows(self, table):
+        with connection.cursor() as cursor:
+            cursor.execute('SELECT count(*) FROM "{0}"'.format(table))
+            return cursor.fetchone()[0]
+
+    def test_migration_creates_current_partitions(self):
+        names = {partition.name for partition in self.partitioning.get_partitions()}
+        current = month_start(timezone.now().date())
+
+        self.assertIn(self.partitioning.default_partition, names)
+        for offset in range(3):
+            self.assertIn(self.partitioning.partition_name(add_months(current, offset)), names)
+
+        self._make_payout()
+        self.assertEqual(self._count_rows(self.partitioning.partition_name(current)), 1)
+
+    def test_vote_snapshots_are_partitioned_by_snapshot_month(self):
+        partitioning = PARTITIONED_TABLES['votesnapshot']
+        current = month_start(timezone.now().date())
+
+        self.assertEqual(self._count_rows(partitioning.partition_name(current)), 1)
+        self.assertIn(
+            partitioning.partition_name(current),
+            VoteSnapshot.objects.filter(snapshot_time=self.vote.snapshot_time).explain(),
+        )
+
+    def test_archive_vote_snapshots_keeps_payouts_auditable(self):
+        old_date = add_months(month_start(timezone.now().date()), -2)
+        old_vote = VoteSnapshot.objects.create(
+            market_key=self.market,
+            voting_account=Keypair.random().public_key,
+            votes_value=Decimal('250'),
+            snapshot_time=old_date,
+        )
+        payout = Payout.objects.create(
+            bribe=self.bribe,
+            vote_snapshot=old_vote,
+            stellar_transaction_id='hash',
+            reward_amount=Decimal('1'),
+            asset_code=Asset.native().code,
+            asset_issuer='',
+        )
+
+        out = io.StringIO()
+        call_command('archive_vote_snapshots', '--keep-months', '1', stdout=out)
+
+        self.assertEqual(out.getvalue(), 'Archived rewards_votesnapshot_legacy: 1 rows\n')
+        self.assertFalse(VoteSnapshot.objects.filter(pk=old_vote.pk).exists())
+        self.assertTrue(VoteSnapshot.objects.filter(pk=self.vote.pk).exists())
+
+        archived = VoteSnapshotArchive.objects.get(pk=old_vote.pk)
+        self.assertEqual(archived.voting_account, old_vote.voting_account)
+        self.assertEqual(archived.votes_value, Decimal('250'))
+        self.assertEqual(archived.snapshot_time, old_date)
+
+        payout = Payout.objects.get(pk=payout.pk)
+        self.assertEqual(payout.get_vote_snapshot(), archived)
+        self.assertIn(old_vote.voting_account, str(payout))
+
+    def test_create_partition_moves_rows_from_default(self):
+        month = add_months(month_start(timezone.now().date()), 6)
+        payout = self._make_payout(
+            created_at=timezone.make_aware(datetime.combine(month, time(hour=12))),
+        )
+        self.assertEqual(self._count_rows(self.partitioning.default_partition), 1)
+
+        created = self.partitioning.ensure_partitions(months_ahead=6)
+
+        self.assertIn(self.partitioning.partition_name(month), created)
+        self.assertEqual(self._count_rows(self.partitioning.default_partition), 0)
+        self.assertEqual(self._count_rows(self.partitioning.partition_name(month)), 1)
+        self.assertTrue(Payout.objects.filter(pk=payout.pk).exists())
+        self.assertEqual(self.partitioning.ensure_partitions(months_ahead=6), [])
+
+    def test_create_partition_leaves_empty_default_attached(self):
+        current = month_start(timezone.now().date())
+        self._make_payout(created_at=timezone.make_aware(datetime.combine(add_months(current, 9), time(hour=12))))
+
+        with CaptureQueriesContext(connection) as queries:
+            created = self.partitioning.ensure_partitions()
+
+        self.assertEqual(created, [
+            self.partitioning.partition_name(add_months(current, offset)) for offset in range(3, 7)
+        ])
+        self.assertFalse([query['sql'] for query in queries if 'DETACH' in query['sql']])
+        # The row of a month not created yet stays in DEFAULT.
+        self.assertEqual(self._count_rows(self.partitioning.default_partition), 1)
+        self._make_payout(created_at=timezone.make_aware(datetime.combine(add_months(current, 6), time(hour=12))))
+        self.assertEqual(self._count_rows(self.partitioning.partition_name(add_months(current, 6))), 1)
+
+    def test_detach_and_attach_partitions_command(self):
+        current = month_start(timezone.now().date())
+        old_payout = self._make_payout(created_at=timezone.now() - timedelta(days=40))
+
+        out = io.StringIO()
+        call_command(
+            'manage_partitions', 'detach', '--table', 'payout', '--before', current.strftime('%Y-%m'), stdout=out,
+        )
+
+        # Everything before the first monthly partition lives in the old table.
+        self.assertEqual(out.getvalue(), 'Detached rewards_payout_legacy\n')
+        self.assertFalse(Payout.objects.filter(pk=old_payout.pk).exists())
+        self.assertEqual(self._count_rows('rewards_payout_legacy'), 1)
+
+        next_month = add_months(current, 1)
+        future_payout = self._make_payout(
+            created_at=timezone.make_aware(datetime.combine(next_month, time(hour=12))),
+        )
+        self.partitioning.detach_partitions(add_months(current, 2))
+        self.assertFalse(Payout.objects.filter(pk=future_payout.pk).exists())
+
+        call_command(
+            'manage_partitions', 'attach', '--table', 'payout',
+            '--name', self.partitioning.partition_name(next_month), '--month', next_month.strftime('%Y-%m'),
+            stdout=out,
+        )
+        self.assertTrue(Payout.objects.filter(pk=future_payout.pk).exists())
+
+        with self.assertRaises(CommandError):
+            call_command('manage_partitions', 'detach', '--table', 'payout', stdout=out)
+
+    def test_reward_payer_payout_lookups_prune_old_partitions(self):
+        self._make_payout()
+        day_start = timezone.now().replace(hour=0, minute=0, second=0, microsecond=0)
+        wallet = SecuredWallet(public_key=Keypair.random().public_key, secret=None)
+        payer = RewardPayer(self.bribe, wallet, self.bribe.asset, Decimal('100'), payouts_since=day_start)
+
+        votes = VoteSnapshot.objects.filter(market_key=self.market, snapshot_time=day_start.date())
+        self.assertNotIn(self.vote, list(payer._clean_rewards(votes)))
+
+        plan = Payout.objects.filter(payer._get_payouts_filter(), bribe=self.bribe).explain()
+        self.assertNotIn('rewards_payout_legacy', plan)
+        self.assertIn(self.partitioning.partition_name(month_start(day_start.date())), plan)
+
+
+class ColumnarArchiveTests(TestCase):
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.addCleanup(self.directory.cleanup)
+        self.archive = ColumnarArchive(self.directory.name)
+
+        self.market = MarketKey.objects.create(market_key=Keypair.random().public_key)
+        self.bribe = AggregatedByAssetBribe.objects.create(
+            market_key=self.market,
+            asset_code=Asset.native().code,
+            asset_issuer='',
+            start_at=timezone.now() - timedelta(days=1),
+            stop_at=timezone.now() + timedelta(days=6),
+            total_reward_amount=Decimal('700'),
+        )
+        self.old_day = timezone.now().date() - timedelta(days=10)
+        self.accounts = [Keypair.random().public_key for _ in range(3)]
+        self.votes = [
+            VoteSnapshot.objects.create(
+                market_key=self.market,
+                voting_account=account,
+                votes_value=Decimal('100.1234567') * (index + 1),
+                snapshot_time=self.old_day,
+            )
+            for index, account in enumerate(self.accounts)
+        ]
+        self.recent_vote = VoteSnapshot.objects.create(
+            market_key=self.market,
+            voting_account=self.accounts[0],
+            votes_value=Decimal('1'),
+            snapshot_time=timezone.now().date(),
+        )
+
+    def test_votes_referenced_by_payouts_are_not_exported(self):
+        payout = Payout.objects.create(
+            bribe=self.bribe,
+            vote_snapshot=self.votes[0],
+            stellar_transaction_id='hash',
+            reward_amount=Decimal('1.5'),
+            asset_code=Asset.native().code,
+            asset_issuer='',
+        )
+        start, end = self.old_day, self.old_day + timedelta(days=1)
+
+        with self.assertRaises(CommandError):
+            call_command(
+                'export_archive', '--table', 'votesnapshot',
+                '--start', start.isoformat(), '--end', end.isoformat(), '--directory', self.directory.name,
+                stdout=io.StringIO(),
+            )
+        self.assertEqual(VoteSnapshot.objects.count(), 4)
+        self.assertEqual(self.archive.manifests(), [])
+        self.assertEqual(Payout.objects.get(pk=payout.pk).get_vote_snapshot(), self.votes[0])
+
+        # Copies can still be exported while the rows stay in place.
+        manifest = self.archive.export('votesnapshot', start, end, delete=False)
+        self.assertEqual(manifest.rows, 3)
+        self.assertEqual(VoteSnapshot.objects.count(), 4)
+
+    def test_export_payouts_and_votes_to_parquet(self):
+        payout = Payout.objects.create(
+            bribe=self.bribe,
+            vote_snapshot=self.votes[0],
+            stellar_transaction_id='hash',
+            reward_amount=Decimal('1.5'),
+            asset_code=Asset.native().code,
+            asset_issuer='',
+        )
+        Payout.objects.filter(pk=payout.pk).update(
+            created_at=timezone.make_aware(datetime.combine(self.old_day, time(hour=12))),
+        )
+        start, end = self.old_day, self.old_day + timedelta(days=1)
+
+        out = io.StringIO()
+        call_command(
+            'export_archive', '--table', 'payout', '--table', 'votesnapshot',
+            '--start', start.isoformat(), '--end', end.isoformat(), '--directory', self.directory.name,
+            stdout=out,
+        )
+
+        self.assertIn('Exported payout: 1 rows', out.getvalue())
+        self.assertIn('Exported votesnapshot: 3 rows', out.getvalue())
+        self.assertFalse(Payout.objects.filter(pk=payout.pk).exists())
+        self.assertEqual(list(VoteSnapshot.objects.all()), [self.recent_vote])
+        self.assertEqual([manifest.rows for manifest in self.archive.manifests()], [1, 3])
+
+        votes = self.archive.read('votesnapshot', start, end, filters={'voting_account': self.accounts[1]})
+        self.assertEqual(votes.num_rows, 1)
+        row = votes.to_pylist()[0]
+        self.assertEqual(row['id'], self.votes[1].pk)
+        self.assertEqual(row['votes_value'], Decimal('200.2469134'))
+        self.assertEqual(row['snapshot_time'], self.old_day)
+        self.assertEqual(row['market_key_id'], self.market.market_key)
+
+        payouts = self.archive.read('payout', start, end, columns=['id', 'vote_snapshot_id', 'reward_amount'])
+        self.assertEqual(payouts.to_pylist(), [
+            {'id': payout.pk, 'vote_snapshot_id': self.votes[0].pk, 'reward_amount': Decimal('1.5')},
+        ])
+        self.assertEqual(self.archive.read('payout', end, end + timedelta(days=1)).num_rows, 0)
+
+    @mock.patch('aquarius_bribes.rewards.archive.BATCH_SIZE', 2)
+    def test_export_holder_balances_to_arrow_in_batches(self):
+        for index, account in enumerate(self.accounts * 2):
+            snapshot = AssetHolderBalanceSnapshot.objects.create(
+                account=account,
+                asset_code='AQUA',
+                asset_issuer=random_asset_issuer.public_key,
+                balance=Decimal(index),
+            )
+            AssetHolderBalanceSnapshot.objects.filter(pk=snapshot.pk).update(
+                created_at=timezone.make_aware(datetime.combine(self.old_day, time(hour=index))),
+            )
+
+        manifest = self.archive.export(
+            'assetholderbalancesnapshot', self.old_day, self.old_day + timedelta(days=1), file_format='arrow',
+        )
+
+        self.assertEqual(manifest.rows, 6)
+        self.assertTrue(manifest.path.endswith('.arrow'))
+        self.assertFalse(AssetHolderBalanceSnapshot.objects.exists())
+
+        balances = self.archive.read(
+            'assetholderbalancesnapshot', self.old_day, self.old_day + timedelta(days=1),
+            filters={'account': self.accounts[2]}, columns=['balance'],
+        )
+        self.assertEqual(balances.column('balance').to_pylist(), [Decimal('2'), Decimal('5')])
+
+    def test_export_keeps_rows_when_verification_fails(self):
+        start, end = self.old_day, self.old_day + timedelta(days=1)
+
+        with mock.patch.object(ColumnarArchive, '_file_checksum') as file_checksum:
+            file_checksum.return_value.rows = 2
+            with self.assertRaises(ArchiveVerificationError):
+                self.archive.export('votesnapshot', start, end)
+
+        self.assertEqual(VoteSnapshot.objects.count(), 4)
+        self.assertEqual(self.archive.manifests(), [])
+
+        with self.assertRaises(ValueError):
+            self.archive.export('votesnapshot', start, timezone.now().date() + timedelta(days=1))
+
+
+class StroopAmountTests(TestCase):
+    def setUp(self):
+        self.market = MarketKey.objects.create(market_key=Keypair.random().public_key)
+        self.today = timezone.now().date()
+
+    def _make_vote(self, votes_value):
+        return VoteSnapshot.objects.create(
+            market_key=self.market,
+            voting_account=Keypair.random().public_key,
+            votes_value=votes_value,
+            snapshot_time=self.today,
+        )
+
+    def test_amounts_are_stored_as_stroops(self):
+        vote = self._make_vote(Decimal('12.3456789'))
+        self._make_vote('0.00000005')
+
+        with connection.cursor() as cursor:
+            cursor.execute('SELECT votes_value FROM rewards_votesnapshot WHERE id = %s', [vote.pk])
+            self.assertEqual(cursor.fetchone()[0], 123456789)
+
+        self.assertEqual(VoteSnapshot.objects.get(pk=vote.pk).votes_value, Decimal('12.3456789'))
+        self.assertEqual(
+            sorted(VoteSnapshot.objects.values_list('votes_value', flat=True)),
+            [Decimal('0.0000001'), Decimal('12.3456789')],
+        )
+        self.assertEqual(
+            VoteSnapshot.objects.aggregate(total=models.Sum('votes_value'))['total'],
+            Decimal('12.3456790'),
+        )
+        self.assertEqual(VoteSnapshot.objects.filter(votes_value__gte=Decimal('0.0000002')).get(), vote)
+
+
+class AccountInterningTests(TestCase):
+    def test_snapshots_reference_interned_accounts(self):
+        market = MarketKey.objects.create(market_key=Keypair.random().public_key)
+        address = Keypair.random().public_key
+        today = timezone.now().date()
+
+        vote = VoteSnapshot.objects.create(
+            market_key=market, voting_account=address, votes_value=Decimal('1'), snapshot_time=today,
+        )
+        holders = [
+            AssetHolderBalanceSnapshot(
+                account=account, asset_code='AQUA', asset_issuer=random_asset_issuer.public_key, balance=Decimal('1'),
+            )
+            for account in (address, Keypair.random().public_key)
+        ]
+        Account.objects.assign_refs(holders)
+        AssetHolderBalanceSnapshot.objects.bulk_create(holders)
+
+        account = Account.objects.get(address=address)
+        self.assertEqual(vote.voting_account_ref, account)
+        self.assertEqual(holders[0].account_ref_id, account.pk)
+        self.assertEqual(Account.objects.count(), 2)
+        self.assertEqual(Account.objects.intern([address, None]), {address: account.pk})
+
+        bribe = AggregatedByAssetBribe.objects.create(
+            market_key=market,
+            asset_code='AQUA',
+            asset_issuer=random_asset_issuer.public_key,
+            start_at=timezone.now() - timedelta(days=1),
+            stop_at=timezone.now() + timedelta(days=6),
+            total_reward_amount=Decimal('700'),
+        )
+        votes, total = get_payable_votes(bribe, today)
+        self.assertEqual(list(votes), [vote])
+        self.assertEqual(total, Decimal('1'))
+
+
+class AssetHolderBitmapTests(TestCase):
+    def test_bitmap_operations(self):
+        bitmap = IdBitmap.from_ids([9, 0, 1000, 3, None, 3])
+
+        self.assertEqual(list(bitmap), [0, 3, 9, 1000])
+        self.assertEqual(len(bitmap), 4)
+        self.assertIn(1000, bitmap)
+        self.assertNotIn(8, bitmap)
+        self.assertNotIn(5000, bitmap)
+        self.assertEqual(IdBitmap.from_bytes(bitmap.to_bytes()), bitmap)
+        self.assertEqual(list(bitmap & IdBitmap.from_ids([3, 4, 1000, 7000])), [3, 1000])
+        self.assertEqual(len(IdBitmap.from_ids([])), 0)
+
+    def test_stored_holders_match_eligibility(self):
+        market = MarketKey.objects.create(market_key=Keypair.random().public_key)
+        today = timezone.now().date()
+        voters = [Keypair.random().public_key for _ in range(3)]
+        votes = [
+            VoteSnapshot.objects.create(
+                market_key=market, voting_account=voter, votes_value=Decimal('1'), snapshot_time=today,
+            )
+            for voter in voters
+        ]
+        holders = [
+            AssetHolderBalanceSnapshot(
+                account=account, asset_code='AQUA', asset_issuer=random_asset_issuer.public_key, balance=Decimal('1'),
+            )
+            for account in voters[:2] + [Keypair.random().public_key]
+        ]
+        Account.objects.assign_refs(holders)
+        AssetHolderBalanceSnapshot.objects.bulk_create(holders)
+        bribe = AggregatedByAssetBribe.objects.create(
+            market_key=market,
+            asset_code='AQUA',
+            asset_issuer=random_asset_issuer.public_key,
+            start_at=timezone.now() - timedelta(days=1),
+            stop_at=timezone.now() + timedelta(days=6),
+            total_reward_amount=Decimal('700'),
+        )
+
+        stored = store_asset_holders('AQUA', random_asset_issuer.public_key, today)
+        self.assertEqual(AssetHolderBitmap.objects.get().holders, 3)
+
+        cache = {}
+        eligible, total = get_payable_votes(bribe, today, asset_holder_cache=cache)
+        self.assertEqual(sorted(eligible, key=lambda vote: vote.pk), votes[:2])
+        self.assertEqual(total, Decimal('2'))
+        self.assertEqual(set(stored) & {vote.voting_account_ref_id for vote in votes}, {
+            vote.voting_account_ref_id for vote in votes[:2]
+        })
+        # Holders are joined in the database rather than sent as parameters.
+        self.assertIn(('AQUA', random_asset_issuer.public_key, today), cache)
+        self.assertIn(AssetHolderBalanceSnapshot._meta.db_table, str(eligible.query))
+
+
+@override_settings(DELEGATABLE_ASSETS=DELEGATABLE_ASSETS)
+class DelegationIndexTests(TestCase):
+    def setUp(self):
+        self.market_key = MarketKey.objects.create(market_key=Keypair.random().public_key).market_key
+        self.snapshot_time = timezone.now().replace(minute=0, second=0, microsecond=0)
+        self.delegated_asset, self.delegation_asset = DELEGATABLE_ASSETS[0]
+        self.not_unconditional = ClaimPredicate.predicate_not(
+            ClaimPredicate.predicate_unconditional()
+        ).to_xdr_object().to_xdr()
+        self.unconditional = ClaimPredicate.predicate_unconditional().to_xdr_object().to_xdr()
+
+    def _create_claimable_balance(self, owner, asset, amount, claimants):
+        balance = ClaimableBalance.objects.create(
+            claimable_balance_id=Keypair.random().public_key,
+            asset_code=asset.code,
+            asset_issuer=asset.issuer,
+            amount=Decimal(amount),
+            sponsor=owner,
+            paging_token='',
+            last_modified_time=timezone.now(),
+            last_modified_ledger=1,
+            owner=owner,
+        )
+        for destination, raw_predicate in claimants:
+            balance.claimants.create(destination=destination, raw_predicate=raw_predicate)
+        return balance
+
+    def _delegate_to(self, delegator, delegate, amount, markers=1):
+        self._create_claimable_balance(
+            owner=delegator,
+            asset=self.delegated_asset,
+            amount=amount,
+            claimants=[(delegate, self.not_unconditional)] + [
+                (settings.DELEGATE_MARKER, self.not_unconditional),
+            ] * markers,
+        )
+
+    def test_index_matches_per_voter_queries(self):
+        delegate = Keypair.random().public_key
+        delegator_1 = Keypair.random().public_key
+        delegator_2 = Keypair.random().public_key
+        self._create_claimable_balance(
+            owner=delegate,
+            asset=self.delegation_asset,
+            amount='300',
+            claimants=[(self.market_key, self.unconditional)],
+        )
+        self._delegate_to(delegator_1, delegate, '120')
+        self._delegate_to(delegator_1, delegate, '60')
+        # Two marker claimants used to match the balance twice in the join.
+        self._delegate_to(delegator_2, delegate, '40', markers=2)
+
+        index = DelegationIndex(self.snapshot_time)
+
+        self.assertTrue(index.has_delegated_votes(delegate, self.market_key))
+        self.assertFalse(index.has_delegated_votes(delegator_1, self.market_key))
+        self.assertFalse(index.has_delegated_votes(delegate, Keypair.random().public_key))
+        self.assertEqual(index.amount_delegated_votes(delegate, self.market_key), Decimal('300'))
+        self.assertEqual(index.amount_delegated_votes(delegator_1, self.market_key), Decimal('0'))
+        self.assertEqual(sorted(index.get_delegations(delegate)), sorted([
+            (delegator_1, Decimal('120')),
+            (delegator_1, Decimal('60')),
+            (delegator_2, Decimal('40')),
+            (delegator_2, Decimal('40')),
+        ]))
+        self.assertEqual(index.get_delegations(delegator_1), [])
+
+    def test_index_reads_claims_of_snapshot_day(self):
+        delegate = Keypair.random().public_key
+        delegator = Keypair.random().public_key
+        self._delegate_to(delegator, delegate, '10')
+        stale = self._create_claimable_balance(
+            owner=delegate,
+            asset=self.delegation_asset,
+            amount='300',
+            claimants=[(self.market_key, self.unconditional)],
+        )
+
+        claimant = stale.claimants.get()
+        self.assertEqual(claimant.predicate_kind, BalanceClaimant.PREDICATE_UNCONDITIONAL)
+        self.assertEqual(claimant.snapshot_date, stale.snapshot_date)
+        self.assertEqual(
+            set(BalanceClaimant.objects.filter(
+                claimable_balance__owner=delegator,
+            ).values_list('predicate_kind', flat=True)),
+            {BalanceClaimant.PREDICATE_NOT_UNCONDITIONAL},
+        )
+
+        ClaimableBalance.objects.filter(pk=stale.pk).update(snapshot_date=stale.snapshot_date - timedelta(days=1))
+        BalanceClaimant.objects.filter(claimable_balance=stale).update(
+            snapshot_date=stale.snapshot_date - timedelta(days=1),
+        )
+
+        index = DelegationIndex(self.snapshot_time)
+        self.assertFalse(index.has_delegated_votes(delegate, self.market_key))
+        self.assertEqual(index.get_delegations(delegate), [(delegator, Decimal('10'))])
+
+    def test_grouped_split_matches_per_delegation_rounding(self):
+        owners = [Keypair.random().public_key for _ in range(4)]
+        delegations = [
+            (owners[0], Decimal('1')), (owners[0], Decimal('1')), (owners[0], Decimal('2.0000003')),
+            (owners[1], Decimal('3.3333333')), (owners[1], Decimal('3.3333333')), (owners[1], Decimal('3.3333333')),
+            (owners[2], Decimal('0.0000001')), (owners[3], Decimal('777.7777777')),
+        ]
+        index = DelegationIndex(self.snapshot_time)
+        index.delegations['delegatee'] = delegations
+        index._group_delegations()
+        total, groups = index.get_delegation_groups('delegatee')
+        self.assertEqual(len(groups), 5)
+
+        for votes_value in (Decimal('1000'), Decimal('123.4567891'), Decimal('0.0000007')):
+            expected = {}
+            for owner, amount in delegations:
+                share = Decimal(votes_value * amount / total).quantize(Decimal('0.0000001'), rounding=ROUND_DOWN)
+                expected[owner] = expected.get(owner, Decimal(0)) + share
+            self.assertEqual(split_delegated_votes(votes_value, total, groups), expected)
+
+    def test_load_votes_resolves_delegation_without_per_vote_queries(self):
+        delegate = Keypair.random().public_key
+        delegators = [Keypair.random().public_key for _ in range(2)]
+        self._create_claimable_balance(
+            owner=delegate,
+            asset=self.delegation_asset,
+            amount='200',
+            claimants=[(self.market_key, self.unconditional)],
+        )
+        for delegator, amount in zip(delegators, ('30', '10')):
+            self._delegate_to(delegator, delegate, amount)
+
+        votes = [{'votes_value': '300', 'voting_account': delegate}] + [
+            {'votes_value': '5', 'voting_account': Keypair.random().public_key} for _ in range(20)
+        ]
+
+        def vote_loading_mock(loader, page, page_limit=200):
+            return votes if page == 1 else []
+
+        loader = VotesLoader(self.market_key, self.snapshot_time, delegation_index=DelegationIndex(self.snapshot_time))
+        with mock.patch.object(VotesLoader, '_get_page', new=vote_loading_mock):
+            with self.assertNumQueries(0):
+                list(loader.iter_vote_batches())
+            loader.load_votes()
+
+        snapshots = VoteSnapshot.objects.filter(snapshot_time=self.snapshot_time.date(), market_key=self.market_key)
+        self.assertEqual(snapshots.count(), 24)
+        self.assertEqual(snapshots.get(voting_account=delegate, has_delegation=False).votes_value, Decimal('100'))
+        self.assertEqual(snapshots.get(voting_account=delegators[0]).votes_value, Decimal('150'))
+        self.assertEqual(snapshots.get(voting_account=delegators[1]).votes_value, Decimal('50'))
+
+    def test_load_votes_concurrently_writes_from_calling_thread(self):
+        markets = [self.market_key] + [
+            MarketKey.objects.create(market_key=Keypair.random().public_key).market_key for _ in range(3)
+        ]
+        fetch_threads = set()
+        save_threads = set()
+
+        def vote_loading_mock(loader, page, page_limit=200):
+            fetch_threads.add(threading.get_ident())
+            if page > 2:
+                return []
+            return [
+                {'votes_value': '1.5', 'voting_account': '{0}{1}'.format(page, loader.market_key)[:56]},
+            ]
+
+        real_merge_items = VotesLoader.merge_items
+
+        def merge_items_spy(loader, processed, next_page=None):
+            save_threads.add(threading.get_ident())
+            return real_merge_items(loader, processed, next_page)
+
+        index = DelegationIndex(self.snapshot_time)
+        loaders = [VotesLoader(market, self.snapshot_time, delegation_index=index) for market in markets]
+        with mock.patch.object(VotesLoader, '_get_page', new=vote_loading_mock):
+            with mock.patch.object(VotesLoader, 'merge_items', new=merge_items_spy):
+                load_votes_concurrently(loaders, max_workers=4)
+
+        self.assertEqual(save_threads, {threading.get_ident()})
+        self.assertNotIn(threading.get_ident(), fetch_threads)
+        for market in markets:
+            self.assertEqual(
+                VoteSnapshot.objects.filter(market_key=market, snapshot_time=self.snapshot_time.date()).count(), 2,
+            )
+
+    def test_streamed_batches_sum_repeated_keys(self):
+        delegate = Keypair.random().public_key
+        delegator = Keypair.random().public_key
+        voter = Keypair.random().public_key
+        self._create_claimable_balance(
+            owner=delegate,
+            asset=self.delegation_asset,
+            amount='100',
+            claimants=[(self.market_key, self.unconditional)],
+        )
+        self._delegate_to(delegator, delegate, '10')
+
+        # The voter is listed on two pages, which end up in different batches.
+        pages = [
+            [{'votes_value': '7.5', 'voting_account': voter}],
+            [{'votes_value': '100', 'voting_account': delegate}],
+            [{'votes_value': '2.5', 'voting_account': voter}],
+        ]
+
+        def vote_loading_mock(loader, page, page_limit=200):
+            return pages[page - 1] if page <= len(pages) else []
+
+        loader = VotesLoader(self.market_key, self.snapshot_time, flush_every_pages=1)
+        with mock.patch.object(VotesLoader, '_get_page', new=vote_loading_mock):
+            self.assertEqual(len(list(loader.iter_vote_batches())), 3)
+            loader.load_votes()
+
+            snapshots = VoteSnapshot.objects.filter(snapshot_time=self.snapshot_time.date())
+            self.assertEqual(snapshots.count(), 3)
+            self.assertEqual(snapshots.get(voting_account=voter).votes_value, Decimal('10'))
+            self.assertEqual(snapshots.get(voting_account=delegator).votes_value, Decimal('100'))
+
+            # A second run for the same day leaves the stored snapshots alone.
+            VotesLoader(self.market_key, self.snapshot_time, flush_every_pages=1).load_votes()
+
+        self.assertEqual(snapshots.count(), 3)
+        self.assertEqual(snapshots.get(voting_account=voter).votes_value, Decimal('10'))
+
+
+class CopyLoaderTests(TestCase):
+    def test_trustees_snapshot_is_copied(self):
+        asset = Asset('AQUA', random_asset_issuer.public_key)
+        accounts = [Keypair.random().public_key for _ in range(3)]
+        page = [
+            {
+                'account_id': account,
+                'balances': [
+                    {'asset_code': 'OTHER', 'asset_issuer': asset.issuer, 'balance': '1.0000000'},
+                    {'asset_code': asset.code, 'asset_issuer': asset.issuer, 'balance': '{0}.1234567'.format(index)},
+                ],
+            }
+            for index, account in enumerate(accounts)
+        ]
+
+        loader = TrusteesLoader(asset, last_id_cache_key='copy-loader-test')
+        with mock.patch.object(TrusteesLoader, '_get_page', side_effect=[page, []]):
+            loader.make_balances_spanshot()
+
+        snapshots = AssetHolderBalanceStaging.objects.order_by('balance')
+        self.assertEqual([snapshot.account for snapshot in snapshots], accounts)
+        self.assertEqual(snapshots[2].balance, Decimal('2.1234567'))
+        self.assertEqual(snapshots[2].account_ref.address, accounts[2])
+        self.assertIsNotNone(snapshots[2].created_at)
+
+    def test_copy_escapes_text(self):
+        account = 'tab\there, new\nline, back\\slash\r'
+        snapshot = AssetHolderBalanceSnapshot(account=account, asset_code='A\\N', asset_issuer='', balance=Decimal('1'))
+
+        CopyLoader(AssetHolderBalanceSnapshot).insert([snapshot, snapshot], batch_size=1)
+
+        stored = AssetHolderBalanceSnapshot.objects.all()
+        self.assertEqual(len(stored), 2)
+        self.assertEqual(stored[0].account, account)
+        self.assertEqual(stored[0].asset_code, 'A\\N')
+
+
+class TrusteesLoaderTests(TestCase):
+    def setUp(self):
+        self.assets = [Asset('AQUA', random_asset_issuer.public_key), Asset('USDC', random_asset_issuer.public_key)]
+        self.holders = {
+            asset.code: sorted(Keypair.random().public_key for _ in range(12))
+            for asset in self.assets
+        }
+
+    def tearDown(self):
+        cache.clear()
+
+    def _get_page(self, loader, page_limit=5):
+        # Horizon pages holders by account id, after the cursor.
+        cursor = loader.cursor or ''
+        holders = [account for account in self.holders[loader.asset.code] if account > cursor][:page_limit]
+        return [
+            {
+                'account_id': account,
+                'balances': [{
+                    'asset_code': loader.asset.code, 'asset_issuer': loader.asset.issuer, 'balance': '1.0000000',
+                }],
+            }
+            for account in holders
+        ]
+
+    def test_account_id_ranges_cover_keyspace(self):
+        ranges = account_id_ranges(5)
+
+        self.assertEqual(len(ranges), 5)
+        self.assertIsNone(ranges[0][0])
+        self.assertIsNone(ranges[-1][1])
+        for (_, stop_before), (start_after, _) in zip(ranges, ranges[1:]):
+            self.assertEqual(stop_before, start_after)
+        self.assertEqual(account_id_ranges(1), [(None, None)])
+        self.assertEqual(len(account_id_ranges(1000)), len(ACCOUNT_ID_PREFIXES))
+
+    def test_big_assets_are_sharded(self):
+        with mock.patch.object(TrusteesLoader, 'get_holders_count', side_effect=[10, 120000]):
+            small = TrusteesLoader.sharded(self.assets[0], accounts_per_shard=50000)
+            big = TrusteesLoader.sharded(self.assets[1], accounts_per_shard=50000)
+
+        self.assertEqual(len(small), 1)
+        self.assertEqual(len(big), 3)
+        self.assertEqual(len({loader.last_id_cache_key for loader in big}), 3)
+
+    def test_concurrent_snapshot_loads_every_holder_once(self):
+        with mock.patch.object(TrusteesLoader, 'get_holders_count', side_effect=[10, 120000]):
+            loaders = [
+                loader
+                for asset in self.assets
+                for loader in TrusteesLoader.sharded(asset, accounts_per_shard=50000)
+            ]
+
+        with mock.patch.object(TrusteesLoader, '_get_page', autospec=True, side_effect=self._get_page):
+            make_balances_snapshot_concurrently(loaders, max_workers=3)
+
+        for asset in self.assets:
+            self.assertEqual(
+                sorted(AssetHolderBalanceStaging.objects.filter(
+                    asset_code=asset.code,
+                ).values_list('account', flat=True)),
+                self.holders[asset.code],
+            )
+
+    def test_flushes_with_checkpoint_and_resumes_without_duplicates(self):
+        asset = self.assets[0]
+        holders = self.holders[asset.code]
+        calls = []
+
+        def crash_on_third_page(loader, page_limit=5):
+            calls.append(loader.cursor)
+            if len(calls) == 3:
+                raise RuntimeError('worker lost')
+            return self._get_page(loader, page_limit)
+
+        loader = TrusteesLoader(asset, last_id_cache_key='flush-test', flush_pages=2)
+        loader.save_last_event_id(None)
+        with mock.patch.object(TrusteesLoader, '_get_page', autospec=True, side_effect=crash_on_third_page):
+            with self.assertRaises(RuntimeError):
+                loader.make_balances_spanshot()
+
+        self.assertEqual(loader.load_last_event_id(), holders[9])
+        self.assertEqual(AssetHolderBalanceStaging.objects.count(), 10)
+        # Flushed by the lost run but not checkpointed.
+        AssetHolderBalanceStaging.objects.create(
+            account=holders[10], asset_code=asset.code, asset_issuer=asset.issuer, balance=Decimal(1),
+        )
+
+        loader = TrusteesLoader(asset, last_id_cache_key='flush-test', flush_pages=2)
+        with mock.patch.object(TrusteesLoader, '_get_page', autospec=True, side_effect=self._get_page):
+            loader.make_balances_spanshot()
+
+        self.assertEqual(
+            sorted(AssetHolderBalanceStaging.objects.values_list('account', flat=True)), holders,
+        )
+        self.assertEqual(loader.load_last_event_id(), holders[-1])
+
+    def test_staging_table_is_unlogged_and_reloaded_after_crash(self):
+        # Only the staging table skips the WAL, the holders of past days do not.
+        with connection.cursor() as cursor:
+            cursor.execute(
+                "SELECT relname, relpersistence FROM pg_class WHERE relname IN %s",
+                [('rewards_assetholderbalancestaging', 'rewards_assetholderbalancesnapshot')],
+            )
+            self.assertEqual(
+                dict(cursor.fetchall()),
+                {'rewards_assetholderbalancestaging': 'u', 'rewards_assetholderbalancesnapshot': 'p'},
+            )
+
+        asset = self.assets[0]
+        holders = self.holders[asset.code]
+        loader = TrusteesLoader(asset, last_id_cache_key='crash-test', flush_pages=2)
+        # A checkpoint survived in the cache, the unlogged rows it covers did not.
+        loader.save_last_event_id(holders[9])
+        with mock.patch.object(TrusteesLoader, '_get_page', autospec=True, side_effect=self._get_page):
+            loader.make_balances_spanshot()
+
+        self.assertEqual(
+            sorted(AssetHolderBalanceStaging.objects.values_list('account', flat=True)), holders,
+        )
+
+    def test_interrupted_snapshot_blocks_payouts_until_resumed(self):
+        market = MarketKey.objects.create(market_key=Keypair.random().public_key)
+        AggregatedByAssetBribe.objects.create(
+            market_key=market,
+            asset_code=self.assets[0].code,
+            asset_issuer=self.assets[0].issuer,
+            start_at=timezone.now() - timedelta(days=1),
+            stop_at=timezone.now() + timedelta(days=6),
+            total_reward_amount=Decimal('700'),
+        )
+
+        with mock.patch.object(TrusteesLoader, 'get_holders_count', return_value=12), \
+                mock.patch('aquarius_bribes.rewards.tasks.make_balances_snapshot_concurrently',
+                           side_effect=SoftTimeLimitExceeded()), \
+                mock.patch.object(task_make_trustees_snapshot, 'apply_async') as apply_async:
+            task_make_trustees_snapshot()
+
+        apply_async.assert_called_once_with(kwargs={'resume': True}, countdown=60)
+        self.assertTrue(cache.get(LOAD_TRUSTORS_TASK_ACTIVE_KEY))
+        # Holders of a snapshot still in progress are not stored.
+        self.assertFalse(AssetHolderBitmap.objects.exists())
+
+        with mock.patch.object(TrusteesLoader, 'get_holders_count', return_value=12), \
+                mock.patch.object(TrusteesLoader, '_get_page', autospec=True, side_effect=self._get_page):
+            task_make_trustees_snapshot(resume=True)
+
+        self.assertFalse(cache.get(LOAD_TRUSTORS_TASK_ACTIVE_KEY))
+        self.assertEqual(AssetHolderBitmap.objects.get(
+            asset_code=self.assets[0].code, asset_issuer=self.assets[0].issuer, snapshot_date=get_snapshot_date(),
+        ).holders, 12)
+
+    def test_rate_limiter_spaces_calls_across_threads(self):
+        limiter = RateLimiter(rate=100)
+        calls = []
+
+        def call():
+            limiter.wait()
+            calls.append(datetime.now())
+
+        threads = [threading.Thread(target=call) for _ in range(6)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        calls.sort()
+        self.assertGreaterEqual((calls[-1] - calls[0]).total_seconds(), 0.045)
+
+
+class LedgerDumpTrusteesLoaderTests(TestCase):
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.addCleanup(self.directory.cleanup)
+        self.aqua = Asset('AQUA', random_asset_issuer.public_key)
+        self.long_code = Asset('AQUARIUSVOTE', random_asset_issuer.public_key)
+        self.other = Asset('OTHER', random_asset_issuer.public_key)
+        self.accounts = [Keypair.random() for _ in range(4)]
+
+    def _trustline(self, account, asset, balance):
+        return stellar_xdr.BucketEntry(
+            type=stellar_xdr.BucketEntryType.LIVEENTRY,
+            live_entry=stellar_xdr.LedgerEntry(
+                last_modified_ledger_seq=stellar_xdr.Uint32(10),
+                data=stellar_xdr.LedgerEntryData(
+                    type=stellar_xdr.LedgerEntryType.TRUSTLINE,
+                    trust_line=stellar_xdr.TrustLineEntry(
+                        account_id=account.xdr_account_id(),
+                        asset=asset.to_trust_line_asset_xdr_object(),
+                        balance=stellar_xdr.Int64(balance),
+                        limit=stellar_xdr.Int64(2 ** 63 - 1),
+                        flags=stellar_xdr.Uint32(1),
+                        ext=stellar_xdr.TrustLineEntryExt(0),
+                    ),
+                ),
+                ext=stellar_xdr.LedgerEntryExt(0),
+            ),
+        )
+
+    def _removed_trustline(self, account, asset):
+        return stellar_xdr.BucketEntry(
+            type=stellar_xdr.BucketEntryType.DEADENTRY,
+            dead_entry=stellar_xdr.LedgerKey(
+                type=stellar_xdr.LedgerEntryType.TRUSTLINE,
+                trust_line=stellar_xdr.LedgerKeyTrustLine(
+                    account_id=account.xdr_account_id(), asset=asset.to_trust_line_asset_xdr_object(),
+                ),
+            ),
+        )
+
+    def _write_bucket(self, bucket_hash, entries):
+        path = os.path.join(
+            self.directory.name, 'bucket', bucket_hash[0:2], bucket_hash[2:4], bucket_hash[4:6],
+            'bucket-{0}.xdr.gz'.format(bucket_hash),
+        )
+        os.makedirs(os.path.dirname(path))
+        with gzip.open(path, 'wb') as bucket:
+            for entry in entries:
+                record = entry.to_xdr_bytes()
+                bucket.write(struct.pack('>I', len(record) | 0x80000000) + record)
+
+    def test_snapshot_reads_current_trustlines_from_buckets(self):
+        newer, older = 'ab' * 32, 'cd' * 32
+        self._write_bucket(newer, [
+            stellar_xdr.BucketEntry(
+                type=stellar_xdr.BucketEntryType.METAENTRY,
+                meta_entry=stellar_xdr.BucketMetadata(stellar_xdr.Uint32(21), stellar_xdr.BucketMetadataExt(0)),
+            ),
+            self._trustline(self.accounts[0], self.aqua, 50000000),
+            self._removed_trustline(self.accounts[1], self.aqua),
+            self._trustline(self.accounts[2], self.other, 10000000),
+        ])
+        self._write_bucket(older, [
+            self._trustline(self.accounts[0], self.aqua, 10000000),
+            self._trustline(self.accounts[1], self.aqua, 10000000),
+            self._trustline(self.accounts[2], self.long_code, 12345678),
+            self._trustline(self.accounts[3], self.aqua, 0),
+        ])
+        os.makedirs(os.path.join(self.directory.name, '.well-known'))
+        with open(os.path.join(self.directory.name, '.well-known', 'stellar-history.json'), 'w') as state:
+            json.dump({'currentBuckets': [
+                {'curr': newer, 'snap': '0' * 64},
+                {'curr': '0' * 64, 'snap': older},
+            ]}, state)
+        # Replaced by the snapshot.
+        AssetHolderBalanceStaging.objects.create(
+            account=self.accounts[1].public_key, asset_code='AQUA', asset_issuer=self.aqua.issuer, balance=Decimal(1),
+        )
+
+        loader = LedgerDumpTrusteesLoader.from_archive(
+            [self.aqua, self.long_code, Asset.native()], self.directory.name,
+        )
+        holders = loader.make_balances_spanshot(batch_size=2)
+
+        self.assertEqual(holders, {get_asset_string(self.aqua): 2, get_asset_string(self.long_code): 1})
+        self.assertEqual(
+            sorted(AssetHolderBalanceStaging.objects.values_list('account', 'asset_code', 'balance')),
+            sorted([
+                (self.accounts[0].public_key, 'AQUA', Decimal('5')),
+                (self.accounts[2].public_key, 'AQUARIUSVOTE', Decimal('1.2345678')),
+                (self.accounts[3].public_key, 'AQUA', Decimal('0')),
+            ]),
+        )
+        self.assertFalse(AssetHolderBalanceStaging.objects.filter(account_ref=None).exists())
+
+
+@mock.patch('aquarius_bribes.utils.horizon.time.sleep')
+class HorizonPagerTests(TestCase):
+    def _error(self, error_class, status, headers=None):
+        return error_class(HorizonResponse(status, '{}', headers or {}, 'https://horizon.test/accounts'))
+
+    def test_retries_with_backoff_and_retry_after(self, sleep):
+        pager = HorizonPager(base_delay=1, max_delay=4)
+        request = mock.Mock(side_effect=[
+            self._error(BadResponseError, 503),
+            self._error(BadRequestError, 429, {'Retry-After': '30'}),
+            self._error(BadResponseError, 503),
+            self._error(BadResponseError, 503),
+            ['record'],
+        ])
+
+        self.assertEqual(pager.call(request), ['record'])
+
+        delays = [call.args[0] for call in sleep.call_args_list]
+        self.assertEqual(len(delays), 4)
+        self.assertEqual(delays[1], 30)
+        self.assertTrue(all(0 <= delay <= 4 for delay in delays[2:]))
+        self.assertEqual(pager.failures, 0)
+        self.assertEqual(pager.errors, 4)
+
+    def test_client_errors_are_not_retried(self, sleep):
+        pager = HorizonPager()
+        request = mock.Mock(side_effect=self._error(NotFoundError, 404))
+
+        with self.assertRaises(NotFoundError):
+            pager.call(request)
+        self.assertEqual(request.call_count, 1)
+        self.assertEqual(pager.errors, 0)
+
+    def test_circuit_opens_and_fails_fast(self, sleep):
+        pager = HorizonPager(failure_threshold=3)
+        request = mock.Mock(side_effect=self._error(BadResponseError, 502))
+
+        with self.assertRaises(HorizonUnavailable):
+            pager.call(request)
+        self.assertEqual(request.call_count, 3)
+
+        with self.assertRaises(HorizonUnavailable):
+            pager.call(request)
+        self.assertEqual(request.call_count, 3)
+
+        # After reset_after one request probes Horizon again.
+        pager.opened_at -= pager.reset_after
+        request.side_effect = None
+        request.return_value = []
+        self.assertEqual(pager.call(request), [])
+        self.assertIsNone(pager.opened_at)
+
+    def test_error_budget_is_shared_by_requests(self, sleep):
+        pager = HorizonPager(failure_threshold=10, error_budget=3)
+        flaky = [self._error(BadResponseError, 500), 'ok'] * 3
+
+        for _ in range(2):
+            self.assertEqual(pager.call(mock.Mock(side_effect=flaky[:2])), 'ok')
+        with self.assertRaises(HorizonUnavailable):
+            pager.call(mock.Mock(side_effect=[self._error(BadResponseError, 500)] * 2))
+
+    def test_pages_follow_paging_tokens(self, sleep):
+        pages = {
+            None: [{'paging_token': '1'}, {'paging_token': '2'}],
+            '2': [{'paging_token': '3'}],
+            '3': [],
+        }
+        get_page = mock.Mock(side_effect=lambda cursor: pages[cursor])
+
+        self.assertEqual(list(HorizonPager().iter_pages(get_page)), [pages[None], pages['2']])
+
+
+class AssetHolderIntervalTests(TestCase):
+    def setUp(self):
+        self.asset = Asset('AQUA', random_asset_issuer.public_key)
+        self.today = timezone.now().date()
+        self.holders = [Keypair.random().public_key for _ in range(4)]
+
+    def tearDown(self):
+        cache.clear()
+
+    def _load_day(self, days_ago, accounts):
+        day = self.today - timedelta(days=days_ago)
+        snapshots = [
+            AssetHolderBalanceStaging(
+                account=account, asset_code=self.asset.code, asset_issuer=self.asset.issuer, balance=Decimal('1'),
+            )
+            for account in accounts
+        ]
+        Account.objects.assign_refs(snapshots)
+        AssetHolderBalanceStaging.objects.bulk_create(snapshots)
+        AssetHolderBalanceStaging.objects.filter(pk__in=[snapshot.pk for snapshot in snapshots]).update(
+            created_at=timezone.make_aware(datetime.combine(day, time(hour=12))),
+        )
+        return day
+
+    def _as_of(self, day):
+        return set(
+            AssetHolderInterval.objects.as_of(day).filter(asset_code=self.asset.code).values_list(
+                'account__address', flat=True,
+            )
+        )
+
+    def test_only_changed_holders_are_written(self):
+        first, second, third, fourth = self.holders
+        day_1 = self._load_day(2, [first, second, third])
+        self.assertEqual(AssetHolderInterval.objects.sync(self.asset.code, self.asset.issuer, day_1), (0, 3))
+        day_2 = self._load_day(1, [first, third, fourth])
+        self.assertEqual(AssetHolderInterval.objects.sync(self.asset.code, self.asset.issuer, day_2), (1, 1))
+
+        # Resyncing a day replaces what its previous sync did.
+        AssetHolderBalanceStaging.objects.filter(account=fourth).delete()
+        self.assertEqual(AssetHolderInterval.objects.sync(self.asset.code, self.asset.issuer, day_2), (1, 0))
+
+        self.assertEqual(AssetHolderInterval.objects.count(), 3)
+        self.assertEqual(self._as_of(day_1), {first, second, third})
+        self.assertEqual(self._as_of(day_2), {first, third})
+        self.assertEqual(self._as_of(day_1 - timedelta(days=1)), set())
+        with self.assertRaises(ValueError):
+            AssetHolderInterval.objects.sync(self.asset.code, self.asset.issuer, day_1)
+
+        # Eligibility reads the intervals once the day's rows are gone.
+        AssetHolderBalanceStaging.objects.all().delete()
+        self.assertEqual(
+            set(get_asset_holders(self.asset.code, self.asset.issuer, day_2)),
+            set(Account.objects.filter(address__in=[first, third]).values_list('pk', flat=True)),
+        )
+
+        market = MarketKey.objects.create(market_key=Keypair.random().public_key)
+        for account in (first, second, third):
+            VoteSnapshot.objects.create(
+                market_key=market, voting_account=account, votes_value=Decimal('1'), snapshot_time=day_2,
+            )
+        bribe = AggregatedByAssetBribe.objects.create(
+            market_key=market,
+            asset_code=self.asset.code,
+            asset_issuer=self.asset.issuer,
+            start_at=timezone.now() - timedelta(days=1),
+            stop_at=timezone.now() + timedelta(days=6),
+            total_reward_amount=Decimal('700'),
+        )
+        votes, total = get_payable_votes(bribe, day_2)
+        self.assertEqual({vote.voting_account for vote in votes}, {first, third})
+        self.assertEqual(total, Decimal('2'))
+        self.assertEqual(get_eligibility_totals([bribe], day_2)[bribe.pk][0], Decimal('2'))
+
+    def test_trustees_task_keeps_intervals_instead_of_rows(self):
+        market = MarketKey.objects.create(market_key=Keypair.random().public_key)
+        AggregatedByAssetBribe.objects.create(
+            market_key=market,
+            asset_code=self.asset.code,
+            asset_issuer=self.asset.issuer,
+            start_at=timezone.now() - timedelta(days=1),
+            stop_at=timezone.now() + timedelta(days=6),
+            total_reward_amount=Decimal('700'),
+        )
+        page = [
+            {
+                'account_id': account,
+                'balances': [{'asset_code': self.asset.code, 'asset_issuer': self.asset.issuer, 'balance': '1.0'}],
+            }
+            for account in sorted(self.holders)
+        ]
+
+        with mock.patch.object(TrusteesLoader, 'get_holders_count', return_value=len(page)), \
+                mock.patch.object(TrusteesLoader, '_get_page', side_effect=[page, []]):
+            task_make_trustees_snapshot()
+
+        self.assertFalse(AssetHolderBalanceStaging.objects.exists())
+        self.assertFalse(AssetHolderBalanceSnapshot.objects.exists())
+        self.assertEqual(self._as_of(self.today), set(self.holders))
+        self.assertEqual(AssetHolderBitmap.objects.get(snapshot_date=self.today).holders, len(self.holders))
+
+
+@override_settings(DELEGATABLE_ASSETS=DELEGATABLE_ASSETS)
+class VoteSnapshotProgressTests(TestCase):
+    def setUp(self):
+        self.market_key = MarketKey.objects.create(market_key=Keypair.random().public_key).market_key
+        self.snapshot_time = timezone.now().replace(minute=0, second=0, microsecond=0)
+        self.pages = [
+            [{'votes_value': '1', 'voting_account': Keypair.random().public_key}] for _ in range(5)
+        ]
+        self.fetched = []
+
+    def _vote_loading_mock(self, fail_on_page=None):
+        def vote_loading_mock(loader, page, page_limit=200):
+            self.fetched.append(page)
+            if page == fail_on_page:
+                raise requests.ConnectionError('tracker is down')
+            return self.pages[page - 1] if page <= len(self.pages) else []
+        return vote_loading_mock
+
+    def _load(self, fail_on_page=None):
+        loader = VotesLoader(self.market_key, self.snapshot_time, flush_every_pages=2)
+        with mock.patch.object(VotesLoader, '_get_page', new=self._vote_loading_mock(fail_on_page)):
+            loader.load_votes()
+
+    def test_rerun_resumes_from_checkpoint(self):
+        with self.assertRaises(requests.ConnectionError):
+            self._load(fail_on_page=4)
+
+        progress = VoteSnapshotProgress.objects.get(market_key=self.market_key)
+        self.assertEqual(progress.status, VoteSnapshotProgress.STATUS_FAILED)
+        self.assertEqual(progress.next_page, 3)
+        self.assertEqual(progress.message, 'tracker is down')
+        # Page 3 was fetched but not flushed, so it is not stored yet.
+        self.assertEqual(VoteSnapshot.objects.filter(market_key=self.market_key).count(), 2)
+
+        self.fetched = []
+        self._load()
+        self.assertEqual(self.fetched, [3, 4, 5, 6])
+        self.assertEqual(VoteSnapshot.objects.filter(market_key=self.market_key).count(), 5)
+        progress.refresh_from_db()
+        self.assertEqual(progress.status, VoteSnapshotProgress.STATUS_DONE)
+        self.assertIsNotNone(progress.finished_at)
+
+        self.fetched = []
+        self._load()
+        self.assertEqual(self.fetched, [])
+
+    def test_concurrent_load_fails_markets_that_cannot_finish(self):
+        other_market_key = MarketKey.objects.create(market_key=Keypair.random().public_key).market_key
+        loaders = [
+            VotesLoader(market_key, self.snapshot_time, delegation_index=mock.Mock(), flush_every_pages=2)
+            for market_key in (self.market_key, other_market_key)
+        ]
+        real_finish_run = VotesLoader.finish_run
+
+        def finish_run_mock(loader):
+            if loader.market_key == self.market_key:
+                raise ValueError('cannot finish')
+            real_finish_run(loader)
+
+        with mock.patch.object(VotesLoader, '_get_page', new=self._vote_loading_mock()), \
+                mock.patch.object(VotesLoader, 'has_delegated_votes', return_value=False), \
+                mock.patch.object(VotesLoader, 'finish_run', new=finish_run_mock):
+            with self.assertRaisesMessage(ValueError, 'cannot finish'):
+                load_votes_concurrently(loaders, max_workers=2)
+
+        statuses = dict(VoteSnapshotProgress.objects.values_list('market_key_id', 'status'))
+        self.assertEqual(statuses, {
+            self.market_key: VoteSnapshotProgress.STATUS_FAILED,
+            other_market_key: VoteSnapshotProgress.STATUS_DONE,
+        })
+
+    def test_api_reports_progress(self):
+        with self.assertRaises(requests.ConnectionError):
+            self._load(fail_on_page=2)
+
+        with mock.patch('aquarius_bribes.rewards.api.task_load_votes') as task, \
+                mock.patch.object(RunVotesSnapshotAPIView, 'authorization_token', 'token'):
+            response = self.client.post('/api/take-votes-snapshot/', HTTP_AUTHORIZATION='Bearer token')
+            self.assertEqual(response.status_code, 200)
+            self.assertEqual(response.json()['message'], 'Snapshot resumed')
+            self.assertEqual(response.json()['progress']['failed'], 1)
+            task.delay.assert_called_once_with()
+
+            self._load()
+            response = self.client.post('/api/take-votes-snapshot/', HTTP_AUTHORIZATION='Bearer token')
+            self.assertEqual(response.status_code, 403)
+            self.assertEqual(response.json()['progress']['done'], 1)
+            self.assertEqual(response.json()['progress']['pages_loaded'], 5)
+
+    def test_only_one_run_loads_votes(self):
+        with self.assertRaises(requests.ConnectionError):
+            self._load(fail_on_page=2)
+
+        # A run on another worker holds the lock in its own session.
+        other = connection.copy()
+        try:
+            with other.cursor() as cursor:
+                cursor.execute('SELECT pg_advisory_lock(%s)', [LOAD_VOTES_LOCK_ID])
+
+            with mock.patch('aquarius_bribes.rewards.api.task_load_votes') as task, \
+                    mock.patch.object(RunVotesSnapshotAPIView, 'authorization_token', 'token'):
+                response = self.client.post('/api/take-votes-snapshot/', HTTP_AUTHORIZATION='Bearer token')
+            self.assertEqual(response.status_code, 403)
+            self.assertEqual(response.json()['message'], 'Snapshot in progress')
+            task.delay.assert_not_called()
+
+            with mock.patch('aquarius_bribes.rewards.tasks.load_votes_concurrently') as load:
+                task_load_votes()
+            load.assert_not_called()
+        finally:
+            other.close()
+
+        self.assertFalse(is_load_votes_running())
+
+    def test_run_stopped_by_time_limit_resumes(self):
+        AggregatedByAssetBribe.objects.create(
+            market_key_id=self.market_key,
+            asset_code='AQUA',
+            asset_issuer=random_asset_issuer.public_key,
+            start_at=timezone.now() - timedelta(days=1),
+            stop_at=timezone.now() + timedelta(days=6),
+            total_reward_amount=Decimal('700'),
+        )
+
+        with mock.patch('aquarius_bribes.rewards.tasks.task_make_claims_snapshot', return_value=True), \
+                mock.patch('aquarius_bribes.rewards.tasks.load_votes_concurrently',
+                           side_effect=SoftTimeLimitExceeded()), \
+                mock.patch.object(task_load_votes, 'apply_async') as apply_async:
+            task_load_votes()
+
+        apply_async.assert_called_once_with(countdown=60)
+        # Payouts stay blocked until the resumed run is done, which it may
+        # start right away.
+        self.assertTrue(cache.get(LOAD_VOTES_TASK_ACTIVE_KEY))
+        self.assertFalse(is_load_votes_running())
+        cache.delete(LOAD_VOTES_TASK_ACTIVE_KEY)
+
+
+@override_settings(DELEGATABLE_ASSETS=DELEGATABLE_ASSETS)
+class ClaimLoaderTests(TestCase):
+    def _claim(self, owner, destination, index):
+        return {
+            'id': '{0:072d}'.format(index),
+            'amount': '{0}.5000000'.format(index),
+            'sponsor': owner,
+            'last_modified_time': '2025-01-01T00:00:00Z',
+            'last_modified_ledger': index,
+            'paging_token': str(index),
+            'claimants': [
+                {'destination': destination, 'predicate': {'not': {'unconditional': True}}},
+                {'destination': owner, 'predicate': {'unconditional': True}},
+            ],
+        }
+
+    def test_assets_are_loaded_concurrently_with_bulk_inserts(self):
+        owners = [Keypair.random().public_key for _ in range(6)]
+        destination = Keypair.random().public_key
+        pages = {}
+        assets = list(DELEGATABLE_ASSETS[0])
+        for asset_index, asset in enumerate(assets):
+            claims = [self._claim(owners[i], destination, asset_index * 10 + i) for i in range(3)]
+            pages[asset.code] = [claims[:2], claims[2:], []]
+
+        fetch_threads = set()
+
+        def claims_loading_mock(loader, page_limit=200, cursor=None):
+            fetch_threads.add(threading.get_ident())
+            return pages[loader.asset.code].pop(0)
+
+        with mock.patch.object(ClaimLoader, '_get_page', new=claims_loading_mock):
+            load_claims_concurrently([ClaimLoader(asset) for asset in assets], max_workers=2)
+
+        self.assertNotIn(threading.get_ident(), fetch_threads)
+        self.assertEqual(ClaimableBalance.objects.count(), 6)
+        balance = ClaimableBalance.objects.get(claimable_balance_id='{0:072d}'.format(11))
+        self.assertEqual(balance.asset_code, assets[1].code)
+        self.assertEqual(balance.owner, owners[1])
+        self.assertEqual(balance.owner_ref.address, owners[1])
+        self.assertEqual(balance.amount, Decimal('11.5'))
+        self.assertEqual(
+            list(balance.claimants.order_by('id').values_list(
+                'destination', 'predicate_kind', 'destination_ref__address',
+            )),
+            [
+                (destination, BalanceClaimant.PREDICATE_NOT_UNCONDITIONAL, destination),
+                (owners[1], BalanceClaimant.PREDICATE_UNCONDITIONAL, owners[1]),
+            ],
+        )
+
+    def test_snapshot_stopped_by_time_limit_resumes_from_cursor(self):
+        cache.clear()
+        delegatable_asset, delegated_asset = DELEGATABLE_ASSETS[0]
+        claims = {
+            asset.code: [
+                self._claim(Keypair.random().public_key, Keypair.random().public_key, offset + i) for i in range(4)
+            ]
+            for asset, offset in ((delegatable_asset, 0), (delegated_asset, 10))
+        }
+        cursors = []
+        fail_at = {'cursor': '11'}
+
+        def claims_loading_mock(loader, page_limit=200, cursor=None):
+            cursors.append((loader.asset.code, cursor))
+            if loader.asset.code == delegated_asset.code and cursor == fail_at['cursor']:
+                raise SoftTimeLimitExceeded()
+            records = claims[loader.asset.code]
+            start = 0 if cursor is None else [claim['paging_token'] for claim in records].index(cursor) + 1
+            return records[start:start + 2]
+
+        with mock.patch.object(ClaimLoader, '_get_page', new=claims_loading_mock), \
+                mock.patch.object(task_make_claims_snapshot, 'apply_async') as apply_async:
+            self.assertFalse(task_make_claims_snapshot())
+            apply_async.assert_called_once_with(kwargs={'resume': True}, countdown=60)
+            self.assertEqual(ClaimableBalance.objects.filter(asset_code=delegated_asset.code).count(), 2)
+
+            fail_at['cursor'] = 'never'
+            cursors.clear()
+            self.assertTrue(task_make_claims_snapshot(resume=True))
+            self.assertEqual(cursors, [(delegated_asset.code, '11'), (delegated_asset.code, '13')])
+            self.assertEqual(ClaimableBalance.objects.count(), 8)
+
+            cursors.clear()
+            self.assertTrue(task_make_claims_snapshot(resume=True))
+            self.assertEqual(cursors, [])
+
+            # A fresh snapshot reloads the day.
+            self.assertTrue(task_make_claims_snapshot())
+            self.assertEqual(ClaimableBalance.objects.count(), 8)
+            self.assertEqual(len(cursors), 6)
+
+    def test_live_sync_follows_listings_and_copies_snapshot(self):
+        cache.clear()
+        delegatable_asset, delegated_asset = DELEGATABLE_ASSETS[0]
+        owners = [Keypair.random().public_key for _ in range(4)]
+        destination = Keypair.random().public_key
+        balances = {
+            delegatable_asset.code: [self._claim(owners[index], destination, index) for index in range(2)],
+            delegated_asset.code: [self._claim(owners[2], destination, 10)],
+        }
+        requests = []
+
+        def listings_loading_mock(loader, page_limit=200, cursor=None):
+            requests.append((loader.asset.code, cursor))
+            claims = [
+                claim for claim in balances[loader.asset.code]
+                if cursor is None or int(claim['paging_token']) > int(cursor)
+            ]
+            return claims[:1]
+
+        with mock.patch.object(ClaimLoader, '_get_page', new=listings_loading_mock):
+            live_claims = LiveClaimsSync([delegatable_asset, delegated_asset])
+            # Each sync pages at most one listing page per asset.
+            self.assertFalse(live_claims.sync(max_pages=1))
+            self.assertEqual(LiveClaimableBalance.objects.count(), 2)
+            self.assertTrue(live_claims.sync(max_pages=2))
+            self.assertEqual(LiveClaimableBalance.objects.count(), 3)
+
+            today = timezone.now().date()
+            # Nothing is copied before a sweep has run.
+            with self.assertRaises(ValueError):
+                live_claims.copy_snapshot(today)
+
+            # One balance is created, one claimed: the tail picks up the new
+            # one, the sweep drops the claimed one once it reaches the end.
+            created = self._claim(owners[3], destination, 2)
+            balances[delegatable_asset.code] = [balances[delegatable_asset.code][0], created]
+            requests.clear()
+            self.assertTrue(live_claims.sync())
+            self.assertEqual(LiveClaimableBalance.objects.count(), 4)
+            self.assertFalse(live_claims.sweep(max_pages=1))
+            self.assertTrue(live_claims.sweep())
+
+            self.assertEqual(
+                requests,
+                [
+                    (delegatable_asset.code, '1'), (delegatable_asset.code, '2'),
+                    (delegated_asset.code, '10'),
+                    (delegatable_asset.code, None), (delegated_asset.code, None),
+                    (delegatable_asset.code, '0'), (delegatable_asset.code, '2'),
+                    (delegated_asset.code, '10'),
+                ],
+            )
+            self.assertEqual(
+                sorted(LiveClaimableBalance.objects.values_list('claimable_balance_id', flat=True)),
+                ['{0:072d}'.format(index) for index in (0, 2, 10)],
+            )
+
+            live_claims.copy_snapshot(today)
+            # Between snapshots only the tail is paged; the next copy waits
+            # for a new sweep.
+            requests.clear()
+            self.assertTrue(live_claims.sync())
+            self.assertEqual(requests, [(delegatable_asset.code, '2'), (delegated_asset.code, '10')])
+            with self.assertRaises(ValueError):
+                live_claims.copy_snapshot(today)
+            self.assertTrue(live_claims.sweep())
+            live_claims.copy_snapshot(today)
+
+        snapshot = ClaimableBalance.objects.filter(snapshot_date=today)
+        self.assertEqual(snapshot.count(), 3)
+        self.assertEqual(BalanceClaimant.objects.filter(snapshot_date=today).count(), 6)
+        balance = snapshot.get(claimable_balance_id=created['id'])
+        self.assertEqual((balance.asset_code, balance.owner_ref.address), (delegatable_asset.code, owners[3]))
+        self.assertEqual(
+            list(balance.claimants.order_by('id').values_list('destination', 'predicate_kind')),
+            [
+                (destination, BalanceClaimant.PREDICATE_NOT_UNCONDITIONAL),
+                (owners[3], BalanceClaimant.PREDICATE_UNCONDITIONAL),
+            ],
+        )
+
+    def test_page_is_not_stored_twice_on_the_same_day(self):
+        loader = ClaimLoader(DELEGATABLE_ASSETS[0][0])
+        claims = [self._claim(Keypair.random().public_key, Keypair.random().public_key, i) for i in range(2)]
+
+        self.assertEqual(len(loader.save_page(claims)), 2)
+        self.assertEqual(loader.save_page(claims), [])
+        self.assertEqual(ClaimableBalance.objects.count(), 2)
+        self.assertEqual(BalanceClaimant.objects.count(), 4)
@@ -1,20 +1,61 @@
-from typing import Dict, List
+from datetime import date, datetime, time, timedelta
+from typing import Dict, Iterator, List, Optional, Tuple
 
 from django.core.cache import cache
+from django.db.models import QuerySet
+from django.utils import timezone
 
 from stellar_sdk import Asset
-from stellar_sdk.exceptions import BadResponseError, ConnectionError
 
 from aquarius_bribes.bribes.utils import get_horizon
-from aquarius_bribes.rewards.models import AssetHolderBalanceSnapshot
+from aquarius_bribes.rewards.bulk_load import CopyLoader
+from aquarius_bribes.rewards.models import Account, AssetHolderBalanceStaging, get_snapshot_date
+from aquarius_bribes.utils.concurrency import consume_concurrently
+from aquarius_bribes.utils.horizon import HorizonPager
+
+# Every account id starts with G followed by one of A-D (the top bits of
+# the key) and then any base32 character, so these 128 prefixes cover the
+# keyspace. Sorted as strings, like Horizon orders accounts.
+ACCOUNT_ID_PREFIXES = sorted(
+    'G' + first + second for first in 'ABCD' for second in 'ABCDEFGHIJKLMNOPQRSTUVWXYZ234567'
+)
+ACCOUNTS_PER_SHARD = 50000
+MAX_SHARDS = 16
+# Pages buffered before they are written and the cursor is checkpointed.
+FLUSH_PAGES = 50
+
+
+def account_id_ranges(count: int) -> List[Tuple[Optional[str], Optional[str]]]:
+    """
+    Split the account id keyspace into ``count`` ranges of (cursor,
+    stop_before). A prefix used as a cursor pages every account that
+    starts with it, since Horizon returns ids greater than the cursor.
+    """
+    count = max(1, min(count, len(ACCOUNT_ID_PREFIXES)))
+    bounds = [ACCOUNT_ID_PREFIXES[len(ACCOUNT_ID_PREFIXES) * index // count] for index in range(1, count)]
+    return list(zip([None] + bounds, bounds + [None]))
 
 
 class TrusteesLoader(object):
     def __init__(
         self, asset: Asset, last_id_cache_key: str = None, last_id_cache_timeout: int = 60 * 60 * 12,
+        start_after: str = None, stop_before: str = None, pager: HorizonPager = None,
+        snapshot_date: date = None, flush_pages: int = FLUSH_PAGES,
     ):
         self.asset = asset
         self.horizon = get_horizon()
+        # Range of the account id keyspace this loader pages, see account_id_ranges.
+        self.start_after = start_after
+        self.stop_before = stop_before
+        self.pager = pager or HorizonPager()
+        self.snapshot_date = snapshot_date or get_snapshot_date()
+
+        # Paging position, ahead of the checkpoint by the buffered pages.
+        self.cursor = start_after
+        self.pending_cursor = None
+        self.flush_pages = flush_pages
+        self.buffer = []
+        self.buffered_pages = 0
 
         if not last_id_cache_key:
             last_id_cache_key = '{0}:{1}_trustees_loader'.format(self.asset.code, self.asset.issuer)
@@ -30,37 +71,135 @@ class TrusteesLoader(object):
     def save_last_event_id(self, last_id: str):
         cache.set(self.last_id_cache_key, last_id, self.last_id_cache_timeout)
 
-    def _get_page(self, page_limit: int = 200) -> List[Dict]:
-        try:
-            page_builder = self.horizon.accounts().for_asset(
-                Asset(code=self.asset.code, issuer=self.asset.issuer),
-            ).limit(page_limit).order(
-                desc=False,
+    def _get_day_rows(self) -> QuerySet:
+        day_start = timezone.make_aware(datetime.combine(self.snapshot_date, time.min))
+        return AssetHolderBalanceStaging.objects.filter(
+            asset_code=self.asset.code,
+            asset_issuer=self.asset.issuer or '',
+            created_at__gte=day_start,
+            created_at__lt=day_start + timedelta(days=1),
+        )
+
+    def _get_stored(self) -> QuerySet:
+        stored = self._get_day_rows()
+        if self.cursor:
+            stored = stored.filter(account__gt=self.cursor)
+        if self.stop_before:
+            stored = stored.filter(account__lt=self.stop_before)
+        return stored
+
+    def resume(self):
+        """
+        Continue from the saved checkpoint, or from the start of the range
+        without one. Rows of the day stored past it, by a run stopped between
+        a flush and its checkpoint, are deleted so they are not loaded twice.
+        """
+        checkpoint = self.load_last_event_id()
+        if checkpoint:
+            # The staging table is unlogged and emptied by a database crash;
+            # a checkpoint without the rows it covers starts over.
+            kept = self._get_day_rows().filter(account__lte=checkpoint)
+            if self.start_after:
+                kept = kept.filter(account__gt=self.start_after)
+            if not kept.exists():
+                checkpoint = None
+        self.cursor = checkpoint or self.start_after
+        self.buffer = []
+        self.buffered_pages = 0
+        self._get_stored().delete()
+
+    def reset(self):
+        """Forget the checkpoint and delete the day's rows in the loader's range."""
+        self.save_last_event_id(None)
+        self.resume()
+
+    def store_page(self, snapshots: List[AssetHolderBalanceStaging], cursor: str):
+        self.buffer.extend(snapshots)
+        self.buffered_pages += 1
+        self.pending_cursor = cursor
+        if self.buffered_pages >= self.flush_pages:
+            self.flush()
+
+    def flush(self):
+        """Write the buffered pages, then checkpoint the cursor of the last one."""
+        if not self.buffered_pages:
+            return
+        Account.objects.assign_refs(self.buffer)
+        CopyLoader(AssetHolderBalanceStaging).insert(self.buffer)
+        self.save_last_event_id(self.pending_cursor)
+        self.buffer = []
+        self.buffered_pages = 0
+
+    @classmethod
+    def sharded(
+        cls, asset: Asset, pager: HorizonPager = None,
+        accounts_per_shard: int = ACCOUNTS_PER_SHARD, max_shards: int = MAX_SHARDS,
+    ) -> List['TrusteesLoader']:
+        """
+        Loaders splitting the asset's holders over account id ranges, one
+        per ``accounts_per_shard`` holders, so big assets page in parallel.
+        Each range keeps its own cursor.
+        """
+        loader = cls(asset, pager=pager)
+        count = min(max_shards, max(1, -(-loader.get_holders_count() // accounts_per_shard)))
+        if count == 1:
+            return [loader]
+
+        return [
+            cls(
+                asset, last_id_cache_key='{0}:{1}'.format(loader.last_id_cache_key, start_after or ''),
+                start_after=start_after, stop_before=stop_before, pager=pager,
             )
+            for start_after, stop_before in account_id_ranges(count)
+        ]
+
+    def get_holders_count(self) -> int:
+        records = self.pager.call(
+            self.horizon.assets().for_code(self.asset.code).for_issuer(self.asset.issuer).call,
+        )['_embedded']['records']
+        if not records:
+            return 0
+        accounts = records[0].get('accounts', {})
+        return sum(
+            int(accounts.get(key, 0))
+            for key in ('authorized', 'authorized_to_maintain_liabilities', 'unauthorized')
+        )
 
-            last_id = self.load_last_event_id()
-            if last_id:
-                page_builder = page_builder.cursor(last_id)
+    def _get_page(self, page_limit: int = 200) -> List[Dict]:
+        page_builder = self.horizon.accounts().for_asset(
+            Asset(code=self.asset.code, issuer=self.asset.issuer),
+        ).limit(page_limit).order(
+            desc=False,
+        )
 
-            return page_builder.call()['_embedded']['records']
-        except (BadResponseError, ConnectionError):
-            return None
+        if self.cursor:
+            page_builder = page_builder.cursor(self.cursor)
 
-    def make_balances_spanshot(self):
-        accounts_page = self._get_page()
-        processed_accounts = []
-        while accounts_page or accounts_page is None:
-            if accounts_page is not None:
-                for account in accounts_page:
-                    processed_accounts.append(self._process_account(account))
+        return page_builder.call()['_embedded']['records']
 
-                self.save_last_event_id(processed_accounts[-1].account)
+    def iter_pages(self) -> Iterator[Tuple[List[AssetHolderBalanceStaging], str]]:
+        """Yield the holders of each page in range with the page's cursor."""
+        # Paged by hand: the cursor is the account id, and ranges stop early.
+        accounts_page = self.pager.call(self._get_page)
+        while accounts_page:
+            self.cursor = accounts_page[-1]['account_id']
+            in_range = [
+                account for account in accounts_page
+                if self.stop_before is None or account['account_id'] < self.stop_before
+            ]
+            yield [self._process_account(account) for account in in_range], self.cursor
+            if len(in_range) < len(accounts_page):
+                return
 
-            accounts_page = self._get_page()
+            accounts_page = self.pager.call(self._get_page)
 
-        AssetHolderBalanceSnapshot.objects.bulk_create(processed_accounts, batch_size=5000)
+    def make_balances_spanshot(self):
+        self.resume()
+        for snapshots, cursor in self.iter_pages():
+            self.store_page(snapshots, cursor)
+        self.flush()
 
-    def _process_account(self, account: Dict) -> AssetHolderBalanceSnapshot:
+    def _process_account(self, account: Dict) -> AssetHolderBalanceStaging:
         balance = next(
             (
                 x for x in account['balances']
@@ -68,9 +207,36 @@ class TrusteesLoader(object):
             ),
             None,
         )
-        return AssetHolderBalanceSnapshot(
+        return AssetHolderBalanceStaging(
             account=account['account_id'],
             asset_code=self.asset.code,
             asset_issuer=self.asset.issuer or '',
             balance=balance['balance'],
         )
+
+
+def make_balances_snapshot_concurrently(loaders: List[TrusteesLoader], max_workers: int = 8):
+    """
+    Page the holders of several assets, or account id ranges of one, in a
+    thread pool and store them from the calling thread, so the snapshot
+    takes as long as the largest range rather than the sum of all assets.
+    Each loader resumes from its checkpoint and flushes every
+    ``flush_pages`` pages. The first fetch error is raised once the other
+    loaders are done.
+    """
+    for loader in loaders:
+        loader.resume()
+
+    errors = consume_concurrently(
+        loaders,
+        lambda loader: loader.iter_pages(),
+        lambda loader, item: loader.store_page(*item),
+        max_workers=max_workers,
+        thread_name_prefix='trustees-loader',
+    )
+    # Pages fetched before a loader failed are complete and kept too.
+    for loader in loaders:
+        loader.flush()
+    for error in errors:
+        if error is not None:
+            raise error
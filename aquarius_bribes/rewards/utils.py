@@ -11,3 +11,7 @@ def _get_not_unconditinal_predicate():
     return ClaimPredicate.predicate_not(
         ClaimPredicate.predicate_unconditional(),
     ).to_xdr_object().to_xdr()
+
+
+def _get_unconditional_predicate():
+    return ClaimPredicate.predicate_unconditional().to_xdr_object().to_xdr()
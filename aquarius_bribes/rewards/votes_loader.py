@@ -1,98 +1,212 @@
-from datetime import timedelta
 from decimal import ROUND_DOWN, Decimal
+from itertools import groupby
+from operator import itemgetter
+from typing import Dict, List, Tuple
 
 from django.conf import settings
-from django.db import IntegrityError, models
+from django.db import connection, models, transaction
+from django.utils import timezone
 
-import sentry_sdk
 import requests
 
-from aquarius_bribes.rewards.models import ClaimableBalance, VoteSnapshot
-from aquarius_bribes.rewards.utils import _get_not_unconditinal_predicate
+from aquarius_bribes.rewards.bulk_load import CopyLoader
+from aquarius_bribes.rewards.models import Account, Claimant, VoteSnapshot, VoteSnapshotProgress
 from aquarius_bribes.utils.assets import get_asset_string, parse_asset_string
+from aquarius_bribes.utils.concurrency import consume_concurrently
+
+FLUSH_EVERY_PAGES = 25
+MERGE_COLUMNS = [
+    'snapshot_time', 'market_key', 'voting_account', 'voting_account_ref',
+    'is_delegated', 'has_delegation', 'delegate_owner', 'votes_value',
+]
+# delegate_owner is NULL for undelegated votes and the unique key treats
+# NULLs as distinct, so keys are matched explicitly instead of relying on
+# ON CONFLICT.
+MERGE_VOTES_SQL = """
+WITH summed AS (
+    UPDATE "{table}" AS stored SET "votes_value" = stored."votes_value" + incoming."votes_value"
+    FROM "{staging_table}" AS incoming
+    WHERE stored."snapshot_time" = incoming."snapshot_time"
+        AND stored."market_key_id" = incoming."market_key_id"
+        AND stored."voting_account" = incoming."voting_account"
+        AND stored."is_delegated" = incoming."is_delegated"
+        AND stored."has_delegation" = incoming."has_delegation"
+        AND stored."delegate_owner" IS NOT DISTINCT FROM incoming."delegate_owner"
+        AND stored."id" > %s
+)
+INSERT INTO "{table}" ({columns})
+SELECT {columns} FROM "{staging_table}" AS incoming
+WHERE NOT EXISTS (
+    SELECT 1 FROM "{table}" AS stored
+    WHERE stored."snapshot_time" = incoming."snapshot_time"
+        AND stored."market_key_id" = incoming."market_key_id"
+        AND stored."voting_account" = incoming."voting_account"
+        AND stored."is_delegated" = incoming."is_delegated"
+        AND stored."has_delegation" = incoming."has_delegation"
+        AND stored."delegate_owner" IS NOT DISTINCT FROM incoming."delegate_owner"
+)
+"""
+
+
+class DelegationIndex(object):
+    """
+    Delegations recorded as claimable balances on one snapshot day, loaded
+    with a single query over all claimants of the day so VotesLoader
+    resolves delegation for every vote of every market in memory.
+
+    ``delegated`` maps owner -> {claimant destination -> amount} for balances
+    of the delegated assets: a delegatee's votes locked for a market.
+    ``delegations`` maps delegatee -> [(owner, amount)] for balances of the
+    delegatable assets locked in favour of the delegatee. Balances matching
+    several claimants are repeated exactly as the joins of the per-voter
+    queries used to repeat them.
+    ``delegation_groups`` holds the same delegations per delegatee as
+    (total amount, [(owner, amount, repeats)]), the shape the vote split
+    is computed from.
+    """
+    def __init__(self, snapshot_time):
+        self.snapshot_time = snapshot_time
+        self.delegated = {}
+        self.delegations = {}
+        self.delegation_groups = {}
+        self._load()
+        self._group_delegations()
+
+    def _load(self):
+        delegatable_assets = {(asset.code, asset.issuer) for asset, _ in settings.DELEGATABLE_ASSETS}
+        delegated_assets = {(asset.code, asset.issuer) for _, asset in settings.DELEGATABLE_ASSETS}
+
+        asset_filter = models.Q()
+        for code, issuer in delegatable_assets | delegated_assets:
+            asset_filter |= models.Q(claimable_balance__asset_code=code, claimable_balance__asset_issuer=issuer)
+
+        snapshot_date = self.snapshot_time.date()
+        claimants = Claimant.objects.filter(
+            snapshot_date=snapshot_date, claimable_balance__snapshot_date=snapshot_date,
+        ).filter(asset_filter).annotate(
+            is_not_unconditional=models.ExpressionWrapper(
+                models.Q(predicate_kind=Claimant.PREDICATE_NOT_UNCONDITIONAL), output_field=models.BooleanField(),
+            ),
+        ).values_list(
+            'claimable_balance_id', 'claimable_balance__owner', 'claimable_balance__amount',
+            'claimable_balance__asset_code', 'claimable_balance__asset_issuer',
+            'destination', 'is_not_unconditional',
+        ).order_by('claimable_balance_id', 'id')
+
+        for _, balance_claimants in groupby(claimants.iterator(), key=itemgetter(0)):
+            balance_claimants = list(balance_claimants)
+            _, owner, amount, asset_code, asset_issuer, _, _ = balance_claimants[0]
+
+            if (asset_code, asset_issuer) in delegated_assets:
+                owner_delegated = self.delegated.setdefault(owner, {})
+                for claimant in balance_claimants:
+                    destination = claimant[5]
+                    owner_delegated[destination] = owner_delegated.get(destination, Decimal('0')) + amount
+
+            if (asset_code, asset_issuer) in delegatable_assets:
+                markers = sum(1 for claimant in balance_claimants if claimant[5] == settings.DELEGATE_MARKER)
+                for claimant in balance_claimants:
+                    if claimant[6]:
+                        self.delegations.setdefault(claimant[5], []).extend([(owner, amount)] * markers)
+
+    def _group_delegations(self):
+        for delegatee, delegations in self.delegations.items():
+            repeats = {}
+            for delegation in delegations:
+                repeats[delegation] = repeats.get(delegation, 0) + 1
+            self.delegation_groups[delegatee] = (
+                sum((amount for _, amount in delegations), Decimal(0)),
+                [(owner, amount, count) for (owner, amount), count in repeats.items()],
+            )
+
+    def has_delegated_votes(self, voting_account, market_key) -> bool:
+        return market_key in self.delegated.get(voting_account, {})
+
+    def amount_delegated_votes(self, voting_account, market_key) -> Decimal:
+        return self.delegated.get(voting_account, {}).get(market_key, Decimal('0'))
+
+    def get_delegations(self, delegatee) -> List[Tuple[str, Decimal]]:
+        return self.delegations.get(delegatee, [])
+
+    def get_delegation_groups(self, delegatee) -> Tuple[Decimal, List[Tuple[str, Decimal, int]]]:
+        return self.delegation_groups.get(delegatee, (Decimal(0), []))
+
+
+def split_delegated_votes(votes_value, total_delegated_votes, delegation_groups) -> Dict[str, Decimal]:
+    """
+    Each delegator's share of a delegatee's votes, proportional to the
+    amount delegated and rounded down to a stroop per delegation, exactly
+    as one snapshot per delegation summed by owner would give: equal
+    (owner, amount) delegations get equal shares, so each share is computed
+    once and multiplied by its repeats.
+    """
+    shares = {}
+    for owner, amount, repeats in delegation_groups:
+        share = Decimal(
+            votes_value * amount / total_delegated_votes,
+        ).quantize(
+            Decimal('0.0000001'), rounding=ROUND_DOWN,
+        )
+        shares[owner] = shares.get(owner, Decimal(0)) + share * repeats
+    return shares
 
 
 class VotesLoader(object):
-    def __init__(self, market_key, snapshot_time, base_url='https://voting-tracker.aqua.network'):
+    def __init__(
+        self, market_key, snapshot_time, base_url='https://voting-tracker.aqua.network', delegation_index=None,
+        session=None, flush_every_pages: int = FLUSH_EVERY_PAGES,
+    ):
         self.market_key = market_key
         self.snapshot_time = snapshot_time
         self.base_url = base_url
+        self._delegation_index = delegation_index
+        self.session = session or requests
+        self.flush_every_pages = flush_every_pages
+        self.run_start_id = 0
+        self.start_page = 1
+        self.progress = None
+
+    @property
+    def delegation_index(self) -> DelegationIndex:
+        # Built on first use, so a loader that only sees undelegated votes
+        # in tests or one-off runs does not pay for it; task_load_votes
+        # shares one index between the loaders of all markets.
+        if self._delegation_index is None:
+            self._delegation_index = DelegationIndex(self.snapshot_time)
+        return self._delegation_index
+
+    @property
+    def snapshot_date(self):
+        return VoteSnapshot._meta.get_field('snapshot_time').to_python(self.snapshot_time)
 
     def _get_page(self, page, page_limit: int = 200):
-        response = requests.get(
+        response = self.session.get(
             '{}/api/market-keys/{}/votes/?limit={}&timestamp={}&page={}'.format(
                 self.base_url, self.market_key, page_limit, self.snapshot_time.strftime("%s"), page,
-            )
+            ),
+            timeout=settings.DEFAULT_GET_TIMEOUT,
         )
         return response.json().get('results', [])
 
     def process_vote(self, vote):
         return VoteSnapshot(
             snapshot_time=self.snapshot_time,
-            votes_value=vote['votes_value'],
+            votes_value=Decimal(vote['votes_value']),
             voting_account=vote['voting_account'],
             market_key_id=self.market_key,
         )
 
-    def _get_delegated_asset_filter(self):
-        asset_filter = models.Q()
-        for _, delegated_asset in settings.DELEGATABLE_ASSETS:
-            asset_filter |= models.Q(
-                asset_code=delegated_asset.code,
-                asset_issuer=delegated_asset.issuer,
-            )
-        return asset_filter
-
-    def _get_delegatable_asset_filter(self):
-        asset_filter = models.Q()
-        for asset, _ in settings.DELEGATABLE_ASSETS:
-            asset_filter |= models.Q(
-                asset_code=asset.code,
-                asset_issuer=asset.issuer,
-            )
-        return asset_filter
-
     def has_delegated_votes(self, voting_account):
-        asset_filter = self._get_delegated_asset_filter()
-
-        date = self.snapshot_time.replace(hour=0)
-        return ClaimableBalance.objects.filter(
-            loaded_at__gte=date, loaded_at__lt=date + timedelta(days=1),
-        ).filter(owner=voting_account).filter(
-            asset_filter,
-        ).filter(claimants__destination=self.market_key).exists()
+        return self.delegation_index.has_delegated_votes(voting_account, str(self.market_key))
 
     def amount_delegated_votes(self, voting_account):
-        asset_filter = self._get_delegated_asset_filter()
-
-        date = self.snapshot_time.replace(hour=0)
-        return ClaimableBalance.objects.filter(
-            loaded_at__gte=date, loaded_at__lt=date + timedelta(days=1),
-        ).filter(owner=voting_account).filter(
-            asset_filter,
-        ).filter(claimants__destination=self.market_key).aggregate(
-            total_votes=models.Sum('amount'),
-        )['total_votes'] or Decimal('0')
+        return self.delegation_index.amount_delegated_votes(voting_account, str(self.market_key))
 
     def process_delegated_vote(self, voting_account, votes_value):
         votes = []
         votes_value = Decimal(votes_value)
 
-        asset_filter = self._get_delegatable_asset_filter()
-
-        date = self.snapshot_time.replace(hour=0)
-        delegated_votes = ClaimableBalance.objects.filter(
-            loaded_at__gte=date, loaded_at__lt=date + timedelta(days=1),
-        ).filter(
-            claimants__raw_predicate=_get_not_unconditinal_predicate(),
-            claimants__destination=voting_account
-        ).filter(
-            asset_filter,
-        ).filter(claimants__destination=settings.DELEGATE_MARKER)
-        total_delegated_votes = delegated_votes.aggregate(total_votes=models.Sum('amount'))['total_votes']
-
-        if total_delegated_votes is None:
-            total_delegated_votes = Decimal(0)
+        total_delegated_votes, delegation_groups = self.delegation_index.get_delegation_groups(voting_account)
 
         delegated_votes_amount = self.amount_delegated_votes(voting_account)
 
@@ -121,17 +235,14 @@ class VotesLoader(object):
             votes_value = delegated_votes_amount
 
         if total_delegated_votes > 0:
-            for delegated_vote in delegated_votes:
+            shares = split_delegated_votes(votes_value, total_delegated_votes, delegation_groups)
+            for owner, share in shares.items():
                 votes.append(
                     VoteSnapshot(
                         snapshot_time=self.snapshot_time,
-                        votes_value=Decimal(
-                            votes_value * delegated_vote.amount / total_delegated_votes,
-                        ).quantize(
-                            Decimal('0.0000001'), rounding=ROUND_DOWN,
-                        ),
+                        votes_value=share,
                         delegate_owner=voting_account,
-                        voting_account=delegated_vote.owner,
+                        voting_account=owner,
                         market_key_id=self.market_key,
                         is_delegated=True,
                     )
@@ -159,18 +270,13 @@ class VotesLoader(object):
 
         return list(aggregated.values())
 
-    def save_all_items(self, processed):
-        try:
-            VoteSnapshot.objects.bulk_create(processed, batch_size=5000)
-        except IntegrityError:
-            for item in processed:
-                try:
-                    item.save()
-                except IntegrityError as err:
-                    sentry_sdk.capture_exception(err)
-
-    def load_votes(self):
-        page = 1
+    def iter_vote_batches(self):
+        """
+        Page through the voting tracker from ``start_page`` and yield
+        (aggregated unsaved snapshots, next page to fetch) every
+        ``flush_every_pages`` pages. Does not touch the database.
+        """
+        page = self.start_page
         votes = self._get_page(page)
         parsed_votes = []
 
@@ -188,7 +294,134 @@ class VotesLoader(object):
                     )
 
             page += 1
+            if (page - self.start_page) % self.flush_every_pages == 0:
+                yield self.aggregate_items(parsed_votes), page
+                parsed_votes = []
+
             votes = self._get_page(page)
 
-        aggregated_votes = self.aggregate_items(parsed_votes)
-        self.save_all_items(aggregated_votes)
+        if parsed_votes:
+            yield self.aggregate_items(parsed_votes), page
+
+    def _get_run_start_id(self):
+        # Snapshots of this market and day written before this run keep
+        # their values; only rows created by this run are summed into.
+        return VoteSnapshot.objects.filter(
+            snapshot_time=self.snapshot_date, market_key_id=self.market_key,
+        ).aggregate(last_id=models.Max('id'))['last_id'] or 0
+
+    def begin_run(self) -> bool:
+        """
+        Start or resume the run of this market and day. Returns False when
+        its votes are already loaded.
+        """
+        with transaction.atomic():
+            self.progress, created = VoteSnapshotProgress.objects.select_for_update().get_or_create(
+                snapshot_time=self.snapshot_date, market_key_id=self.market_key,
+                defaults={'tracker_timestamp': self.snapshot_time},
+            )
+            if self.progress.status == VoteSnapshotProgress.STATUS_DONE:
+                return False
+
+            if created:
+                self.progress.run_start_id = self._get_run_start_id()
+            elif self.progress.tracker_timestamp != self.snapshot_time:
+                # Pages of another timestamp do not line up with the
+                # checkpoint: drop what the interrupted run wrote and restart.
+                VoteSnapshot.objects.filter(
+                    snapshot_time=self.snapshot_date, market_key_id=self.market_key,
+                    id__gt=self.progress.run_start_id,
+                ).delete()
+                self.progress.tracker_timestamp = self.snapshot_time
+                self.progress.next_page = 1
+
+            self.progress.status = VoteSnapshotProgress.STATUS_RUNNING
+            self.progress.message = ''
+            self.progress.save()
+
+        self.run_start_id = self.progress.run_start_id
+        self.start_page = self.progress.next_page
+        return True
+
+    def merge_items(self, processed, next_page: int = None):
+        """
+        Write one batch of aggregated snapshots, COPYed into a staging table
+        and merged in one statement: votes of keys this run already wrote
+        are added to the stored row, new keys are inserted.
+        A key recurs between batches when the tracker lists a voter on more
+        than one page, which the old load-everything-then-aggregate path
+        summed as well.
+        ``next_page`` is checkpointed in the same transaction.
+        """
+        Account.objects.assign_refs(processed)
+
+        copy_loader = CopyLoader(VoteSnapshot, MERGE_COLUMNS)
+        with transaction.atomic(), connection.cursor() as cursor:
+            if processed:
+                staging_table = copy_loader.stage(cursor, processed)
+                cursor.execute(
+                    MERGE_VOTES_SQL.format(
+                        table=copy_loader.table, staging_table=staging_table, columns=copy_loader.columns,
+                    ),
+                    [self.run_start_id],
+                )
+            if self.progress is not None and next_page is not None:
+                self.progress.next_page = next_page
+                self.progress.save(update_fields=['next_page', 'updated_at'])
+
+    def finish_run(self):
+        if self.progress is not None:
+            self.progress.status = VoteSnapshotProgress.STATUS_DONE
+            self.progress.finished_at = timezone.now()
+            self.progress.save(update_fields=['status', 'finished_at', 'updated_at'])
+
+    def fail_run(self, error):
+        if self.progress is not None:
+            self.progress.status = VoteSnapshotProgress.STATUS_FAILED
+            self.progress.message = str(error)
+            self.progress.save(update_fields=['status', 'message', 'updated_at'])
+
+    def load_votes(self):
+        if not self.begin_run():
+            return
+        try:
+            for batch, next_page in self.iter_vote_batches():
+                self.merge_items(batch, next_page)
+        except Exception as error:
+            self.fail_run(error)
+            raise
+        self.finish_run()
+
+
+def load_votes_concurrently(loaders, max_workers: int = 8):
+    """
+    Fetch votes of several markets in a thread pool while the calling
+    thread writes the batches, see consume_concurrently. Loaders must share
+    a built DelegationIndex.
+
+    Batches already written are kept and checkpointed when a market fails,
+    so a rerun resumes it, but only markets fetched completely are marked
+    done. Every market is marked done or failed before the first error is
+    raised. Markets already loaded for the day are skipped.
+    """
+    loaders = [loader for loader in loaders if loader.begin_run()]
+
+    errors = consume_concurrently(
+        loaders,
+        lambda loader: loader.iter_vote_batches(),
+        lambda loader, item: loader.merge_items(*item),
+        max_workers=max_workers,
+        thread_name_prefix='votes-loader',
+    )
+    first_error = None
+    for loader, error in zip(loaders, errors):
+        if error is None:
+            try:
+                loader.finish_run()
+            except Exception as finish_error:
+                error = finish_error
+        if error is not None:
+            loader.fail_run(error)
+            first_error = first_error or error
+    if first_error is not None:
+        raise first_error
@@ -65,6 +65,11 @@ def setup_periodic_tasks(sender, **kwargs):
         #     'schedule': crontab(hour='0', minute='0'),
         #     'args': (),
         # },
+        'aquarius_bribes.rewards.tasks.task_sync_live_claims': {
+            'task': 'aquarius_bribes.rewards.tasks.task_sync_live_claims',
+            'schedule': crontab(minute='*/5'),
+            'args': (),
+        },
         'aquarius_bribes.rewards.tasks.task_make_trustees_snapshot': {
             'task': 'aquarius_bribes.rewards.tasks.task_make_trustees_snapshot',
             'schedule': crontab(hour='0', minute='0'),
@@ -80,5 +85,10 @@ def setup_periodic_tasks(sender, **kwargs):
             'schedule': crontab(hour='*', minute='1'),
             'args': (),
         },
+        'aquarius_bribes.rewards.tasks.task_ensure_partitions': {
+            'task': 'aquarius_bribes.rewards.tasks.task_ensure_partitions',
+            'schedule': crontab(hour='3', minute='30'),
+            'args': (),
+        },
         'drf_secure_token.tasks.delete_old_tokens': DELETE_OLD_TOKENS,
     })
@@ -0,0 +1,56 @@
+import queue
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from typing import Callable, Iterable, List, Optional
+
+_DONE = object()
+
+
+def consume_concurrently(
+    sources: list, produce: Callable[[object], Iterable], consume: Callable[[object, object], None],
+    max_workers: int = 8, thread_name_prefix: str = 'producer',
+) -> List[Optional[BaseException]]:
+    """
+    Iterate ``produce(source)`` for every source in a thread pool and hand
+    each item to ``consume(source, item)`` on the calling thread through a
+    bounded queue. Worker threads only fetch, so they never open database
+    connections of their own, and memory stays bounded by the queue size.
+
+    Returns the exception each producer failed with, or None, in the order
+    of ``sources``. An exception from ``consume`` or raised in the calling
+    thread (a soft time limit) stops the workers and propagates.
+    """
+    items = queue.Queue(maxsize=max_workers * 2)
+    stop = threading.Event()
+
+    def put(item):
+        while not stop.is_set():
+            try:
+                items.put(item, timeout=1)
+                return
+            except queue.Full:
+                continue
+
+    def fetch(source):
+        try:
+            for item in produce(source):
+                if stop.is_set():
+                    return
+                put((source, item))
+        finally:
+            put((source, _DONE))
+
+    executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix=thread_name_prefix)
+    futures = [executor.submit(fetch, source) for source in sources]
+    try:
+        pending = len(sources)
+        while pending:
+            source, item = items.get()
+            if item is _DONE:
+                pending -= 1
+            else:
+                consume(source, item)
+        return [future.exception() for future in futures]
+    finally:
+        stop.set()
+        executor.shutdown(wait=False, cancel_futures=True)
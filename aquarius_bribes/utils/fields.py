@@ -0,0 +1,58 @@
+from decimal import ROUND_HALF_UP, Decimal
+
+from django import forms
+from django.core import exceptions
+from django.db import models
+
+STROOPS_IN_UNIT = 10 ** 7
+STROOP = Decimal('0.0000001')
+
+
+def to_stroops(value) -> int:
+    # Rounds like a numeric(20, 7) column did, so stored values do not change.
+    return int((Decimal(value) * STROOPS_IN_UNIT).quantize(Decimal(1), rounding=ROUND_HALF_UP))
+
+
+def from_stroops(value) -> Decimal:
+    return (Decimal(value) / STROOPS_IN_UNIT).quantize(STROOP)
+
+
+class StroopField(models.BigIntegerField):
+    """
+    Stellar amount stored as a bigint number of stroops (amount * 10^7).
+
+    Python code keeps seeing the same Decimal with 7 decimal places a
+    DecimalField(max_digits=20, decimal_places=7) gave, while the column is
+    half the size of numeric and sums and comparisons run on integers.
+    """
+    description = 'Stellar amount stored in stroops'
+
+    def from_db_value(self, value, expression, connection):
+        if value is None:
+            return value
+        # Sum() over a bigint column comes back as numeric.
+        return from_stroops(value)
+
+    def to_python(self, value):
+        if value is None or isinstance(value, Decimal):
+            return value
+        try:
+            return Decimal(value).quantize(STROOP)
+        except (ArithmeticError, TypeError, ValueError):
+            raise exceptions.ValidationError(
+                self.error_messages['invalid'], code='invalid', params={'value': value},
+            )
+
+    def get_prep_value(self, value):
+        value = models.Field.get_prep_value(self, value)
+        if value is None or hasattr(value, 'resolve_expression'):
+            return value
+        return to_stroops(value)
+
+    def formfield(self, **kwargs):
+        return models.Field.formfield(self, **{
+            'form_class': forms.DecimalField,
+            'max_digits': 19,
+            'decimal_places': 7,
+            **kwargs,
+        })
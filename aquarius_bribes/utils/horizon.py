@@ -0,0 +1,114 @@
+import random
+import threading
+import time
+from typing import Callable, Dict, Iterator, List, Optional, TypeVar
+
+from stellar_sdk.exceptions import BadRequestError, BadResponseError, ConnectionError
+
+from aquarius_bribes.utils.http import RateLimiter
+
+T = TypeVar('T')
+
+HTTP_TOO_MANY_REQUESTS = 429
+# Seconds to wait, sent by Horizon with 429 and 503 responses.
+RETRY_AFTER_HEADERS = ('Retry-After', 'X-Ratelimit-Reset')
+
+
+class HorizonUnavailable(Exception):
+    """Horizon kept failing: the circuit is open or the error budget is spent."""
+
+
+class HorizonPager(object):
+    """
+    Runs the Horizon requests of the loaders sharing it, from any thread.
+
+    Connection errors, 5xx and 429 responses are retried after a jittered
+    exponential backoff, or after the delay Horizon asks for if it is
+    longer. ``failure_threshold`` failures in a row open the circuit: every
+    request fails fast with HorizonUnavailable for ``reset_after`` seconds,
+    then one is let through to probe. Retries beyond ``error_budget`` over
+    the pager's life give up as well, so an outage stops the loaders at
+    their checkpoints instead of spinning until the task's time limit.
+    """
+    def __init__(
+        self, rate_limiter: RateLimiter = None, base_delay: float = 1.0, max_delay: float = 60.0,
+        failure_threshold: int = 8, reset_after: float = 60.0 * 5, error_budget: int = 200,
+    ):
+        self.rate_limiter = rate_limiter
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.failure_threshold = failure_threshold
+        self.reset_after = reset_after
+        self.error_budget = error_budget
+
+        self.failures = 0
+        self.errors = 0
+        self.opened_at = None
+        self._lock = threading.Lock()
+
+    def _check_circuit(self):
+        with self._lock:
+            if self.opened_at is not None and time.monotonic() - self.opened_at < self.reset_after:
+                raise HorizonUnavailable('Circuit open after {0} failed requests in a row'.format(self.failures))
+
+    def _record_failure(self, error: Exception):
+        with self._lock:
+            self.failures += 1
+            self.errors += 1
+            if self.failures >= self.failure_threshold:
+                self.opened_at = time.monotonic()
+                raise HorizonUnavailable(
+                    'Circuit opened after {0} failed requests in a row'.format(self.failures),
+                ) from error
+            if self.errors > self.error_budget:
+                raise HorizonUnavailable('Error budget of {0} retries spent'.format(self.error_budget)) from error
+
+    def _record_success(self):
+        with self._lock:
+            self.failures = 0
+            self.opened_at = None
+
+    def get_delay(self, error: Exception, attempt: int) -> float:
+        delay = random.uniform(0, min(self.max_delay, self.base_delay * 2 ** attempt))
+
+        response = error.args[0] if error.args else None
+        headers = getattr(response, 'headers', None) or {}
+        for header in RETRY_AFTER_HEADERS:
+            try:
+                delay = max(delay, float(headers[header]))
+            except (KeyError, TypeError, ValueError):
+                continue
+        return delay
+
+    def call(self, request: Callable[[], T]) -> T:
+        attempt = 0
+        while True:
+            self._check_circuit()
+            if self.rate_limiter:
+                self.rate_limiter.wait()
+
+            try:
+                result = request()
+            except (BadRequestError, BadResponseError, ConnectionError) as error:
+                if isinstance(error, BadRequestError) and error.status != HTTP_TOO_MANY_REQUESTS:
+                    raise
+                self._record_failure(error)
+                time.sleep(self.get_delay(error, attempt))
+                attempt += 1
+                continue
+
+            self._record_success()
+            return result
+
+    def iter_pages(
+        self, get_page: Callable[[Optional[str]], List[Dict]], cursor: str = None,
+    ) -> Iterator[List[Dict]]:
+        """
+        Yield ``get_page(cursor)`` until a page comes back empty, continuing
+        after the paging token of each page's last record.
+        """
+        page = self.call(lambda: get_page(cursor))
+        while page:
+            yield page
+            cursor = page[-1]['paging_token']
+            page = self.call(lambda: get_page(cursor))
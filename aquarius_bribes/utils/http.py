@@ -0,0 +1,52 @@
+import threading
+import time
+from urllib.parse import urlsplit
+
+import requests
+from requests.adapters import HTTPAdapter
+
+
+class HostLimitedSession(requests.Session):
+    """
+    requests.Session with a keep-alive connection pool, safe to share between
+    threads, that lets at most ``max_per_host`` requests to the same host be
+    in flight at once.
+    """
+    def __init__(self, max_per_host: int = 4):
+        super().__init__()
+        self.max_per_host = max_per_host
+        self._semaphores = {}
+        self._semaphores_lock = threading.Lock()
+
+        adapter = HTTPAdapter(pool_maxsize=max_per_host)
+        self.mount('https://', adapter)
+        self.mount('http://', adapter)
+
+    def _get_semaphore(self, host: str) -> threading.BoundedSemaphore:
+        with self._semaphores_lock:
+            if host not in self._semaphores:
+                self._semaphores[host] = threading.BoundedSemaphore(self.max_per_host)
+            return self._semaphores[host]
+
+    def request(self, method, url, *args, **kwargs):
+        with self._get_semaphore(urlsplit(url).netloc):
+            return super().request(method, url, *args, **kwargs)
+
+
+class RateLimiter(object):
+    """
+    Spaces calls to wait(), from any number of threads, at most ``rate``
+    per second apart.
+    """
+    def __init__(self, rate: float):
+        self.interval = 1.0 / rate
+        self._next_at = 0.0
+        self._lock = threading.Lock()
+
+    def wait(self):
+        with self._lock:
+            now = time.monotonic()
+            delay = self._next_at - now
+            self._next_at = max(now, self._next_at) + self.interval
+        if delay > 0:
+            time.sleep(delay)
@@ -154,6 +154,9 @@ STATICFILES_DIRS = [
 MEDIA_URL = '/media/'
 MEDIA_ROOT = root('media')
 
+# Parquet / Arrow files with archived snapshots and payouts, see rewards.archive
+REWARDS_ARCHIVE_ROOT = env('REWARDS_ARCHIVE_ROOT', default=root('archive'))
+
 
 CELERY_ENABLED = env.bool('CELERY_ENABLED', default=True)
 if CELERY_ENABLED:
@@ -233,4 +236,10 @@ REWARD_SERVER_AUTHORIZATION_TOKEN = NotImplemented
 
 DELEGATE_MARKER = NotImplemented
 DELEGATABLE_ASSETS = NotImplemented
+# Keep claimable balances of DELEGATABLE_ASSETS up to date from their Horizon
+# listings and take daily claims snapshots from them, see rewards.claims_sync
+CLAIMS_LIVE_SYNC = env.bool('CLAIMS_LIVE_SYNC', default=False)
+# Local mirror of a history archive; when set, trustee snapshots are read
+# from its latest bucket list instead of Horizon, see rewards.ledger_dump
+TRUSTEES_LEDGER_ARCHIVE_PATH = env('TRUSTEES_LEDGER_ARCHIVE_PATH', default='')
 